@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for the ws.py interpreter"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ws
+
+
+def timed(func, repeat=5):
+    """Return the best wall-clock time of several runs of func"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name, baseline, optimized):
+    """Print a benchmark result line"""
+    print(f"{name:<40} baseline {baseline * 1000:9.2f} ms   ws {optimized * 1000:9.2f} ms   "
+          f"speedup {baseline / optimized:6.1f}x")
+
+
+def bench_expressions(iterations=100000):
+    """Loop counters and conditions: eval with a globals copy vs ExpressionEvaluator"""
+    evaluator = ws.ExpressionEvaluator()
+
+    def eval_loop():
+        variables = {'i': 0}
+        while True:
+            exec_globals = vars(ws).copy()
+            exec_globals.update(variables)
+            if not eval("i < %d" % iterations, exec_globals, variables):
+                break
+            variables['i'] = eval("i + 1", exec_globals, variables)
+
+    def evaluator_loop():
+        variables = {'i': 0}
+        while evaluator.evaluate("i < %d" % iterations, variables):
+            variables['i'] = evaluator.evaluate("i + 1", variables)
+
+    report(f"loop counter ({iterations} iterations)", timed(eval_loop), timed(evaluator_loop))
+
+    variables = {'x': 10, 'name': 'Tester', 'version': 1.5}
+    condition = "x > 5 and name == 'Tester' or version >= 2.0"
+
+    def eval_conditions():
+        for _ in range(iterations):
+            exec_globals = vars(ws).copy()
+            exec_globals.update(variables)
+            eval(condition, exec_globals, variables)
+
+    def evaluator_conditions():
+        for _ in range(iterations):
+            evaluator.evaluate(condition, variables)
+
+    report(f"conditions ({iterations} evaluations)", timed(eval_conditions), timed(evaluator_conditions))
+
+
+def bench_run(commands=200):
+    """Per-command overhead of run: a new shell per command vs argv and a persistent session"""
+    interpreter = ws.WSInterpreter()
+
+    def shell_commands():
+        for _ in range(commands):
+            interpreter.run_command(["shell", "echo", "hello"])
+
+    def argv_commands():
+        for _ in range(commands):
+            interpreter.run_command(["argv", sys.executable, "-S", "-c", "pass"])
+
+    def python_commands():
+        for _ in range(commands):
+            interpreter.run_command(["shell", sys.executable, "-S", "-c", "pass"])
+
+    def session_commands():
+        for _ in range(commands):
+            interpreter.run_command(["session", "echo", "hello"])
+
+    report(f"shell vs session echo ({commands} commands)", timed(shell_commands, 3), timed(session_commands, 3))
+    report(f"shell vs argv python ({commands} commands)", timed(python_commands, 3), timed(argv_commands, 3))
+    interpreter.close()
+
+
+class RecursiveInterpreter(ws.WSInterpreter):
+    """The former execution chain: execute -> handler -> _execute_block_body -> execute"""
+
+    def execute(self, parsed_code):
+        result = None
+        for command in parsed_code:
+            if len(command) >= 2 and command[0] in self.block_handlers:
+                result = self.block_handlers[command[0]](command[1])
+            elif command[0] in self.commands:
+                result = self.commands[command[0]](command[1:])
+        return result
+
+    def conditional(self, block):
+        condition, body, else_body = self._split_if_block(block)
+        if self.evaluator.evaluate(condition, self.variables):
+            return self._execute_block_body(body)
+        return self._execute_block_body(else_body) if else_body else None
+
+    def while_loop(self, block):
+        result = None
+        while self.evaluator.evaluate(block[0][6:], self.variables):
+            result = self._execute_block_body(block[1:-1])
+        return result
+
+    def call_function(self, args):
+        previous_scope = self.current_function_scope
+        self.current_function_scope = args[0]
+        result = self.execute(self.compiled_functions[args[0]])
+        self.current_function_scope = previous_scope
+        return result
+
+
+def bench_calls(depth=200, repeat=50):
+    """Recursive WS function calls: the recursive execute chain vs the explicit-stack executor"""
+    script = f"""
+function countdown
+    if n > 0
+        set n n - 1
+        call countdown
+    end
+end
+set i 0
+while i < {repeat}
+    set n {depth}
+    call countdown
+    set i i + 1
+end
+"""
+    recursive, stacked = RecursiveInterpreter(), ws.WSInterpreter()
+    recursive_code, stacked_code = recursive.parse(script), stacked.parse(script)
+
+    def recursive_calls():
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, depth * 10))
+        try:
+            recursive.execute(recursive_code)
+        finally:
+            sys.setrecursionlimit(limit)
+
+    report(f"recursive calls ({repeat} x depth {depth})", timed(recursive_calls), timed(lambda: stacked.execute(stacked_code)))
+
+
+def bench_monitor(processes=50, interval='250ms', duration=5.0):
+    """CPU overhead of sampling many processes with process monitor"""
+    import subprocess
+    children = [subprocess.Popen([sys.executable, "-c", "import time; time.sleep(600)"]) for _ in range(processes)]
+    interpreter = ws.WSInterpreter()
+    try:
+        for child in children:
+            interpreter.process_operations(["monitor", str(child.pid), f"interval={interval}"])
+        start_cpu, start = time.process_time(), time.perf_counter()
+        time.sleep(duration)
+        cpu, wall = time.process_time() - start_cpu, time.perf_counter() - start
+        samples = sum(monitor.ring.count for monitor in interpreter.process_sampler.monitors.values())
+        print(f"{f'monitor {processes} processes every {interval}':<40} {samples} samples   "
+              f"cpu {cpu * 1000:7.1f} ms in {wall:.1f} s   overhead {100 * cpu / wall:5.2f}%")
+    finally:
+        interpreter.close()
+        for child in children:
+            child.kill()
+            child.wait()
+
+
+def write_gray_png(path, pixels):
+    """Write a 2-D uint8 array as a grayscale PNG file"""
+    import struct
+    import zlib
+    raw = b''.join(b'\x00' + row.tobytes() for row in pixels)
+    chunk = lambda kind, data: struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    header = struct.pack('>IIBBBBB', pixels.shape[1], pixels.shape[0], 8, 0, 0, 0, 0)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+def bench_screen(width=1920, height=1080, template_size=(40, 120)):
+    """Template search in a full-HD screenshot with screen find (needs NumPy)"""
+    import tempfile
+    np = ws.numpy
+    if np is None:
+        print(f"{'screen find (full HD)':<40} skipped: NumPy not installed")
+        return
+    rng = np.random.default_rng(1)
+    y, x = np.mgrid[0:height, 0:width]
+    screen = ((x // 7 + y // 5) % 200 + 20).astype(np.uint8)
+    th, tw = template_size
+    button = rng.integers(0, 256, template_size, dtype=np.uint8)
+    screen[700:700 + th, 1500:1500 + tw] = button
+    image = screen.astype(np.float64)
+    matcher = ws.ImageMatcher()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'button.png')
+        write_gray_png(path, button)
+        match = matcher.find(image, path)
+        assert match and match[:2] == (1500, 700), match
+        elapsed = timed(lambda: matcher.find(image, path), 10)
+    print(f"{f'screen find {tw}x{th} in {width}x{height}':<40} {elapsed * 1000:9.2f} ms")
+
+
+def bench_vectors(count=1000000):
+    """Summary statistics over a million samples: a list of floats vs a vector"""
+    import random
+    rng = random.Random(1)
+    samples = [rng.uniform(0, 1000) for _ in range(count)]
+
+    def list_summary():
+        ordered = sorted(samples)
+        total = sum(ordered)
+        [ordered[max(0, -(-int(p * count) // 100) - 1)] for p in (50, 90, 95, 99)]
+        return total / count, ordered[0], ordered[-1]
+
+    def vector_summary():
+        return ws.Vector(samples).summary()
+
+    report(f"summary ({count} samples)", timed(list_summary, 3), timed(vector_summary, 3))
+
+
+def bench_search(files=20000, lines=100):
+    """Regex search over many files: sequential read and decode vs file search"""
+    import re
+    import tempfile
+    interpreter = ws.WSInterpreter()
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(files):
+            subdirectory = os.path.join(directory, f"d{i % 100}")
+            os.makedirs(subdirectory, exist_ok=True)
+            body = ''.join(f"key{n} = value {n}\n" for n in range(lines))
+            if i % 50 == 0:
+                body += "timeout = 30  # TODO tune\n"
+            with open(os.path.join(subdirectory, f"f{i}.conf"), 'w') as f:
+                f.write(body)
+        pattern = directory.replace(os.sep, '/') + '/**/*.conf'
+
+        def read_and_match():
+            regex = re.compile(r'TODO \w+')
+            found = []
+            for path in interpreter.scan_files([pattern]):
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    for number, line in enumerate(f.read().splitlines(), 1):
+                        for match in regex.finditer(line):
+                            found.append((path, number, match.start() + 1, line))
+            return found
+
+        def file_search():
+            return list(interpreter.search_files([r'TODO \w+', 'in', pattern]))
+
+        assert len(read_and_match()) == len(file_search()) == files // 50
+        report(f"search ({files} files)", timed(read_and_match, 3), timed(file_search, 3))
+    interpreter.close()
+
+
+BENCHMARKS = {
+    'expressions': bench_expressions,
+    'run': bench_run,
+    'calls': bench_calls,
+    'monitor': bench_monitor,
+    'screen': bench_screen,
+    'vectors': bench_vectors,
+    'search': bench_search,
+}
+
+
+def parse_arguments():
+    """Parse command line arguments for the benchmark runner"""
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for WS Language Interpreter",
+        epilog="Example: python bench_ws.py expressions"
+    )
+    parser.add_argument("names", nargs="*", help="Benchmarks to run (default: all)")
+    parser.add_argument("-l", "--list", action="store_true", help="List available benchmarks")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.list:
+        for name, func in BENCHMARKS.items():
+            print(f"  {name:<20} - {func.__doc__}")
+    else:
+        for name in args.names or BENCHMARKS:
+            BENCHMARKS[name]()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import os
+import json
 import sys
 import subprocess
 import tempfile
@@ -36,16 +37,18 @@ class WSInterpreterTest(unittest.TestCase):
         except:
             print(f"Failed to delete test directory: {cls.test_dir}")
     
-    def run_script(self, script_content):
-        """Runs a ws script and returns its output"""
+    def run_script(self, script_content, *options, timeout=None):
+        """Runs a ws script with optional command line options and returns its output"""
         script_path = os.path.join(self.test_dir, "test_script.ws")
         with open(script_path, 'w', encoding='utf-8') as f:
             f.write(script_content)
             
         result = subprocess.run(
-            [sys.executable, self.ws_path, script_path],
+            [sys.executable, self.ws_path, *options, script_path],
+            cwd=self.test_dir,
             capture_output=True,
-            text=True
+            text=True,
+            timeout=timeout
         )
         return result.stdout, result.stderr, result.returncode
     
@@ -373,6 +376,1363 @@ call inner
             "There should be an error message about access to nested function"
         )
 
+    def test_018_optimizer(self):
+        """Testing that -O folds constants without changing output"""
+        scripts = ['''
+set DEBUG 0
+set LIMIT 2 * 3 + 1
+if DEBUG == 1
+    print "Debug mode"
+end
+if LIMIT > 5
+    print "Limit $LIMIT is big"
+else
+    print "Limit is small"
+end
+set i 0
+while i < 3
+    if DEBUG
+        print "Debug $i"
+    end
+    print "Step $i of $LIMIT"
+    set i i + 1
+end
+while DEBUG
+    print "Never printed"
+end
+''', '''
+set x 10
+set name "Tester"
+set version 1.0
+if version >= 1.0
+    print "Name: $name, x: $x"
+else
+    print "Outdated"
+end
+function double
+    set y x * 2
+    print "double = $y"
+end
+call double
+set x 3
+call double
+''']
+        outputs = []
+        for script in scripts:
+            plain, _, plain_code = self.run_script(script)
+            optimized, _, optimized_code = self.run_script(script, "-O")
+            self.assertEqual(plain_code, 0)
+            self.assertEqual(optimized_code, 0)
+            self.assertEqual(plain, optimized)
+            outputs.append(optimized)
+        self.assertIn("Limit 7 is big", outputs[0])
+        self.assertIn("Step 2 of 7", outputs[0])
+        self.assertIn("double = 20", outputs[1])
+        self.assertIn("double = 6", outputs[1])
+        
+        from ws import WSInterpreter
+        interpreter = WSInterpreter()
+        optimized_code = interpreter.optimize(interpreter.parse(scripts[0]))
+        self.assertNotIn('if', [command[0] for command in optimized_code])
+        self.assertIn(['set', 'LIMIT', '7'], optimized_code)
+
+    def test_019_safe_expressions(self):
+        """Testing the restricted expression evaluator"""
+        output, _, code = self.run_script('''
+set a 7
+set b 2
+set q a / b
+set f a // b
+set s 'abc' * 2
+set ok 1 < a <= 7 and not b > 5
+set n len(s) + abs(b - a)
+print "q=$q f=$f s=$s ok=$ok n=$n"
+set pwn __import__("os").getcwd()
+print "pwn=$pwn"
+if __import__("os").name
+    print "Unsafe condition executed"
+end
+set r exec 2 ** 8
+print "r=$r"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("q=3.5 f=3 s=abcabc ok=True n=11", output)
+        self.assertIn('pwn=__import__("os").getcwd()', output)
+        self.assertNotIn("Unsafe condition executed", output)
+        self.assertIn("r=256", output)
+        
+        from ws import ExpressionEvaluator
+        evaluator = ExpressionEvaluator()
+        for expression in ("9 ** 9 ** 9", "'x' * 10 ** 12", "10 ** 12 * b'x'", "bytes(10 ** 12)",
+                           "1 << 10 ** 12", "'%.999999999d' % 1"):
+            with self.assertRaises(ValueError, msg=expression):
+                evaluator.evaluate(expression, {})
+        self.assertEqual(evaluator.evaluate("2 ** 100 + (-3) ** 3", {}), 2 ** 100 - 27)
+        self.assertEqual(evaluator.evaluate("'ab' * 2 + '%03d' % 7", {}), "abab007")
+
+    def test_020_binary_files(self):
+        """Testing binary file reading, mapping, hashing and patching"""
+        import hashlib
+        import zlib
+        payload = b"MZ\x90\x00" + bytes(range(256)) * 4 + b"PAYLOAD-END"
+        source = os.path.join(self.test_dir, "payload.bin")
+        copy = os.path.join(self.test_dir, "payload_copy.bin")
+        with open(source, 'wb') as f:
+            f.write(payload)
+            
+        output, _, code = self.run_script(f'''
+set data from file readbytes {source}
+set view from file map {source}
+set size len(view)
+set is_exe view[0:2] == b"MZ"
+set marker find(view, b"PAYLOAD")
+set digest sha256(view)
+set checksum crc32(data[4:])
+set file_digest from file hash {source} md5
+print "size=$size exe=$is_exe marker=$marker"
+print "digest=$digest"
+print "checksum=$checksum"
+print "file_digest=$file_digest"
+file write {copy} $data
+file patch {copy} 0 b"ZM"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn(f"size={len(payload)} exe=True marker={payload.find(b'PAYLOAD')}", output)
+        self.assertIn(f"digest={hashlib.sha256(payload).hexdigest()}", output)
+        self.assertIn(f"checksum={zlib.crc32(payload[4:])}", output)
+        self.assertIn(f"file_digest={hashlib.md5(payload).hexdigest()}", output)
+        with open(copy, 'rb') as f:
+            self.assertEqual(f.read(), b"ZM" + payload[2:])
+
+    def test_021_wait_until(self):
+        """Testing event-driven wait until conditions"""
+        target = os.path.join(self.test_dir, "wait_target.txt")
+        if os.path.exists(target):
+            os.remove(target)
+            
+        output, _, code = self.run_script(f'''
+exec __import__("threading").Timer(0.2, lambda: open(r"{target}", "w").close()).start()
+set start exec __import__("time").monotonic()
+set created from wait until file exists {target} timeout 5
+set elapsed exec __import__("time").monotonic() - start
+print "created=$created"
+if elapsed < 1
+    print "reacted quickly"
+end
+exec __import__("threading").Timer(0.2, lambda: open(r"{target}", "a").write("x")).start()
+set changed from wait until file changed {target} timeout 5
+print "changed=$changed"
+set missing from wait until file exists {target}.missing timeout 0.2
+print "missing=$missing"
+set pid exec __import__("subprocess").Popen([r"{sys.executable}", "-c", "import time; time.sleep(0.2)"]).pid
+set exited from wait until process exits $pid timeout 5
+print "exited=$exited"
+set x 10
+set reached from wait until x > 5 timeout 1
+print "reached=$reached"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("created=True", output)
+        self.assertIn("reacted quickly", output)
+        self.assertIn("changed=True", output)
+        self.assertIn("missing=False", output)
+        self.assertIn("exited=True", output)
+        self.assertIn("reached=True", output)
+
+    def test_022_scheduler(self):
+        """Testing every/at blocks and misfire handling"""
+        output, _, code = self.run_script('''
+set n 0
+every 100ms count=3
+    set n n + 1
+    print "tick $n"
+end
+every 150ms count=2
+    print "tock"
+end
+at 23:59 count=0
+    print "Never printed"
+end
+print "scheduled"
+''', "--max-concurrency", "2")
+        self.assertEqual(code, 0)
+        self.assertLess(output.index("scheduled"), output.index("tick 1"))
+        self.assertIn("tick 3", output)
+        self.assertEqual(output.count("tock"), 2)
+        self.assertNotIn("tick 4", output)
+        self.assertNotIn("Never printed", output)
+        
+        from ws import WSInterpreter
+        skipping = WSInterpreter()
+        skipping.execute(skipping.parse('''
+every 100ms count=2 misfire=skip
+    wait 0.35
+end
+'''))
+        skipping.run_scheduled()
+        job = skipping.scheduler.jobs[0]
+        self.assertEqual(job.runs, 2)
+        self.assertGreaterEqual(job.missed, 2)
+        
+        catching_up = WSInterpreter()
+        catching_up.execute(catching_up.parse('''
+every 100ms count=3 misfire=catchup
+    wait 0.25
+end
+'''))
+        catching_up.run_scheduled()
+        job = catching_up.scheduler.jobs[0]
+        self.assertEqual(job.runs, 3)
+        self.assertEqual(job.missed, 0)
+        
+        output, _, code = self.run_script('''
+function outer
+    function inner
+        print "inner ran"
+    end
+    wait 0.6
+    print "outer done"
+end
+every 100ms count=1
+    call outer
+end
+every 300ms count=1
+    call inner
+end
+''', "--max-concurrency", "2")
+        self.assertEqual(code, 0)
+        self.assertIn("outer done", output)
+        self.assertIn("Function 'inner' not defined", output)
+        self.assertNotIn("inner ran", output)
+
+    def test_023_streaming_run(self):
+        """Testing streaming run output, redirection and foreach over run"""
+        emitter = os.path.join(self.test_dir, "emit_lines.py")
+        with open(emitter, 'w', encoding='utf-8') as f:
+            f.write("import sys\n"
+                    "for i in range(int(sys.argv[1])):\n"
+                    "    print('line', i, flush=True)\n"
+                    "sys.exit(int(sys.argv[2]) if len(sys.argv) > 2 else 0)\n")
+        target = os.path.join(self.test_dir, "run_output.txt")
+        
+        output, _, code = self.run_script(f'''
+run stream {sys.executable} {emitter} 3
+run {sys.executable} {emitter} 5000 > {target}
+set count 0
+foreach line in run {sys.executable} {emitter} 4
+    set count count + 1
+    print "got $line"
+end
+print "count=$count"
+foreach line in run {sys.executable} {emitter} 30 2
+    set count count + 1
+end
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("line 2", output)
+        self.assertIn("got line 3", output)
+        self.assertIn("count=4", output)
+        self.assertIn("Command error (exit code 2), last 20 lines:", output)
+        self.assertIn("line 29", output)
+        self.assertNotIn("line 9\n", output)
+        with open(target, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 5000)
+        self.assertEqual(lines[-1], "line 4999")
+
+    def test_024_shell_session_and_argv(self):
+        """Testing the persistent shell session and shell-free argv execution"""
+        echo_args = os.path.join(self.test_dir, "echo_args.py")
+        with open(echo_args, 'w', encoding='utf-8') as f:
+            f.write("import sys\nprint('|'.join(sys.argv[1:]))\n")
+            
+        output, _, code = self.run_script(f'''
+set quoted from run argv {sys.executable} {echo_args} "two words" 'single' "semi;colon"
+print "argv=$quoted"
+shell open
+shell run cd {self.test_dir}
+set here from run session {sys.executable} -c "import os; print(os.getcwd())"
+print "cwd=$here"
+shell run FOO=persisted
+set foo from run session echo $FOO
+print "foo=$foo"
+foreach arg in run argv {sys.executable} {echo_args} "two words" x
+    print "foreach argv=$arg"
+end
+shell mode session
+foreach here in run {sys.executable} -c "import os; print(os.getcwd())"
+    print "foreach cwd=$here"
+end
+shell mode shell
+set failed from run session exit 3
+print "failed=$failed"
+shell close
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("argv=two words|'single'|semi;colon", output)
+        self.assertIn("foreach argv=two words|x", output)
+        if os.name != 'nt':
+            self.assertIn(f"cwd={os.path.realpath(self.test_dir)}", output)
+            self.assertIn(f"foreach cwd={os.path.realpath(self.test_dir)}", output)
+            self.assertIn("foo=persisted", output)
+            self.assertIn("failed=", output)
+
+    def test_025_snapshots(self):
+        """Testing snapshot save and load of interpreter state"""
+        snapshot = os.path.join(self.test_dir, "state.wssnap")
+        output, _, code = self.run_script(f'''
+set greeting "Hello"
+set limits [1, 2, 3]
+set view from file map {self.ws_path}
+function greet
+    print "$greeting from a restored function"
+end
+snapshot save {snapshot}
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("Warning: variable 'view' not saved in snapshot", output)
+        
+        output, _, code = self.run_script(f'''
+snapshot load {snapshot}
+call greet
+set total limits[0] + limits[2]
+print "total=$total"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("Hello from a restored function", output)
+        self.assertIn("total=4", output)
+        
+        with open(snapshot, 'wb') as f:
+            f.write(b"not a snapshot")
+        output, _, code = self.run_script(f'''
+set result from snapshot load {snapshot}
+print $result
+''')
+        self.assertIn("Snapshot load error: not a WS snapshot file", output)
+
+    def test_026_imports(self):
+        """Testing import of WS modules with namespaces, search paths and cycle detection"""
+        import shutil
+        library = tempfile.mkdtemp(prefix="ws_lib_")
+        self.addCleanup(shutil.rmtree, library, True)
+        with open(os.path.join(library, "helpers.ws"), 'w', encoding='utf-8') as f:
+            f.write('''
+print "Loading helpers"
+function shout
+    print "HELPER CALLED"
+end
+''')
+        with open(os.path.join(library, "greetings.ws"), 'w', encoding='utf-8') as f:
+            f.write('''
+import helpers
+function hello
+    print "Hello from greetings"
+    call banner
+end
+function banner
+    call helpers.shout
+end
+''')
+        with open(os.path.join(library, "cycle_a.ws"), 'w', encoding='utf-8') as f:
+            f.write("import cycle_b\n")
+        with open(os.path.join(library, "cycle_b.ws"), 'w', encoding='utf-8') as f:
+            f.write("import cycle_a.ws\n")
+            
+        output, _, code = self.run_script('''
+import greetings.ws as g
+import helpers
+call g.hello
+call hello
+import cycle_a
+''', "-I", library)
+        self.assertEqual(code, 0)
+        self.assertEqual(output.count("Loading helpers"), 1)
+        self.assertIn("Hello from greetings", output)
+        self.assertIn("HELPER CALLED", output)
+        self.assertIn("Function 'hello' not defined", output)
+        self.assertIn("Circular import: cycle_a.ws -> cycle_b.ws -> cycle_a.ws", output)
+        self.assertTrue(os.listdir(os.path.join(library, "__wscache__")))
+        
+        import ws
+        first, second = ws.WSInterpreter(), ws.WSInterpreter()
+        for interpreter in (first, second):
+            interpreter.search_paths = [library]
+            interpreter.import_module(["helpers"])
+        path = os.path.realpath(os.path.join(library, "helpers.ws"))
+        self.assertIs(first._load_module(path), second._load_module(path))
+        self.assertIn("helpers.shout", second.functions)
+        
+        import hashlib
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        ws.write_parse_cache(path, digest, bytes(16), [["print", "stale tree"]])
+        ws.MODULE_CACHE.clear()
+        self.assertNotIn(["print", "stale tree"], first._load_module(path))
+        ws.MODULE_CACHE.clear()
+        self.assertNotIn(["print", "stale tree"], first._load_module(path))
+
+    def test_027_concurrent_runs(self):
+        """Testing many threads running shared code on one interpreter, each in its own context"""
+        import threading
+        from ws import WSInterpreter
+        interpreter = WSInterpreter()
+        interpreter.execute(interpreter.parse('''
+function accumulate
+    if i % 2 == 0
+        set total total + seed
+    else
+        set total total + seed * 3
+    end
+end
+'''))
+        script = '''
+set total 0
+set i 0
+while i < 20
+    call accumulate
+    set i i + 1
+end
+set expected seed * 40
+'''
+        results, errors = [], []
+        
+        def worker(thread_id):
+            try:
+                for run in range(25):
+                    seed = thread_id * 100 + run
+                    context = interpreter.run(script, {'seed': seed})
+                    results.append((context.variables['total'], context.variables['expected']))
+            except Exception as e:
+                errors.append(e)
+                
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+            
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 16 * 25)
+        for total, expected in results:
+            self.assertEqual(total, expected)
+        self.assertEqual(interpreter.variables, {})
+        self.assertEqual(len(interpreter.compiled_scripts), 1)
+
+    def test_028_deep_recursion(self):
+        """Testing deep WS recursion on the explicit-stack executor and the call depth limit"""
+        script = '''
+function countdown
+    if n > 0
+        set n n - 1
+        while n % 1000 == 0 and n > marker
+            set marker n
+        end
+        call countdown
+    end
+end
+set marker -1
+set n 50000
+call countdown
+print "Countdown done: $n"
+function forever
+    call forever
+end
+call forever
+print "Still running"
+'''
+        output, _, code = self.run_script(script, "--max-call-depth", "60000")
+        self.assertEqual(code, 0)
+        self.assertIn("Countdown done: 0", output)
+        self.assertIn("Error: Maximum call depth of 60000 exceeded calling 'forever'", output)
+        self.assertEqual(output.count("Maximum call depth"), 1)
+        self.assertIn("Still running", output)
+        
+        output, _, code = self.run_script(script, "--max-call-depth", "100")
+        self.assertIn("Error: Maximum call depth of 100 exceeded calling 'countdown'", output)
+        self.assertIn("Countdown done: 49900", output)
+
+    def test_029_list_files(self):
+        """Testing lazy recursive file listing with filters, limits and parallel traversal"""
+        import shutil
+        tree = tempfile.mkdtemp(prefix="ws_tree_")
+        self.addCleanup(shutil.rmtree, tree, True)
+        for directory in ("src", "src/pkg", "src/pkg/deep", "docs", ".hidden"):
+            os.makedirs(os.path.join(tree, directory), exist_ok=True)
+        files = {"src/main.py": 10, "src/pkg/util.py": 5000, "src/pkg/deep/core.py": 20,
+                 "src/pkg/notes.txt": 30, "docs/guide.md": 40, ".hidden/secret.py": 1, "top.py": 1}
+        for name, size in files.items():
+            with open(os.path.join(tree, name), 'w') as f:
+                f.write("x" * size)
+        old = time.time() - 3 * 86400
+        os.utime(os.path.join(tree, "src/main.py"), (old, old))
+        root = tree.replace(os.sep, '/')
+        
+        output, _, code = self.run_script(f'''
+set n 0
+foreach f in list files {root}/**/*.py
+    set n n + 1
+end
+print "All python: $n"
+set n 0
+foreach f in list files {root}/src/**/* type=file ext=py|txt min_size=15 workers=4
+    set n n + 1
+end
+print "Filtered: $n"
+set n 0
+foreach f in list files {root}/src/** newer=1d type=file
+    set n n + 1
+end
+print "Recent: $n"
+set n 0
+foreach f in list files {root}/**/* limit=2
+    set n n + 1
+end
+print "Limited: $n"
+list files {root}/src/pkg/*.txt
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("All python: 4", output)
+        self.assertIn("Filtered: 3", output)
+        self.assertIn("Recent: 3", output)
+        self.assertIn("Limited: 2", output)
+        self.assertNotIn("util.py", output)
+        self.assertIn("notes.txt", output)
+        
+        from ws import FileScan
+        self.assertEqual(sorted(FileScan(root + "/src/*/*.py")), [root + "/src/pkg/util.py"])
+        self.assertEqual(sorted(FileScan(root + "/**/*.py", workers=4)), sorted(FileScan(root + "/**/*.py")))
+        self.assertEqual(len(list(FileScan(root + "/**/*.py", hidden=True))), 5)
+        
+        import ntpath
+        import ws
+        self.assertEqual(FileScan("/var/log/*.log").root, "/var/log")
+        self.assertEqual(FileScan("/*.log").root, "/")
+        self.assertEqual(FileScan("logs/**/*.log").root, "logs")
+        self.assertEqual(FileScan("*.log").root, "")
+        with patch.object(ws.os, 'path', ntpath), patch.object(ws.os, 'sep', '\\'):
+            self.assertEqual(FileScan("C:/*.txt").root, "C:/")
+            self.assertEqual(FileScan("C:\\Users\\*\\*.txt").root, "C:/Users")
+            self.assertEqual(FileScan("C:*.txt").root, "C:")
+            self.assertEqual(FileScan("//server/share/*.txt").root, "//server/share/")
+
+    def test_030_csv_and_jsonl(self):
+        """Testing streaming CSV and JSON Lines loops, field access and buffered writers"""
+        source = os.path.join(self.test_dir, "orders.csv")
+        with open(source, 'w', encoding='utf-8', newline='') as f:
+            f.write('id,customer,amount\n1,ann,10\n2,"bob, jr",250\n3,cy,99\n')
+        report = os.path.join(self.test_dir, "large.csv")
+        events = os.path.join(self.test_dir, "large.jsonl")
+        
+        output, _, code = self.run_script(f'''
+set total 0
+csv each row in {source}
+    set total total + int(row.amount)
+    if int(row.amount) > 50
+        csv write {report} row
+        jsonl write {events} id=int(row.id) customer=row.customer double=int(row.amount)*2
+    end
+end
+csv close
+jsonl close {events}
+print "Total: $total"
+jsonl each event in {events}
+    print "Event $event.id for $event.customer: $event.double"
+end
+csv each row in {source} header=no
+    print "Raw $row"
+end
+csv each row in missing.csv
+end
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("Total: 359", output)
+        self.assertIn("Event 2 for bob, jr: 500", output)
+        self.assertIn("Event 3 for cy: 198", output)
+        self.assertIn("Raw ['id', 'customer', 'amount']", output)
+        self.assertIn("Error in csv loop:", output)
+        with open(report, encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ['id,customer,amount', '2,"bob, jr",250', '3,cy,99'])
+        with open(events, encoding='utf-8') as f:
+            self.assertEqual(f.readline().strip(), '{"id": 2, "customer": "bob, jr", "double": 500}')
+
+    def test_031_string_builder(self):
+        """Testing string builder buffers with append, line and flush to file"""
+        report = os.path.join(self.test_dir, "report.txt")
+        output, _, code = self.run_script(f'''
+buffer append greeting Hello
+buffer append greeting ", $name"
+print "Greeting: $greeting!"
+set i 0
+while i < 50
+    set j 0
+    while j < 100
+        buffer line report row $i-$j
+        set j j + 1
+    end
+    set i i + 1
+end
+set size len(report)
+print "Report size: $size"
+buffer flush report to {report}
+set size len(report)
+print "After flush: $size"
+buffer line report tail
+buffer flush report to {report} append
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("Greeting: Hello, $name!", output)
+        self.assertIn("After flush: 0", output)
+        with open(report, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 5001)
+        self.assertEqual(lines[0], "row 0-0")
+        self.assertEqual(lines[4999], "row 49-99")
+        self.assertEqual(lines[-1], "tail")
+        self.assertIn(f"Report size: {sum(len(line) + 1 for line in lines[:5000])}", output)
+        
+        from ws import StringBuilder
+        builder = StringBuilder("a")
+        builder.append("b")
+        self.assertEqual(builder, "ab")
+        self.assertEqual(builder + "c", "abc")
+        self.assertEqual(builder.chunks, ["ab"])
+
+    def test_032_cached_functions(self):
+        """Testing memoized functions with parameters, LRU size, TTL, clearing and statistics"""
+        output, _, code = self.run_script('''
+set calls 0
+function cached double n maxsize=2 ttl=300ms
+    set calls calls + 1
+    set result n * 2
+end
+set a from call double 5
+set b from call double 5
+set c from call double 6
+print "Values: $a $b $c calls=$calls"
+set d from call double 7
+set e from call double 5
+print "After eviction: $e calls=$calls"
+wait 0.4
+set f from call double 7
+print "After expiry: $f calls=$calls"
+cache clear double
+set g from call double 7
+print "After clear: $g calls=$calls"
+list funcs
+function greet who
+    print "Hello $who"
+end
+call greet World
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("Values: 10 10 12 calls=2", output)
+        self.assertIn("After eviction: 10 calls=4", output)
+        self.assertIn("After expiry: 14 calls=5", output)
+        self.assertIn("After clear: 14 calls=6", output)
+        self.assertIn("double (cached: hits=1 misses=6 size=1/2 ttl=0.3s)", output)
+        self.assertIn("Hello World", output)
+
+    def test_033_pforeach(self):
+        """Testing parallel foreach in thread and process mode with isolated scopes and per-item errors"""
+        output, _, code = self.run_script('''
+function square n
+    set r n * n
+end
+set base 100
+pforeach x in [1, 2, 3, 4, 5, 6] workers=3 results=out
+    set y from call square x
+    if x == 4
+        call missing_function
+    end
+    set z y + base
+end
+print "Thread results: $out"
+pforeach x in [3, 1, 2] workers=2 mode=process results=squares
+    print "Child $x"
+    set y from call square x
+end
+print "Process results: $squares"
+print "Parent x: $x"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("pforeach item 3 (4) failed: Function 'missing_function' not defined", output)
+        self.assertIn("Thread results: [101, 104, 109, \"Error: Function 'missing_function' not defined\", 125, 136]", output)
+        self.assertIn("Child 3\nChild 1\nChild 2\n", output)
+        self.assertIn("Process results: [9, 1, 4]", output)
+        self.assertIn("Parent x: $x", output)
+
+    def test_034_watch_mode(self):
+        """Testing watch mode re-running on changes to the script and its imports with incremental parsing"""
+        import queue
+        import shutil
+        import threading
+        directory = tempfile.mkdtemp(prefix="ws_watch_")
+        self.addCleanup(shutil.rmtree, directory, True)
+        script = os.path.join(directory, "watched.ws")
+        module = os.path.join(directory, "watched_lib.ws")
+        with open(module, 'w', encoding='utf-8') as f:
+            f.write('function greet\n    print "lib v1"\nend\n')
+        with open(script, 'w', encoding='utf-8') as f:
+            f.write('import watched_lib\nfunction hello\n    print "hello v1"\nend\ncall hello\ncall watched_lib.greet\n')
+            
+        process = subprocess.Popen([sys.executable, self.ws_path, "--watch", script],
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        lines = queue.Queue()
+        threading.Thread(target=lambda: [lines.put(line) for line in process.stdout], daemon=True).start()
+        
+        def next_run():
+            output = []
+            while True:
+                line = lines.get(timeout=10)
+                output.append(line)
+                if line.startswith("[watch] Finished"):
+                    return ''.join(output)
+                    
+        first = next_run()
+        self.assertIn("hello v1", first)
+        self.assertIn("lib v1", first)
+        
+        time.sleep(0.05)
+        with open(script, 'w', encoding='utf-8') as f:
+            f.write('import watched_lib\nfunction hello\n    print "hello v2"\nend\ncall hello\ncall watched_lib.greet\n')
+        second = next_run()
+        self.assertIn("hello v2", second)
+        self.assertIn("lib v1", second)
+        self.assertIn("(1 segment(s) parsed, 3 reused)", second)
+        
+        time.sleep(0.05)
+        with open(module, 'w', encoding='utf-8') as f:
+            f.write('function greet\n    print "lib v2"\nend\n')
+        third = next_run()
+        self.assertIn("lib v2", third)
+        self.assertIn("(0 segment(s) parsed, 4 reused)", third)
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "process monitoring without psutil needs /proc")
+    def test_035_process_monitor(self):
+        """Testing background process sampling into a ring buffer with stats and CSV export"""
+        child = subprocess.Popen([sys.executable, "-c", "import time; x = bytearray(8 << 20); time.sleep(30)"])
+        self.addCleanup(child.wait)
+        self.addCleanup(child.kill)
+        time.sleep(0.3)
+        export = os.path.join(self.test_dir, "samples.csv")
+        output, _, code = self.run_script(f'''
+process monitor {child.pid} interval=50ms capacity=5
+wait 0.6
+set rss from process stats {child.pid} rss
+print "Samples: $rss.count"
+set big rss.min > 8000000
+print "Big: $big"
+process stats {child.pid}
+process export {child.pid} {export}
+process unmonitor
+set missing from process stats {child.pid}
+print "$missing"
+set missing from process monitor 999999999
+print "$missing"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("Samples: 5", output)
+        self.assertIn("Big: True", output)
+        self.assertIn(f"{child.pid} cpu: count=5", output)
+        self.assertIn("p99=", output)
+        self.assertIn(f"Error: {child.pid} is not being monitored", output)
+        self.assertIn("Error: No process with PID 999999999", output)
+        with open(export, encoding='utf-8') as f:
+            rows = f.read().splitlines()
+        self.assertEqual(rows[0], "time,cpu,rss,handles,read_bytes,write_bytes")
+        self.assertEqual(len(rows), 6)
+
+    def test_036_coordinator_and_workers(self):
+        """Testing distributed runs: a coordinator queueing jobs for several workers on localhost, with retries"""
+        with open(os.path.join(self.test_dir, "square.ws"), 'w', encoding='utf-8') as f:
+            f.write('print "Squaring $n"\nwait 0.2\nset result n * n\n')
+        with open(os.path.join(self.test_dir, "broken.ws"), 'w', encoding='utf-8') as f:
+            f.write('call undefined_function\n')
+        jobs = os.path.join(self.test_dir, "jobs.jsonl")
+        with open(jobs, 'w', encoding='utf-8') as f:
+            for n in range(1, 9):
+                f.write(json.dumps({"script": "square.ws", "params": {"n": n}}) + "\n")
+            f.write(json.dumps({"script": "broken.ws"}) + "\n")
+        results = os.path.join(self.test_dir, "results.jsonl")
+        
+        coordinator = subprocess.Popen([sys.executable, self.ws_path, "coordinator", "--jobs", jobs,
+                                        "--address", "127.0.0.1:0", "--retries", "1", "--results", results],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        self.addCleanup(coordinator.wait)
+        self.addCleanup(coordinator.kill)
+        for line in coordinator.stdout:
+            if line.startswith("[coordinator] Listening on"):
+                address = line.split()[3]
+                break
+        workers = [subprocess.Popen([sys.executable, self.ws_path, "worker", "--address", address,
+                                     "--concurrency", str(concurrency)],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                   for concurrency in (1, 1, 2)]
+        output = coordinator.communicate(timeout=30)[0]
+        worker_output = ''.join(worker.communicate(timeout=10)[0] for worker in workers)
+        
+        self.assertEqual(coordinator.returncode, 1)
+        self.assertIn("Squaring 5", output)
+        self.assertIn("failed on", output)
+        self.assertIn("9 job(s) finished", output)
+        self.assertIn("8 ok, 1 failed", output)
+        self.assertEqual(worker_output.count("[worker]"), 3)
+        with open(results, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record['result'] for record in records[:8]], [n * n for n in range(1, 9)])
+        self.assertTrue(all(record['ok'] for record in records[:8]))
+        self.assertEqual(records[8]['attempts'], 2)
+        self.assertFalse(records[8]['ok'])
+        self.assertIn("undefined_function", records[8]['errors'][0])
+        self.assertGreater(len({record['worker'] for record in records}), 1)
+
+    def test_037_run_cached(self):
+        """Testing run cached: memoized command output with TTL, input file stamps and an on-disk store"""
+        import shutil
+        counter = os.path.join(self.test_dir, "counter.py")
+        with open(counter, 'w', encoding='utf-8') as f:
+            f.write("import os\npath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'count.txt')\n"
+                    "count = int(open(path).read()) + 1 if os.path.exists(path) else 1\n"
+                    "open(path, 'w').write(str(count))\nprint(count, end='')\n")
+        data = os.path.join(self.test_dir, "input.txt")
+        with open(data, 'w', encoding='utf-8') as f:
+            f.write("v1")
+        store = os.path.join(self.test_dir, "run_cache")
+        self.addCleanup(shutil.rmtree, store, True)
+        script = f'''
+set a from run cached argv {sys.executable} {counter}
+set b from run argv cached {sys.executable} {counter}
+print "First: $a $b"
+set c from run cached ttl=50ms argv {sys.executable} {counter}
+wait 0.1
+set d from run cached ttl=50ms argv {sys.executable} {counter}
+print "Expired: $c $d"
+set e from run cached inputs={data} argv {sys.executable} {counter}
+exec open(r"{data}", "w").write("version 2")
+set f from run cached inputs={data} argv {sys.executable} {counter}
+print "Inputs: $e $f"
+cache stats run
+'''
+        output, _, code = self.run_script(script, "--debug", "--run-cache", store)
+        self.assertEqual(code, 0)
+        self.assertIn("First: 1 1", output)
+        self.assertIn("Expired: 1 2", output)
+        self.assertIn("Inputs: 3 4", output)
+        self.assertIn("[run cache] hit:", output)
+        self.assertIn("run: hits=2 misses=4", output)
+        
+        output, _, code = self.run_script(f'''
+set a from run cached argv {sys.executable} {counter}
+print "Stored: $a"
+cache clear run
+set b from run cached argv {sys.executable} {counter}
+print "Cleared: $b"
+''', "--run-cache", store)
+        self.assertIn("Stored: 2", output)
+        self.assertIn("Cleared: 5", output)
+
+    def test_038_checkpoint_resume(self):
+        """Testing checkpoints and --resume after a crash, including inside a function, and rejection of changed scripts"""
+        log = os.path.join(self.test_dir, "steps.log")
+        crash = os.path.join(self.test_dir, "crash.flag")
+        script_path = os.path.join(self.test_dir, "test_script.ws")
+        checkpoint = script_path + ".ckpt"
+        open(crash, 'w').close()
+        self.addCleanup(lambda: os.path.exists(checkpoint) and os.remove(checkpoint))
+        script = f'''
+function step
+    file append {log} "step $i\\n"
+    checkpoint in step $i
+    if i == 3
+        exec os._exit(3) if os.path.exists(r"{crash}") else None
+    end
+    file append {log} "after $i\\n"
+end
+set i 1
+while i <= 5
+    call step
+    checkpoint loop $i
+    set i i + 1
+end
+print "Done at $i"
+'''
+        _, _, code = self.run_script(script)
+        self.assertEqual(code, 3)
+        self.assertTrue(os.path.exists(checkpoint))
+        os.remove(crash)
+        
+        output, _, _ = self.run_script(script.replace("set i 1", "set i 2"), "--resume", checkpoint)
+        self.assertIn("the script changed before checkpoint 'in step 3'; cannot resume", output)
+        
+        output, _, code = self.run_script(script.replace("Done at", "Finished at"), "--resume", checkpoint)
+        self.assertEqual(code, 0)
+        self.assertIn("Resuming from checkpoint 'in step 3'", output)
+        self.assertIn("Finished at 6", output)
+        with open(log, encoding='utf-8') as f:
+            self.assertEqual(f.read().split("\n")[:-1],
+                             [f"{kind} {i}" for i in range(1, 6) for kind in ("step", "after")])
+        self.assertFalse(os.path.exists(checkpoint))
+        
+        backup = os.path.join(self.test_dir, "backup.ckpt")
+        self.run_script(script.replace("set i 1", "set i 5"))
+        self.assertFalse(os.path.exists(checkpoint))
+        with open(checkpoint, 'wb') as f:
+            f.write(b"not written by this run")
+        _, _, code = self.run_script('print "no checkpoints here"')
+        self.assertEqual(code, 0)
+        self.assertTrue(os.path.exists(checkpoint))
+        os.remove(checkpoint)
+        open(crash, 'w').close()
+        self.run_script(script)
+        os.replace(checkpoint, backup)
+        os.remove(crash)
+        output, _, code = self.run_script(script, "--resume", backup)
+        self.assertEqual(code, 0)
+        self.assertIn("Done at 6", output)
+        self.assertTrue(os.path.exists(backup))
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_039_type_strategies(self):
+        """Testing type entering long text through the clipboard and short text as chunked key events"""
+        from ws import TextTyper, WSInterpreter
+        
+        class FakeKeyboard:
+            def __init__(self):
+                self.events = []
+            def write(self, text):
+                self.events.append(('write', text))
+            def hotkey(self, *keys):
+                self.events.append(('hotkey', keys, clipboard.text))
+                
+        class FakeClipboard:
+            available = True
+            def __init__(self):
+                self.text = "previous contents"
+            def get(self):
+                return self.text
+            def set(self, text):
+                self.text = text
+                
+        keyboard, clipboard = FakeKeyboard(), FakeClipboard()
+        typer = TextTyper(keyboard, clipboard, paste_threshold=100, chunk_size=10, paste_delay=0)
+        self.assertEqual(typer.type("short text here"), "keys")
+        self.assertEqual(keyboard.events, [('write', "short text"), ('write', " here")])
+        
+        keyboard.events.clear()
+        template = "line of a large template\n" * 40
+        self.assertEqual(typer.type(template), "paste")
+        self.assertEqual(len(keyboard.events), 1)
+        self.assertEqual(keyboard.events[0][2], template)
+        self.assertEqual(clipboard.text, "previous contents")
+        
+        keyboard.events.clear()
+        typer.strategy = "keys"
+        self.assertEqual(typer.type(template), "keys")
+        self.assertEqual(''.join(event[1] for event in keyboard.events), template)
+        
+        keyboard.events.clear()
+        clipboard.available = False
+        typer.strategy = "auto"
+        self.assertEqual(typer.type(template), "keys")
+        typer.strategy = "paste"
+        self.assertEqual(typer.type(template), "paste")
+        with self.assertRaises(ValueError):
+            TextTyper(keyboard, clipboard, strategy="telepathy")
+            
+        class RestoreFailingClipboard(FakeClipboard):
+            def set(self, text):
+                if text == "previous contents":
+                    raise OSError("clipboard locked")
+                self.text = text
+                
+        keyboard.events.clear()
+        clipboard = RestoreFailingClipboard()
+        typer = TextTyper(keyboard, clipboard, paste_threshold=100, paste_delay=0)
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(typer.type(template), "paste")
+        self.assertEqual(keyboard.events, [('hotkey', typer.paste_keys, template)])
+        self.assertIn("could not restore the clipboard: clipboard locked", stdout.getvalue())
+        
+        keyboard.events.clear()
+        clipboard = FakeClipboard()
+        clipboard.text = None
+        typer = TextTyper(keyboard, clipboard, paste_threshold=100, paste_delay=0)
+        self.assertEqual(typer.type(template), "paste")
+        self.assertEqual(keyboard.events, [('hotkey', typer.paste_keys, template)])
+        self.assertEqual(clipboard.text, "")
+        
+        class UnreadableClipboard(FakeClipboard):
+            def get(self):
+                raise OSError("clipboard busy")
+                
+        keyboard.events.clear()
+        clipboard = UnreadableClipboard()
+        typer = TextTyper(keyboard, clipboard, paste_threshold=100, chunk_size=1000, paste_delay=0)
+        self.assertEqual(typer.type(template), "keys")
+        self.assertEqual(keyboard.events, [('write', template)])
+        self.assertEqual(clipboard.text, "previous contents")
+        typer.strategy = "paste"
+        self.assertRaises(OSError, typer.type, template)
+        clipboard = FakeClipboard()
+            
+        interpreter = WSInterpreter()
+        interpreter.typer = TextTyper(keyboard, clipboard, paste_threshold=8, paste_delay=0)
+        keyboard.events.clear()
+        clipboard.available = True
+        interpreter.variables['name'] = "World"
+        interpreter.execute(interpreter.parse('type "Hello, $name!"'))
+        self.assertEqual(keyboard.events[0][:2], ('hotkey', interpreter.typer.paste_keys))
+        self.assertEqual(keyboard.events[0][2], "Hello, World!")
+        
+        _, stderr, code = self.run_script('print "never"', "--type-strategy", "telepathy")
+        self.assertNotEqual(code, 0)
+        self.assertIn("invalid choice", stderr)
+
+    def test_040_screen_find(self):
+        """Testing template search in PNG images with screen find and wait until screen shows"""
+        import random
+        import struct
+        import zlib
+        
+        def write_png(path, rows, channels=1, sub_filter=False):
+            lines = []
+            for row in rows:
+                data = bytes(value for pixel in row for value in (pixel if channels > 1 else (pixel,)))
+                if sub_filter:
+                    data = bytes([data[i] if i < channels else (data[i] - data[i - channels]) & 0xFF
+                                  for i in range(len(data))])
+                lines.append((b"\x01" if sub_filter else b"\x00") + data)
+            chunk = lambda kind, data: (struct.pack(">I", len(data)) + kind + data
+                                        + struct.pack(">I", zlib.crc32(kind + data)))
+            header = struct.pack(">IIBBBBB", len(rows[0]), len(rows), 8, 2 if channels == 3 else 0, 0, 0, 0)
+            with open(path, 'wb') as f:
+                f.write(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"".join(lines)))
+                        + chunk(b"IEND", b""))
+                        
+        random.seed(7)
+        screen = [[(x * 3 + y * 5) % 200 + 20 for x in range(160)] for y in range(100)]
+        button = [[random.randrange(256) for _ in range(24)] for _ in range(16)]
+        for y, row in enumerate(button):
+            screen[60 + y][110:134] = row
+        noisy = [[min(255, max(0, value + random.randint(-20, 20))) for value in row] for row in button]
+        paths = {name: os.path.join(self.test_dir, f"{name}.png") for name in ("screen", "button", "noisy", "color")}
+        write_png(paths["screen"], [[(v, v, v) for v in row] for row in screen], channels=3, sub_filter=True)
+        write_png(paths["button"], button)
+        write_png(paths["noisy"], noisy, sub_filter=True)
+        write_png(paths["color"], [[(v, v, v) for v in row] for row in button], channels=3)
+        
+        output, _, code = self.run_script(f'''
+set pos from screen find {paths["button"]} source={paths["screen"]}
+print "Found $pos.left $pos.top $pos.width $pos.height centre $pos.x $pos.y"
+set pos from screen find {paths["color"]} 100 50 60 50 source={paths["screen"]}
+print "In region $pos.left $pos.top"
+set pos from screen find {paths["noisy"]} 0.8 source={paths["screen"]}
+set close pos.confidence > 0.8 and pos.confidence < 1
+print "Noisy $pos.left $pos.top $close"
+set missing from screen find {paths["noisy"]} 0.99 source={paths["screen"]}
+print "Strict $missing"
+set missing from screen find {paths["button"]} 0 0 100 100 source={paths["screen"]}
+print "Outside $missing"
+set shown from wait until screen shows {paths["button"]} source={paths["screen"]} timeout 2
+print "Shown $shown.x"
+set timed_out from wait until screen shows {paths["button"]} 0 0 80 80 source={paths["screen"]} timeout 0.2
+print "Timed out $timed_out"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("Found 110 60 24 16 centre 122 68", output)
+        self.assertIn("In region 110 60", output)
+        self.assertIn("Noisy 110 60 True", output)
+        self.assertIn("Strict None", output)
+        self.assertIn("Outside None", output)
+        self.assertIn("Shown 122", output)
+        self.assertIn("Timed out False", output)
+
+    def test_041_vectors(self):
+        """Testing vectors: element-wise arithmetic, aggregates, CSV and file size sources, snapshots"""
+        data = os.path.join(self.test_dir, "latency.csv")
+        with open(data, 'w', encoding='utf-8') as f:
+            f.write("host,ms\n" + "".join(f"h{i},{i}\n" for i in range(1, 101)) + "h0,\n")
+        snapshot = os.path.join(self.test_dir, "vectors.snap")
+        output, _, code = self.run_script(f'''
+vector new a
+vector append a 1
+vector append a 2
+vector append a 3
+vector append a 4
+set b vector([10,20,30,40])
+set c a*2+b
+print "Combined $c"
+set rows exec [{{'v':5}},{{'v':1}},{{'v':3}}]
+vector from r rows field=v
+vector sort r desc
+print "Sorted $r"
+vector from ms csv {data} ms
+set n from vector count ms
+set total from vector sum ms
+set middle from vector mean ms
+set p from vector percentile ms 50 95
+print "CSV $n $total $middle $p"
+vector stats ms
+set h from vector histogram ms 4
+set bad from vector from bad csv {data} nope
+print "$bad"
+vector new none
+set empty from vector mean none
+print "$empty"
+snapshot save {snapshot}
+set c 0
+snapshot load {snapshot}
+set top from vector max c
+print "Restored $top"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("Combined [12, 24, 36, 48]", output)
+        self.assertIn("Sorted [5, 3, 1]", output)
+        self.assertIn("CSV 100 5050.0 50.5 [50.0, 95.0]", output)
+        self.assertIn("ms: count=100 sum=5050 min=1 max=100 avg=50.5 p50=50 p90=90 p95=95 p99=99", output)
+        self.assertIn("1 - 25.75        25", output)
+        self.assertIn("75.25 - 100          25", output)
+        self.assertIn("Error: Column not found: nope", output)
+        self.assertIn("Error: mean of an empty vector", output)
+        self.assertIn("Restored 48.0", output)
+        
+    def test_042_file_search(self):
+        """Testing file search: parallel regex search with line and column positions"""
+        import shutil
+        tree = tempfile.mkdtemp(prefix="ws_search_")
+        self.addCleanup(shutil.rmtree, tree, True)
+        os.makedirs(os.path.join(tree, "conf", "nested"))
+        files = {
+            "conf/app.ini": "name = app\ntimeout = 30  # TODO tune\n  caf\u00e9 TODO again\n",
+            "conf/nested/db.ini": "host = db\r\nTODO: password\r\n",
+            "conf/clean.ini": "nothing here\n",
+            "conf/data.bin": "TODO\0binary",
+        }
+        for name, content in files.items():
+            with open(os.path.join(tree, name), 'w', encoding='utf-8', newline='') as f:
+                f.write(content)
+        root = tree.replace(os.sep, '/')
+        output, _, code = self.run_script(f'''
+file search "TODO \\w+" in {root}/conf/*.ini
+set all from file search TODO in {root}/conf/* recursive workers=2
+set total len(all)
+set firsts from file search todo in {root}/conf/*.ini recursive first ignorecase=yes
+set per_file len(firsts)
+print "Totals $total $per_file"
+foreach m in $firsts
+    print "First $m.line $m.column $m.text"
+end
+set bad from file search "(" in {root}/conf/*.ini
+print "$bad"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn(f"{root}/conf/app.ini:2:17: timeout = 30  # TODO tune", output)
+        self.assertIn(f"{root}/conf/app.ini:3:8:   caf\u00e9 TODO again", output)
+        self.assertNotIn("db.ini", output.split("Totals")[0])
+        self.assertIn("Totals 3 2", output)
+        self.assertIn("First 2 17 timeout = 30  # TODO tune", output)
+        self.assertIn("First 2 1 TODO: password", output)
+        self.assertIn("Error: Invalid search pattern", output)
+        
+        import ws
+        interpreter, consumed = ws.WSInterpreter(), []
+        
+        def scan_files(args):
+            for index in range(1000):
+                consumed.append(index)
+                yield os.path.join(tree, "conf", "app.ini")
+                
+        with patch.object(interpreter, 'scan_files', scan_files):
+            matches = interpreter.search_files(["TODO", "in", "*.ini", "workers=2"])
+            self.assertEqual(next(matches)['line'], 2)
+            self.assertLessEqual(len(consumed), 8)
+            matches.close()
+        
+    def test_043_set_text_starting_with_command(self):
+        """Testing that set stores text starting with a command name and runs commands only after from"""
+        marker = os.path.join(self.test_dir, "keep.txt")
+        with open(marker, 'w') as f:
+            f.write("keep")
+        output, _, code = self.run_script(f'''
+set note run echo SIDE_EFFECT_RAN
+set greeting call me maybe
+set pause wait 5
+set action type hello
+print "Note: $note | $greeting | $pause | $action"
+set echoed from run echo FROM_RAN
+print "Echoed: $echoed"
+set cleanup from file delete {marker}
+set size from file exists {marker}
+print "Exists: $size"
+''', timeout=30)
+        self.assertEqual(code, 0)
+        self.assertIn("Note: run echo SIDE_EFFECT_RAN | call me maybe | wait 5 | type hello", output)
+        self.assertNotIn("SIDE_EFFECT_RAN\n", output)
+        self.assertNotIn("not defined", output)
+        self.assertIn("Echoed: FROM_RAN", output)
+        self.assertIn("Error: 'file delete' does not return a value", output)
+        self.assertIn("Exists: True", output)
+        self.assertTrue(os.path.exists(marker))
+        
+    def test_044_function_parameter_scope(self):
+        """Testing that parameters shadow caller variables only during the call and missing arguments are reported"""
+        output, _, code = self.run_script('''
+set x 10
+function show x
+    print "inside x=$x"
+end
+call show 5
+print "after x=$x"
+function depth n
+    if n > 0
+        call depth n-1
+        print "unwound n=$n"
+    end
+end
+call depth 2
+print "outside n=$n"
+call show
+print "still x=$x"
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("inside x=5", output)
+        self.assertIn("after x=10", output)
+        self.assertIn("unwound n=1\nunwound n=2", output)
+        self.assertIn("outside n=$n", output)
+        self.assertIn("Error: Function 'show' missing argument(s): x", output)
+        self.assertIn("still x=10", output)
+        
+    def test_045_optimizer_state_commands(self):
+        """Testing that -O does not propagate constants across import and snapshot load"""
+        library = os.path.join(self.test_dir, "overrides.ws")
+        with open(library, 'w', encoding='utf-8') as f:
+            f.write("set x 2\n")
+        snapshot = os.path.join(self.test_dir, "optimizer.snap")
+        self.run_script(f"set y 3\nsnapshot save {snapshot}\n")
+        script = f'''
+set x 1
+import overrides
+print "x=$x"
+set y 1
+snapshot load {snapshot}
+print "y=$y"
+'''
+        for options in ((), ("-O",)):
+            output, _, code = self.run_script(script, *options)
+            self.assertEqual(code, 0)
+            self.assertIn("x=2", output, options)
+            self.assertIn("y=3", output, options)
+        
+    def test_046_shell_session_recovery(self):
+        """Testing that the shell session survives unbalanced quotes, keeps blank lines and restarts after an opt-in timeout"""
+        from ws import ShellSession, WSInterpreter
+        self.assertIsNone(WSInterpreter().session_timeout)
+        session = ShellSession()
+        self.addCleanup(session.close)
+        self.assertEqual(session.run(f'{sys.executable} -c "import time; time.sleep(0.5); print(1)"', timeout=None)[0], 0)
+        self.assertRaises(TimeoutError, session.run, f'{sys.executable} -c "import time; time.sleep(5)"', timeout=0.2)
+        
+        output, _, code = self.run_script(f'''
+shell open
+set quote from run session echo it's
+print "quote=$quote"
+set after from run session echo still alive
+print "after=$after"
+set blank from run session {sys.executable} -c "print('x'); print()"
+set size len(blank)
+print "size=$size"
+set quiet from run session timeout=300ms {sys.executable} -c "import time; time.sleep(5)"
+print "quiet=$quiet"
+set patient from run session {sys.executable} -c "import time; time.sleep(0.5); print('done')"
+print "patient=$patient"
+shell timeout 300ms
+set slow from run session {sys.executable} -c "import time; time.sleep(5)"
+print "slow=$slow"
+set back from run session echo recovered
+print "back=$back"
+shell close
+''', timeout=60)
+        self.assertEqual(code, 0)
+        self.assertIn("after=still alive", output)
+        self.assertIn("size=3", output)
+        self.assertIn("quiet=Error: Command timed out (no output for 0.3s)", output)
+        self.assertIn("patient=done", output)
+        self.assertIn("slow=Error: Command timed out", output)
+        self.assertIn("back=recovered", output)
+        if os.name != 'nt':
+            self.assertIn("quote=Command error (exit code 2)", output)
+        
+    def test_047_expression_commas(self):
+        """Testing that commas inside brackets group only in statements that take expressions"""
+        output, _, code = self.run_script('''
+set items [1,2,3]
+print "items=$items"
+set count len(items)
+print "count=$count"
+print f(a, b) [c,d]
+''')
+        self.assertEqual(code, 0)
+        self.assertIn("items=[1, 2, 3]", output)
+        self.assertIn("count=3", output)
+        self.assertIn("f(a b) [c d]", output)
+        
+    def test_048_repl_closes_writers(self):
+        """Testing that records written in the REPL are flushed when it exits"""
+        target = os.path.join(self.test_dir, "repl_out.csv")
+        result = subprocess.run(
+            [sys.executable, self.ws_path],
+            input=f"csv write {target} a 1\nexit\n",
+            cwd=self.test_dir,
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+        self.assertEqual(result.returncode, 0)
+        with open(target, encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ["a,1"])
+        
+    def test_049_worker_job_isolation(self):
+        """Testing that jobs run by one worker do not see each other's functions or run mode"""
+        scripts = {
+            "first.ws": 'function greet\n    set greeting "first"\nend\nshell mode argv\nset result from call greet\n',
+            "uses.ws": 'set result from call greet\n',
+            "mode.ws": 'shell mode\n',
+            "second.ws": 'function greet\n    set greeting "second"\nend\nset result from call greet\n',
+        }
+        for name, source in scripts.items():
+            with open(os.path.join(self.test_dir, name), 'w', encoding='utf-8') as f:
+                f.write(source)
+        jobs = os.path.join(self.test_dir, "isolated_jobs.jsonl")
+        with open(jobs, 'w', encoding='utf-8') as f:
+            for name in scripts:
+                f.write(json.dumps({"script": name}) + "\n")
+        results = os.path.join(self.test_dir, "isolated_results.jsonl")
+        
+        coordinator = subprocess.Popen([sys.executable, self.ws_path, "coordinator", "--jobs", jobs,
+                                        "--address", "127.0.0.1:0", "--results", results],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        self.addCleanup(coordinator.wait)
+        self.addCleanup(coordinator.kill)
+        for line in coordinator.stdout:
+            if line.startswith("[coordinator] Listening on"):
+                address = line.split()[3]
+                break
+        worker = subprocess.Popen([sys.executable, self.ws_path, "worker", "--address", address],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        coordinator.communicate(timeout=30)
+        worker.communicate(timeout=10)
+        
+        with open(results, encoding='utf-8') as f:
+            records = {record['script']: record for record in map(json.loads, f)}
+        self.assertEqual(records["first.ws"]['result'], "first")
+        self.assertFalse(records["uses.ws"]['ok'])
+        self.assertIn("greet", records["uses.ws"]['errors'][0])
+        self.assertEqual(records["mode.ws"]['result'], "shell")
+        self.assertEqual(records["second.ws"]['result'], "second")
+        
+
 def parse_arguments():
     """Parse command line arguments for test runner"""
     parser = argparse.ArgumentParser(
@@ -4,9 +4,35 @@ import sys
 import re
 import subprocess
 import time
-import glob
+import uuid
+import io
 import argparse
-from typing import Dict, List, Any, Union, Optional, Tuple, Set
+import array
+import ast
+import contextlib
+import ctypes
+import ctypes.util
+import csv
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import operator
+import pickle
+import queue
+import select
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait as wait_futures
+from typing import Dict, List, Any, Union, Optional, Tuple, Set, Callable, Iterator
 
 VERSION = "1.0.0"
 
@@ -17,6 +43,7 @@ except ImportError:
     class PyAutoGuiFallback:
         def click(self, *args, **kwargs): print("Error: pyautogui not installed")
         def write(self, *args, **kwargs): print("Error: pyautogui not installed")
+        def hotkey(self, *args, **kwargs): print("Error: pyautogui not installed")
         def getWindowsWithTitle(self, *args): return []
     pyautogui = PyAutoGuiFallback()
 
@@ -26,6 +53,16 @@ except ImportError:
     print("Warning: psutil module not found. Process commands will have limited functionality.")
     psutil = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
 try:
     import winreg
 except ImportError:
@@ -35,46 +72,2338 @@ except ImportError:
         print("Warning: winreg module not found. Registry commands will not work.")
         winreg = None
 
+INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x80 | 0x100 | 0x200  # MODIFY, ATTRIB, CLOSE_WRITE, MOVED_TO, CREATE, DELETE
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True) if sys.platform.startswith('linux') else None
+    if libc is not None and not hasattr(libc, 'inotify_init1'):
+        libc = None
+except OSError:
+    libc = None
+
+# A token is a run of non-separator characters and quoted strings. In statements
+# that take expressions, parenthesised and bracketed groups (up to two levels deep)
+# stay in one token so that calls and literals such as find(data, b"MZ") or
+# [1, 2, 3] keep their commas; other statements split on every comma.
+_QUOTED = r'"(?:\\.|[^"])*"'
+_FLAT_GROUP = rf'\((?:[^()\[\]"]|{_QUOTED})*\)|\[(?:[^()\[\]"]|{_QUOTED})*\]'
+_GROUP = (rf'\((?:[^()\[\]"]|{_QUOTED}|{_FLAT_GROUP})*\)'
+          rf'|\[(?:[^()\[\]"]|{_QUOTED}|{_FLAT_GROUP})*\]')
+TOKEN_PATTERN = re.compile(rf'(?:[^\s,"]|{_QUOTED})++')
+EXPRESSION_TOKEN_PATTERN = re.compile(rf'(?:[^\s,"(\[]|{_QUOTED}|{_GROUP}|[(\[])++')
+EXPRESSION_STATEMENTS = frozenset({'set', 'exec', 'if', 'while', 'foreach', 'pforeach', 'wait'})
+
+BYTES_LIKE = (bytes, bytearray, memoryview)
+
+FIELD_REFERENCE = re.compile(r'\$(\w+)\.(\w+)')
+VARIABLE_REFERENCE = re.compile(r'\$(\w+)')
+
+# Commands whose result `set <var> from <command> ...` stores, mapped to the
+# subcommands that return a value (None accepts any). Without `from`, set stores
+# text, so `set note run echo hi` stores "run echo hi".
+VALUE_COMMANDS = {
+    'run': None,
+    'call': None,
+    'get': None,
+    'list': None,
+    'vector': None,
+    'file': {'read', 'readbytes', 'map', 'hash', 'exists', 'search'},
+    'process': {'list', 'monitor', 'stats'},
+    'screen': {'find'},
+    'wait': {'until'},
+    'snapshot': {'save', 'load'},
+    'registry': {'read'},
+    'cache': {'stats'},
+}
+
+MAX_LOOP_ITERATIONS = 1000
+DEFAULT_MAX_CALL_DEPTH = 10000
+
+def buffer_find(haystack: Any, needle: Any, start: int = 0) -> int:
+    """Find needle in a string or bytes-like value without copying it; return -1 if absent."""
+    if isinstance(haystack, memoryview):
+        if isinstance(needle, str):
+            needle = needle.encode('utf-8')
+        match = re.compile(re.escape(bytes(needle))).search(haystack, start)
+        return match.start() if match else -1
+    if isinstance(haystack, (bytes, bytearray)) and isinstance(needle, str):
+        needle = needle.encode('utf-8')
+    return haystack.find(needle, start)
+
+def buffer_hash(data: Any, algorithm: str = 'sha256') -> Union[str, int]:
+    """Hash a string or bytes-like value; crc32 returns an integer, other algorithms a hex digest."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if algorithm == 'crc32':
+        return zlib.crc32(data)
+    return hashlib.new(algorithm, data).hexdigest()
+
+def buffer_hex(value: Any) -> str:
+    """Return the hex form of a bytes-like value, or of an integer like the builtin hex."""
+    if isinstance(value, BYTES_LIKE):
+        return value.hex()
+    return hex(value)
+
+def hash_file(path: str, algorithm: str = 'sha256', chunk_size: int = 1 << 20) -> Union[str, int]:
+    """Hash a file in fixed-size chunks without loading it into memory."""
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    crc = 0
+    digest = None if algorithm == 'crc32' else hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            if digest is None:
+                crc = zlib.crc32(view[:size], crc)
+            else:
+                digest.update(view[:size])
+    return crc if digest is None else digest.hexdigest()
+
+SEARCH_MMAP_THRESHOLD = 1 << 20
+BINARY_SNIFF_SIZE = 8192
+
+def search_file(path: str, regex: 're.Pattern[bytes]', first: bool = False) -> List[Dict[str, Any]]:
+    """Return the matches of a bytes pattern in a file as path, line, column and text maps.
+
+    Small files are read in one call and larger ones are memory-mapped, so the
+    content is never decoded as a whole; only the lines that match are. Files
+    with a NUL byte near the start are treated as binary and skipped.
+    """
+    matches = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return matches
+        data = f.read() if size <= SEARCH_MMAP_THRESHOLD else mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if b'\0' in data[:BINARY_SNIFF_SIZE]:
+            return matches
+        line, position = 1, 0
+        for match in regex.finditer(data):
+            start = match.start()
+            line += data[position:start].count(b'\n')
+            position = start
+            line_start = data.rfind(b'\n', 0, start) + 1
+            line_end = data.find(b'\n', start)
+            line_end = len(data) if line_end < 0 else line_end
+            matches.append({
+                'path': path,
+                'line': line,
+                'column': len(data[line_start:start].decode('utf-8', 'replace')) + 1,
+                'text': data[line_start:line_end].decode('utf-8', 'replace').rstrip('\r'),
+            })
+            if first:
+                break
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    return matches
+
+def poll_until(predicate: Callable[[], Any], timeout: Optional[float] = None,
+               initial_delay: float = 0.001, max_delay: float = 0.25) -> bool:
+    """Poll predicate with exponential backoff until it is true or the timeout expires."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = initial_delay
+    while True:
+        if predicate():
+            return True
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+        else:
+            time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def wait_for_path(path: str, predicate: Callable[[], Any], timeout: Optional[float] = None) -> bool:
+    """Wait until predicate is true, waking on inotify events for the path's directory when available."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd = -1
+    if libc is not None and os.path.isdir(directory):
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(directory), INOTIFY_MASK) < 0:
+            os.close(fd)
+            fd = -1
+    if fd < 0:
+        return poll_until(predicate, timeout)
+        
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while True:
+            if predicate():
+                return True
+            if deadline is None:
+                remaining = 1.0
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+            select.select([fd], [], [], min(remaining, 1.0))
+            try:
+                while os.read(fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+    finally:
+        os.close(fd)
+
+def wait_for_process_exit(pid: int, timeout: Optional[float] = None) -> bool:
+    """Wait until a process exits, blocking on the OS where possible instead of polling."""
+    if psutil:
+        try:
+            psutil.Process(pid).wait(timeout)
+        except psutil.NoSuchProcess:
+            pass
+        except psutil.TimeoutExpired:
+            return False
+        return True
+        
+    if os.name == 'nt':
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x00100000, False, pid)  # SYNCHRONIZE
+        if not handle:
+            return True
+        try:
+            milliseconds = 0xFFFFFFFF if timeout is None else int(timeout * 1000)
+            return kernel32.WaitForSingleObject(handle, milliseconds) == 0
+        finally:
+            kernel32.CloseHandle(handle)
+            
+    def exited():
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                return True
+        except ChildProcessError:
+            pass
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+        
+    return poll_until(exited, timeout)
+
+PROCESS_METRICS = ('cpu', 'rss', 'handles', 'read_bytes', 'write_bytes')
+PERCENTILES = (50, 90, 95, 99)
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def sample_process(pid: int, handle: Any = None) -> Tuple[float, int, int, int, int]:
+    """Return cumulative CPU seconds, RSS bytes, open handles and I/O byte counters of a process.
+    
+    Uses psutil when it is installed, reading all counters inside one oneshot()
+    call, and the /proc file system otherwise.
+    """
+    if psutil is not None:
+        process = handle or psutil.Process(pid)
+        with process.oneshot():
+            cpu = process.cpu_times()
+            rss = process.memory_info().rss
+            handles = process.num_handles() if os.name == 'nt' else process.num_fds()
+            try:
+                io_counters = process.io_counters()
+                read_bytes, write_bytes = io_counters.read_bytes, io_counters.write_bytes
+            except (psutil.AccessDenied, AttributeError):
+                read_bytes = write_bytes = 0
+        return cpu.user + cpu.system, rss, handles, read_bytes, write_bytes
+        
+    fields = read_proc_file(f"/proc/{pid}/stat").rsplit(b')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = int(fields[21]) * PAGE_SIZE
+    try:
+        handles = len(os.listdir(f"/proc/{pid}/fd"))
+    except PermissionError:
+        handles = 0
+    try:
+        tokens = read_proc_file(f"/proc/{pid}/io").split()
+        counters = dict(zip(tokens[::2], tokens[1::2]))
+        read_bytes, write_bytes = int(counters[b'read_bytes:']), int(counters[b'write_bytes:'])
+    except (OSError, KeyError):
+        read_bytes = write_bytes = 0
+    return cpu, rss, handles, read_bytes, write_bytes
+
+def read_proc_file(path: str) -> bytes:
+    """Read a small /proc file with a single unbuffered read."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 4096)
+    finally:
+        os.close(fd)
+
+def find_processes(target: str) -> List[int]:
+    """Return the PID named by target, or the PIDs of all processes with that name."""
+    if target.isdigit():
+        exists = psutil.pid_exists(int(target)) if psutil is not None else os.path.exists(f"/proc/{target}")
+        return [int(target)] if exists else []
+    if psutil is not None:
+        return [proc.info['pid'] for proc in psutil.process_iter(['pid', 'name']) if proc.info['name'] == target]
+    pids = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/comm") as f:
+                    if f.read().strip() == target:
+                        pids.append(int(entry))
+            except OSError:
+                pass
+    return pids
+
+class SampleRing:
+    """Fixed-size ring buffer of process samples kept in one typed array per metric."""
+    
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.columns = {name: array.array('d', bytes(8 * capacity)) for name in ('time',) + PROCESS_METRICS}
+        self.count = 0
+        self.lock = threading.Lock()
+        
+    def append(self, timestamp: float, values: Tuple[float, ...]) -> None:
+        """Store a sample, overwriting the oldest one when the buffer is full."""
+        slot = self.count % self.capacity
+        with self.lock:
+            self.columns['time'][slot] = timestamp
+            for name, value in zip(PROCESS_METRICS, values):
+                self.columns[name][slot] = value
+            self.count += 1
+            
+    def values(self, metric: str) -> List[float]:
+        """Return the stored values of a metric from oldest to newest."""
+        if metric not in self.columns:
+            raise ValueError(f"Unknown metric: {metric} (expected one of {', '.join(PROCESS_METRICS)})")
+        with self.lock:
+            column, end = self.columns[metric], self.count
+            return [column[i % self.capacity] for i in range(max(0, end - self.capacity), end)]
+            
+    def summary(self, metric: str) -> Dict[str, float]:
+        """Return count, min, max, avg and nearest-rank percentiles of a metric."""
+        values = sorted(self.values(metric))
+        if not values:
+            return {'count': 0}
+        summary = {'count': len(values), 'min': values[0], 'max': values[-1], 'avg': sum(values) / len(values)}
+        for percentile in PERCENTILES:
+            summary[f'p{percentile}'] = values[max(0, math.ceil(percentile / 100 * len(values)) - 1)]
+        return summary
+        
+    def to_csv(self, path: str) -> int:
+        """Write the stored samples to a CSV file and return the number of rows."""
+        columns = [self.values(name) for name in ('time',) + PROCESS_METRICS]
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(('time',) + PROCESS_METRICS)
+            writer.writerows(zip(*columns))
+        return len(columns[0])
+
+class ProcessMonitor:
+    """Samples one process, or the total of all processes with a given name, into a ring buffer."""
+    
+    def __init__(self, target: str, interval: float, capacity: int):
+        self.target = target
+        self.interval = interval
+        self.ring = SampleRing(capacity)
+        self.pids = find_processes(target)
+        self.handles: Dict[int, Any] = {}
+        self.cpu_seconds: Dict[int, float] = {}
+        self.last_sample: Optional[float] = None
+        self.next_due = time.monotonic()
+        
+    def sample(self) -> None:
+        """Take one sample of every monitored process and record the totals."""
+        if not self.pids and not self.target.isdigit():
+            self.pids = find_processes(self.target)
+            
+        now = time.monotonic()
+        cpu_delta, totals = 0.0, [0, 0, 0, 0]
+        for pid in list(self.pids):
+            try:
+                if psutil is not None and pid not in self.handles:
+                    self.handles[pid] = psutil.Process(pid)
+                cpu, *counters = sample_process(pid, self.handles.get(pid))
+            except Exception:
+                self.pids.remove(pid)
+                self.handles.pop(pid, None)
+                self.cpu_seconds.pop(pid, None)
+                continue
+            cpu_delta += cpu - self.cpu_seconds.get(pid, cpu)
+            self.cpu_seconds[pid] = cpu
+            totals = [total + value for total, value in zip(totals, counters)]
+            
+        elapsed = now - self.last_sample if self.last_sample is not None else 0
+        cpu_percent = 100.0 * cpu_delta / elapsed if elapsed > 0 else 0.0
+        self.last_sample = now
+        self.ring.append(time.time(), (cpu_percent, *totals))
+
+class ProcessSampler:
+    """One background thread that samples every registered monitor at its own interval."""
+    
+    def __init__(self):
+        self.monitors: Dict[str, ProcessMonitor] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        
+    def add(self, monitor: ProcessMonitor) -> None:
+        """Start sampling a monitor, replacing one with the same target."""
+        with self._lock:
+            self.monitors[monitor.target] = monitor
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="ws-process-sampler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        
+    def remove(self, target: Optional[str] = None) -> int:
+        """Stop sampling one target, or all of them; return how many monitors were removed."""
+        with self._lock:
+            targets = [target] if target is not None else list(self.monitors)
+            removed = sum(self.monitors.pop(name, None) is not None for name in targets)
+        self._wake.set()
+        return removed
+        
+    def _run(self) -> None:
+        while True:
+            # Clear before taking the snapshot so a wakeup from add() or remove() is never lost.
+            self._wake.clear()
+            with self._lock:
+                monitors = list(self.monitors.values())
+                if not monitors:
+                    # Let the next add() see that no thread is sampling and start one.
+                    self._thread = None
+                    return
+            now = time.monotonic()
+            for monitor in monitors:
+                if monitor.next_due <= now:
+                    monitor.sample()
+                    # Align to the interval grid so monitors with equal intervals share one wakeup.
+                    monitor.next_due = (math.floor(now / monitor.interval) + 1) * monitor.interval
+            self._wake.wait(max(0.0, min(monitor.next_due for monitor in monitors) - time.monotonic()))
+
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(text: str) -> float:
+    """Parse a duration such as 250ms, 30s, 5m, 2h or 1d into seconds; bare numbers are seconds."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?|\.\d+)\s*(ms|s|m|h|d)?\s*', text)
+    if not match:
+        raise ValueError(f"Invalid duration: {text}")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+def parse_options(args: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    """Split trailing key=value options from positional arguments."""
+    positional, options = [], {}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if sep and re.fullmatch(r'[A-Za-z_][\w-]*', key):
+            options[key] = value
+        else:
+            positional.append(arg)
+    return positional, options
+
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1 << 10, 'kb': 1 << 10, 'm': 1 << 20, 'mb': 1 << 20, 'g': 1 << 30, 'gb': 1 << 30}
+
+def parse_size(text: str) -> int:
+    """Parse a size such as 512, 10k, 4M or 2GB into bytes."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*([kmg]?b?)\s*', text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+def glob_to_regex(pattern: str) -> 're.Pattern[str]':
+    """Translate a '/'-separated glob where '**' spans directories into a regular expression."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            body = pattern[i + 1:end]
+            parts.append('[' + ('^' + body[1:] if body.startswith('!') else body).replace('\\', '\\\\') + ']')
+            i = end
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return re.compile(''.join(parts), re.DOTALL)
+
+class FileScan:
+    """A lazy, filtered scan of the files matching a glob pattern.
+    
+    The pattern is split into a literal root directory and a relative glob;
+    the walk uses os.scandir, prunes directories that cannot match and applies
+    the type, extension, size and age filters before an entry is yielded.
+    With workers > 1 subtrees are scanned in parallel and results arrive in
+    completion order. Every iteration scans the file system again.
+    """
+    
+    def __init__(self, pattern: str, file_type: Optional[str] = None, extensions: Optional[List[str]] = None,
+                 min_size: Optional[int] = None, max_size: Optional[int] = None,
+                 newer: Optional[float] = None, older: Optional[float] = None,
+                 limit: Optional[int] = None, workers: int = 1, hidden: bool = False):
+        # A drive such as C: stays in front of the root, so C:/*.txt scans C:/
+        # and not the current directory of drive C.
+        drive, path = os.path.splitdrive(pattern.replace(os.sep, '/'))
+        segments = path.split('/')
+        literal = 0
+        while literal < len(segments) - 1 and not re.search(r'[*?\[]', segments[literal]):
+            literal += 1
+        self.root = drive + ('/'.join(segments[:literal]) or ('/' if path.startswith('/') else ''))
+        self.segments = segments[literal:]
+        self.regex = glob_to_regex('/'.join(self.segments))
+        self.recursive = '**' in self.segments
+        fixed = self.segments[:self.segments.index('**')] if self.recursive else self.segments
+        self.prefix = [glob_to_regex(segment) for segment in fixed]
+        self.file_type = file_type
+        self.extensions = tuple(ext.lower() if ext.startswith('.') else '.' + ext.lower()
+                                for ext in extensions) if extensions else None
+        self.min_size, self.max_size = min_size, max_size
+        self.newer, self.older = newer, older
+        self.limit = limit
+        self.workers = max(1, workers)
+        self.hidden = hidden
+        
+    def __iter__(self) -> Iterator[str]:
+        results = self._walk_parallel() if self.workers > 1 else self._walk()
+        if self.limit is None:
+            return results
+        return itertools.islice(results, self.limit)
+        
+    def __str__(self) -> str:
+        return '\n'.join(self)
+        
+    def _walk(self) -> Iterator[str]:
+        pending = [(self.root, '')]
+        while pending:
+            matches, subdirectories = self._scan_directory(*pending.pop())
+            yield from matches
+            pending.extend(reversed(subdirectories))
+            
+    def _walk_parallel(self) -> Iterator[str]:
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            running = {pool.submit(self._scan_directory, self.root, '')}
+            while running:
+                done, running = wait_futures(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    matches, subdirectories = future.result()
+                    running.update(pool.submit(self._scan_directory, *subdirectory) for subdirectory in subdirectories)
+                    yield from matches
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            
+    def _scan_directory(self, directory: str, relative: str) -> Tuple[List[str], List[Tuple[str, str]]]:
+        """Return the matching entries of one directory and the subdirectories to descend into."""
+        matches, subdirectories = [], []
+        depth = relative.count('/') + 1 if relative else 0
+        now = time.time()
+        try:
+            entries = os.scandir(directory or '.')
+        except OSError:
+            return matches, subdirectories
+        with entries:
+            for entry in entries:
+                if not self.hidden and entry.name.startswith('.'):
+                    continue
+                path = relative + entry.name
+                try:
+                    is_dir = entry.is_dir()
+                    if is_dir and not entry.is_symlink() and self._descends(depth, entry.name):
+                        subdirectories.append((entry.path, path + '/'))
+                    if not self.regex.fullmatch(path) or not self._accepts(entry, is_dir, now):
+                        continue
+                except OSError:
+                    continue
+                matches.append(os.path.join(directory, entry.name) if directory else entry.name)
+        return matches, subdirectories
+        
+    def _descends(self, depth: int, name: str) -> bool:
+        """Check whether a directory at the given depth can contain matches."""
+        if depth < len(self.prefix) and not self.prefix[depth].fullmatch(name):
+            return False
+        return self.recursive or depth + 1 < len(self.segments)
+        
+    def _accepts(self, entry: os.DirEntry, is_dir: bool, now: float) -> bool:
+        """Apply the type, extension, size and age filters to a matching entry."""
+        if self.file_type == 'file' and is_dir or self.file_type == 'dir' and not is_dir:
+            return False
+        if self.extensions and not entry.name.lower().endswith(self.extensions):
+            return False
+        if self.min_size is None and self.max_size is None and self.newer is None and self.older is None:
+            return True
+        stat = entry.stat()
+        if self.min_size is not None and stat.st_size < self.min_size:
+            return False
+        if self.max_size is not None and stat.st_size > self.max_size:
+            return False
+        if self.newer is not None and stat.st_mtime < now - self.newer:
+            return False
+        if self.older is not None and stat.st_mtime >= now - self.older:
+            return False
+        return True
+
+class ScheduledJob:
+    """A recurring `every` or `at` block with a pre-parsed body."""
+    
+    def __init__(self, name: str, body: List[Any], interval: Optional[float] = None,
+                 time_of_day: Optional[Tuple[int, int, int]] = None, misfire: str = "skip",
+                 count: Optional[int] = None):
+        self.name = name
+        self.body = body
+        self.interval = interval
+        self.time_of_day = time_of_day
+        self.misfire = misfire
+        self.count = count
+        self.runs = 0
+        self.missed = 0
+        self.running = False
+        self.next_run = 0.0
+        
+    def first_run(self, now: float) -> float:
+        """Return the first firing time after now."""
+        return now + self.interval if self.interval is not None else self.following(now)
+    
+    def following(self, after: float) -> float:
+        """Return the firing time that follows a given firing time."""
+        if self.interval is not None:
+            return after + self.interval
+        hour, minute, second = self.time_of_day
+        moment = time.localtime(after)
+        candidate = time.mktime((moment.tm_year, moment.tm_mon, moment.tm_mday, hour, minute, second, 0, 0, -1))
+        day = 0
+        while candidate <= after:
+            day += 1
+            candidate = time.mktime((moment.tm_year, moment.tm_mon, moment.tm_mday + day,
+                                     hour, minute, second, 0, 0, -1))
+        return candidate
+    
+    def finished(self) -> bool:
+        """Check whether the job has used up its run count."""
+        return self.count is not None and self.runs >= self.count
+
+class Scheduler:
+    """Heap-based timer scheduler running recurring jobs inside one interpreter.
+    
+    A single thread sleeps until the earliest due job. Late firings are either
+    skipped (run once, drop missed slots) or caught up (run every missed slot).
+    A job never overlaps with its own previous run, and at most
+    `max_concurrency` job bodies run at the same time.
+    """
+    
+    def __init__(self, execute: Callable[[List[Any]], Any], max_concurrency: int = 1,
+                 clock: Callable[[], float] = time.time):
+        self.execute = execute
+        self.max_concurrency = max(1, max_concurrency)
+        self.clock = clock
+        self.jobs: List[ScheduledJob] = []
+        self._heap: List[Tuple[float, int, ScheduledJob]] = []
+        self._sequence = itertools.count()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._stopped = False
+        
+    def add(self, job: ScheduledJob) -> ScheduledJob:
+        """Schedule a job for its first firing."""
+        with self._lock:
+            job.next_run = job.first_run(self.clock())
+            self.jobs.append(job)
+            if not job.finished():
+                heapq.heappush(self._heap, (job.next_run, next(self._sequence), job))
+        self._wake.set()
+        return job
+    
+    def stop(self) -> None:
+        """Stop the scheduler loop after the jobs that are currently running."""
+        self._stopped = True
+        self._wake.set()
+        
+    def run(self) -> None:
+        """Run due jobs until every job has finished or the scheduler is stopped."""
+        self._stopped = False
+        pool = ThreadPoolExecutor(max_workers=self.max_concurrency) if self.max_concurrency > 1 else None
+        slots = threading.BoundedSemaphore(self.max_concurrency)
+        active = []
+        try:
+            while not self._stopped:
+                with self._lock:
+                    if not self._heap:
+                        active = [future for future in active if not future.done()]
+                        if not active:
+                            return
+                        delay = 0.05
+                    else:
+                        delay = self._heap[0][0] - self.clock()
+                        
+                if delay > 0:
+                    self._wake.wait(delay)
+                    self._wake.clear()
+                    continue
+                    
+                with self._lock:
+                    due, _, job = heapq.heappop(self._heap)
+                    
+                if job.running:
+                    job.missed += 1
+                else:
+                    job.running = True
+                    job.runs += 1
+                    if pool is None:
+                        self._run_job(job, slots)
+                    else:
+                        slots.acquire()
+                        active.append(pool.submit(self._run_job, job, slots))
+                        
+                self._reschedule(job, due)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+                
+    def _run_job(self, job: ScheduledJob, slots: threading.BoundedSemaphore) -> None:
+        """Execute a job body and release its concurrency slot."""
+        try:
+            self.execute(job.body)
+        except Exception as e:
+            print(f"Error in scheduled job '{job.name}': {str(e)}")
+        finally:
+            job.running = False
+            if self.max_concurrency > 1:
+                slots.release()
+            self._wake.set()
+            
+    def _reschedule(self, job: ScheduledJob, due: float) -> None:
+        """Push the next firing of a job, skipping missed slots unless it catches up."""
+        if job.finished():
+            return
+        next_run = job.following(due)
+        now = self.clock()
+        if job.misfire != "catchup":
+            while next_run <= now:
+                job.missed += 1
+                next_run = job.following(next_run)
+        job.next_run = next_run
+        with self._lock:
+            heapq.heappush(self._heap, (next_run, next(self._sequence), job))
+
+class CommandStream:
+    """Run a command and stream its output with bounded memory.
+    
+    A string command runs through the shell and a list runs as an argv without
+    one. Output is consumed as the process produces it, and only the last `tail`
+    lines are kept for error reporting.
+    """
+    
+    def __init__(self, command: Union[str, List[str]], tail: int = 20):
+        self.command = command
+        self.shell = isinstance(command, str)
+        self.tail = deque(maxlen=tail)
+        self.returncode = None
+        
+    def lines(self) -> Iterator[str]:
+        """Yield combined stdout and stderr lines as they arrive."""
+        with subprocess.Popen(self.command, shell=self.shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              text=True, errors='replace', bufsize=1) as process:
+            try:
+                for line in process.stdout:
+                    line = line.rstrip('\r\n')
+                    self.tail.append(line)
+                    yield line
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                self.returncode = process.wait()
+                
+    def copy_to(self, path: str, append: bool = False, chunk_size: int = 1 << 16) -> int:
+        """Copy stdout to a file in fixed-size chunks, keeping the stderr tail; return the exit code."""
+        with open(path, 'ab' if append else 'wb') as target, \
+                subprocess.Popen(self.command, shell=self.shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+            collector = threading.Thread(target=self._collect, args=(process.stderr,), daemon=True)
+            collector.start()
+            shutil.copyfileobj(process.stdout, target, chunk_size)
+            collector.join()
+            self.returncode = process.wait()
+        return self.returncode
+    
+    def _collect(self, stream) -> None:
+        """Keep the last lines of a binary stream."""
+        for line in stream:
+            self.tail.append(line.decode('utf-8', errors='replace').rstrip('\r\n'))
+            
+    def error_report(self) -> str:
+        """Describe a failed command with the last lines of its output."""
+        report = f"Command error (exit code {self.returncode})"
+        if self.tail:
+            report += f", last {len(self.tail)} lines:\n" + '\n'.join(self.tail)
+        return report
+
+TYPE_STRATEGIES = ("auto", "paste", "keys")
+CLIPBOARD_TOOLS = [
+    (['pbpaste'], ['pbcopy']),
+    (['wl-paste', '--no-newline'], ['wl-copy']),
+    (['xclip', '-selection', 'clipboard', '-o'], ['xclip', '-selection', 'clipboard']),
+    (['xsel', '--clipboard', '--output'], ['xsel', '--clipboard', '--input']),
+]
+
+class PyAutoGuiKeyboard:
+    """Keyboard backend that sends key events through pyautogui."""
+    
+    def write(self, text: str) -> None:
+        pyautogui.write(text)
+        
+    def hotkey(self, *keys: str) -> None:
+        pyautogui.hotkey(*keys)
+
+class SystemClipboard:
+    """Text clipboard through the Win32 API on Windows and pbcopy, wl-clipboard, xclip or xsel elsewhere."""
+    CF_UNICODETEXT = 13
+    GMEM_MOVEABLE = 0x0002
+    
+    def __init__(self):
+        self._tools: Optional[Tuple[List[str], List[str]]] = None
+        self._resolved = False
+        
+    @property
+    def tools(self) -> Optional[Tuple[List[str], List[str]]]:
+        """The (paste, copy) commands of the first installed clipboard tool, looked up on first use."""
+        if not self._resolved:
+            if os.name != 'nt':
+                self._tools = next((tools for tools in CLIPBOARD_TOOLS if shutil.which(tools[0][0])), None)
+            self._resolved = True
+        return self._tools
+            
+    @property
+    def available(self) -> bool:
+        return os.name == 'nt' or self.tools is not None
+    
+    def get(self) -> Optional[str]:
+        """Return the clipboard text, or None when it holds no text."""
+        if os.name == 'nt':
+            return self._win32_get()
+        if self.tools is None:
+            raise RuntimeError("no clipboard tool found (install xclip, xsel or wl-clipboard)")
+        result = subprocess.run(self.tools[0], capture_output=True, timeout=5)
+        return result.stdout.decode('utf-8', errors='replace') if result.returncode == 0 else None
+    
+    def set(self, text: str) -> None:
+        """Replace the clipboard contents with text."""
+        if os.name == 'nt':
+            return self._win32_set(text)
+        if self.tools is None:
+            raise RuntimeError("no clipboard tool found (install xclip, xsel or wl-clipboard)")
+        subprocess.run(self.tools[1], input=text.encode('utf-8'), check=True, timeout=5)
+        
+    def _win32_api(self) -> Tuple[Any, Any]:
+        user32, kernel32 = ctypes.windll.user32, ctypes.windll.kernel32
+        user32.GetClipboardData.restype = ctypes.c_void_p
+        user32.SetClipboardData.argtypes = (ctypes.c_uint, ctypes.c_void_p)
+        kernel32.GlobalAlloc.restype = ctypes.c_void_p
+        kernel32.GlobalLock.argtypes = kernel32.GlobalUnlock.argtypes = (ctypes.c_void_p,)
+        kernel32.GlobalLock.restype = ctypes.c_void_p
+        return user32, kernel32
+    
+    def _win32_get(self) -> Optional[str]:
+        user32, kernel32 = self._win32_api()
+        if not user32.OpenClipboard(None):
+            raise RuntimeError("cannot open the clipboard")
+        try:
+            handle = user32.GetClipboardData(self.CF_UNICODETEXT)
+            if not handle:
+                return None
+            pointer = kernel32.GlobalLock(handle)
+            try:
+                return ctypes.wstring_at(pointer)
+            finally:
+                kernel32.GlobalUnlock(handle)
+        finally:
+            user32.CloseClipboard()
+            
+    def _win32_set(self, text: str) -> None:
+        user32, kernel32 = self._win32_api()
+        data = text.encode('utf-16-le') + b'\0\0'
+        handle = kernel32.GlobalAlloc(self.GMEM_MOVEABLE, len(data))
+        pointer = kernel32.GlobalLock(handle)
+        ctypes.memmove(pointer, data, len(data))
+        kernel32.GlobalUnlock(handle)
+        if not user32.OpenClipboard(None):
+            raise RuntimeError("cannot open the clipboard")
+        try:
+            user32.EmptyClipboard()
+            user32.SetClipboardData(self.CF_UNICODETEXT, handle)
+        finally:
+            user32.CloseClipboard()
+
+class TextTyper:
+    """Enter text with key events or by pasting it through the clipboard.
+    
+    The 'auto' strategy pastes payloads of at least paste_threshold characters
+    when a clipboard is available, and types shorter ones as key events in
+    chunks of chunk_size characters; 'paste' and 'keys' force one method.
+    Pasting saves the previous clipboard text and restores it afterwards, or
+    clears the clipboard if it held no text.
+    """
+    
+    def __init__(self, keyboard: Any = None, clipboard: Any = None, strategy: str = "auto",
+                 paste_threshold: int = 200, chunk_size: int = 64, paste_delay: float = 0.1):
+        if strategy not in TYPE_STRATEGIES:
+            raise ValueError(f"unknown type strategy '{strategy}' (expected one of {', '.join(TYPE_STRATEGIES)})")
+        self.keyboard = keyboard or PyAutoGuiKeyboard()
+        self.clipboard = clipboard if clipboard is not None else SystemClipboard()
+        self.strategy = strategy
+        self.paste_threshold = paste_threshold
+        self.chunk_size = chunk_size
+        self.paste_delay = paste_delay
+        self.paste_keys = ('command', 'v') if sys.platform == 'darwin' else ('ctrl', 'v')
+        
+    def type(self, text: str) -> str:
+        """Enter text and return the method used, 'paste' or 'keys'."""
+        if self.strategy == "paste" or (self.strategy == "auto" and len(text) >= self.paste_threshold
+                                         and getattr(self.clipboard, 'available', True)):
+            try:
+                self.paste(text)
+                return "paste"
+            except Exception:
+                if self.strategy == "paste":
+                    raise
+        self.write(text)
+        return "keys"
+    
+    def write(self, text: str) -> None:
+        """Send text as key events, chunk by chunk."""
+        for start in range(0, len(text), self.chunk_size):
+            self.keyboard.write(text[start:start + self.chunk_size])
+            
+    def paste(self, text: str) -> None:
+        """Put text on the clipboard, press the paste shortcut, then restore the previous clipboard text.
+        
+        Errors raised here mean the text was not pasted. A clipboard that cannot
+        be read is left untouched, so that type() can fall back to key events.
+        A failure to restore the clipboard afterwards is only reported, since the
+        text is already in.
+        """
+        saved = self.clipboard.get()
+        self.clipboard.set(text)
+        try:
+            self.keyboard.hotkey(*self.paste_keys)
+            # The target reads the clipboard asynchronously; give it time before restoring.
+            time.sleep(self.paste_delay)
+        finally:
+            try:
+                self.clipboard.set('' if saved is None else saved)
+            except Exception as e:
+                print(f"Warning: could not restore the clipboard: {str(e)}")
+
+DEFAULT_MATCH_CONFIDENCE = 0.9
+# Per-pixel variance below which a window counts as flat; it also absorbs summed-area rounding errors.
+MIN_WINDOW_VARIANCE = 0.01
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def _gray_value(r: int, g: int, b: int) -> int:
+    """ITU-R 601-2 luma, rounded like Pillow's 'L' conversion."""
+    return (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16
+
+def read_png(path: str) -> Tuple[int, int, List[bytes]]:
+    """Decode an 8-bit, non-interlaced PNG file into rows of grayscale bytes."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError(f"{path} is not a PNG file")
+        
+    pos, idat, palette, header = len(PNG_SIGNATURE), [], None, None
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += length + 12
+        if kind == b'IHDR':
+            header = struct.unpack('>IIBBBBB', chunk)
+        elif kind == b'PLTE':
+            palette = chunk
+        elif kind == b'IDAT':
+            idat.append(chunk)
+        elif kind == b'IEND':
+            break
+    if header is None:
+        raise ValueError(f"{path} has no PNG header")
+    width, height, depth, color, _, _, interlace = header
+    if depth != 8 or interlace or color not in PNG_CHANNELS:
+        raise ValueError("only 8-bit non-interlaced PNG images can be read without Pillow")
+        
+    channels = PNG_CHANNELS[color]
+    stride = width * channels
+    raw = zlib.decompress(b''.join(idat))
+    previous, rows = bytearray(stride), []
+    for y in range(height):
+        start = y * (stride + 1)
+        filter_type, row = raw[start], bytearray(raw[start + 1:start + 1 + stride])
+        if filter_type == 1:
+            for i in range(channels, stride):
+                row[i] = (row[i] + row[i - channels]) & 0xFF
+        elif filter_type == 2:
+            row = bytearray((a + b) & 0xFF for a, b in zip(row, previous))
+        elif filter_type == 3:
+            for i in range(stride):
+                left = row[i - channels] if i >= channels else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xFF
+        elif filter_type == 4:
+            for i in range(stride):
+                a = row[i - channels] if i >= channels else 0
+                b = previous[i]
+                c = previous[i - channels] if i >= channels else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                row[i] = (row[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xFF
+        previous = row
+        
+        if color == 0:
+            rows.append(bytes(row))
+        elif color == 4:
+            rows.append(bytes(row[0::2]))
+        elif color == 3:
+            gray = [_gray_value(*palette[i:i + 3]) for i in range(0, len(palette), 3)]
+            rows.append(bytes(gray[index] for index in row))
+        else:
+            rows.append(bytes(_gray_value(r, g, b) for r, g, b in
+                              zip(row[0::channels], row[1::channels], row[2::channels])))
+    return width, height, rows
+
+def gray_image(rows: List[bytes]) -> Any:
+    """Turn rows of grayscale bytes into the matcher's image type: a float array with NumPy, else lists."""
+    if numpy is not None:
+        return numpy.array([numpy.frombuffer(bytes(row), dtype=numpy.uint8) for row in rows], dtype=numpy.float64)
+    return [list(map(float, row)) for row in rows]
+
+def load_gray_image(path: str) -> Any:
+    """Load an image file as grayscale, with Pillow when available and the built-in PNG reader otherwise."""
+    if PILImage is not None:
+        with PILImage.open(path) as image:
+            image = image.convert('L')
+            if numpy is not None:
+                return numpy.asarray(image, dtype=numpy.float64)
+            data, width = image.tobytes(), image.width
+            return [list(map(float, data[i:i + width])) for i in range(0, len(data), width)]
+    return gray_image(read_png(path)[2])
+
+def grab_screen(region: Optional[Tuple[int, int, int, int]] = None) -> Any:
+    """Take a grayscale screenshot of the screen or of an (x, y, width, height) region."""
+    if not hasattr(pyautogui, 'screenshot'):
+        raise RuntimeError("pyautogui not installed")
+    image = pyautogui.screenshot(region=region).convert('L')
+    if numpy is not None:
+        return numpy.asarray(image, dtype=numpy.float64)
+    data, width = image.tobytes(), image.width
+    return [list(map(float, data[i:i + width])) for i in range(0, len(data), width)]
+
+def image_shape(image: Any) -> Tuple[int, int]:
+    """Return (height, width) of a grayscale image."""
+    if numpy is not None:
+        return image.shape
+    return len(image), len(image[0]) if image else 0
+
+def crop_image(image: Any, left: int, top: int, width: int, height: int) -> Any:
+    """Return the part of an image inside a rectangle."""
+    if numpy is not None:
+        return image[top:top + height, left:left + width]
+    return [row[left:left + width] for row in image[top:top + height]]
+
+def downscale_image(image: Any, factor: int) -> Any:
+    """Shrink an image by an integer factor, averaging each factor x factor block."""
+    if factor == 1:
+        return image
+    height, width = image_shape(image)
+    height, width = height // factor * factor, width // factor * factor
+    if numpy is not None:
+        return image[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3))
+    area = factor * factor
+    result = []
+    for y in range(0, height, factor):
+        rows = image[y:y + factor]
+        sums = [sum(column) for column in zip(*(row[:width] for row in rows))]
+        result.append([sum(sums[x:x + factor]) / area for x in range(0, width, factor)])
+    return result
+
+def _integral(image: Any, square: bool = False) -> List[List[float]]:
+    """Summed-area table with a leading row and column of zeros."""
+    width = len(image[0])
+    table = [[0.0] * (width + 1)]
+    for row in image:
+        running, above, line = 0.0, table[-1], [0.0]
+        for x, value in enumerate(row):
+            running += value * value if square else value
+            line.append(above[x + 1] + running)
+        table.append(line)
+    return table
+
+def ncc_map(image: Any, template: Any) -> Any:
+    """Normalized cross-correlation of template at every position where it fits inside image.
+    
+    Scores range from -1 to 1; windows or templates without contrast score 0.
+    """
+    height, width = image_shape(image)
+    th, tw = image_shape(template)
+    area = th * tw
+    if numpy is not None:
+        centered = template - template.mean()
+        norm = math.sqrt(float((centered * centered).sum()))
+        shape = (height + th - 1, width + tw - 1)
+        spectrum = numpy.fft.rfft2(image, shape) * numpy.fft.rfft2(centered[::-1, ::-1], shape)
+        correlation = numpy.fft.irfft2(spectrum, shape)[th - 1:height, tw - 1:width]
+        sums = numpy.pad(image, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+        squares = numpy.pad(image * image, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+        window = lambda table: table[th:, tw:] - table[:-th, tw:] - table[th:, :-tw] + table[:-th, :-tw]
+        window_sum = window(sums)
+        variance = numpy.maximum(window(squares) - window_sum * window_sum / area, 0)
+        denominator = numpy.sqrt(variance) * norm
+        scores = numpy.zeros_like(correlation)
+        numpy.divide(correlation, denominator, out=scores, where=(variance > MIN_WINDOW_VARIANCE * area) & (norm > 0))
+        return scores
+        
+    mean = sum(map(sum, template)) / area
+    centered = [[value - mean for value in row] for row in template]
+    norm = math.sqrt(sum(value * value for row in centered for value in row))
+    sums, squares = _integral(image), _integral(image, square=True)
+    scores = []
+    for y in range(height - th + 1):
+        line, rows = [], image[y:y + th]
+        for x in range(width - tw + 1):
+            window_sum = sums[y + th][x + tw] - sums[y][x + tw] - sums[y + th][x] + sums[y][x]
+            window_squares = squares[y + th][x + tw] - squares[y][x + tw] - squares[y + th][x] + squares[y][x]
+            variance = window_squares - window_sum * window_sum / area
+            if variance <= MIN_WINDOW_VARIANCE * area or not norm:
+                line.append(0.0)
+                continue
+            correlation = sum(sum(map(operator.mul, row[x:x + tw], trow)) for row, trow in zip(rows, centered))
+            line.append(correlation / (math.sqrt(variance) * norm))
+        scores.append(line)
+    return scores
+
+def best_scores(scores: Any, count: int, spacing: Tuple[int, int]) -> List[Tuple[float, int, int]]:
+    """Return up to count (score, x, y) peaks of a score map, at least spacing (dy, dx) apart."""
+    if numpy is not None:
+        order = numpy.argsort(scores, axis=None)[::-1]
+        xs, ys = order % scores.shape[1], order // scores.shape[1]
+        candidates = zip(scores.ravel()[order].tolist(), xs.tolist(), ys.tolist())
+    else:
+        candidates = sorted(((score, x, y) for y, row in enumerate(scores) for x, score in enumerate(row)), reverse=True)
+    peaks = []
+    for score, x, y in candidates:
+        if len(peaks) == count:
+            break
+        if all(abs(x - px) >= spacing[1] or abs(y - py) >= spacing[0] for _, px, py in peaks):
+            peaks.append((score, x, y))
+    return peaks
+
+class ImageMatcher:
+    """Locate a template image inside a screenshot or another image by normalized cross-correlation.
+    
+    The search first runs on copies of both images shrunk by an integer factor
+    and then refines the best coarse candidates at full resolution. With NumPy
+    the correlation maps are computed with FFTs and summed-area tables; without
+    it a pure-Python path gives the same results, only slower. Templates and
+    their shrunk copies are cached by path and modification time.
+    """
+    MIN_COARSE_SIZE = 8
+    MAX_FACTOR = 8
+    CANDIDATES = 5
+    COARSE_MARGIN = 0.2
+    
+    def __init__(self, cache_size: int = 32):
+        self.cache_size = cache_size
+        self.templates: 'OrderedDict[Tuple[str, int, int], Dict[int, Any]]' = OrderedDict()
+        self.lock = threading.Lock()
+        
+    def pyramid(self, path: str) -> Dict[int, Any]:
+        """Return the cached levels of a template image keyed by downscale factor, loading it on first use."""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            levels = self.templates.get(key)
+            if levels is not None:
+                self.templates.move_to_end(key)
+                return levels
+        levels = {1: load_gray_image(path)}
+        with self.lock:
+            self.templates[key] = levels
+            while len(self.templates) > self.cache_size:
+                self.templates.popitem(last=False)
+        return levels
+    
+    def find(self, image: Any, template_path: str, confidence: float = 0.9) -> Optional[Tuple[int, int, int, int, float]]:
+        """Return (left, top, width, height, score) of the best match scoring at least confidence, or None."""
+        levels = self.pyramid(template_path)
+        template = levels[1]
+        th, tw = image_shape(template)
+        height, width = image_shape(image)
+        if th > height or tw > width or not th or not tw:
+            return None
+            
+        factor = max(1, min(self.MAX_FACTOR, min(th, tw) // self.MIN_COARSE_SIZE))
+        if factor == 1:
+            peaks = best_scores(ncc_map(image, template), 1, (th, tw))
+            candidates = [(x, y) for score, x, y in peaks if score >= confidence]
+        else:
+            if factor not in levels:
+                levels[factor] = downscale_image(template, factor)
+            coarse = ncc_map(downscale_image(image, factor), levels[factor])
+            coarse_th, coarse_tw = image_shape(levels[factor])
+            peaks = best_scores(coarse, self.CANDIDATES, (coarse_th, coarse_tw))
+            candidates = [(x * factor, y * factor) for score, x, y in peaks if score >= confidence - self.COARSE_MARGIN]
+            
+        best = None
+        for x, y in candidates:
+            left, top = max(0, x - factor), max(0, y - factor)
+            right, bottom = min(width - tw, x + factor), min(height - th, y + factor)
+            window = crop_image(image, left, top, right - left + tw, bottom - top + th)
+            score, dx, dy = best_scores(ncc_map(window, template), 1, (1, 1))[0]
+            if score >= confidence and (best is None or score > best[4]):
+                best = (left + dx, top + dy, tw, th, score)
+        return best
+
+RUN_MODES = ("shell", "argv", "session")
+
+def join_command(args: List[str]) -> str:
+    """Join tokens into a shell command line, re-quoting tokens that contain whitespace."""
+    parts = []
+    for arg in args:
+        if arg and not re.search(r'\s', arg):
+            parts.append(arg)
+        elif os.name == 'nt':
+            parts.append('"' + arg.replace('"', '""') + '"')
+        else:
+            parts.append('"' + re.sub(r'(["\\`])', r'\\\1', arg) + '"')
+    return ' '.join(parts)
+
+class ShellSession:
+    """Long-lived shell process that runs commands one after another.
+    
+    Each command is followed by a sentinel line carrying its exit code, so
+    output is framed without starting a new shell per command. The working
+    directory and environment persist between commands. POSIX commands are
+    passed as a quoted here-document to a shell function that evals them, so
+    quotes left open by a command cannot swallow the sentinel. With a
+    timeout, a command that produces no output for that many seconds is
+    abandoned and the shell is killed; by default commands may run quietly
+    for as long as they need.
+    """
+    POSIX_RUNNER = ('__ws_run() { __ws_cmd=; while IFS= read -r __ws_line; do __ws_cmd="$__ws_cmd$__ws_line\n"; '
+                    'done; command eval "$__ws_cmd" </dev/null; }\n')
+    
+    def __init__(self, timeout: Optional[float] = None):
+        self.sentinel = f"__WS_{uuid.uuid4().hex}__"
+        self.timeout = timeout
+        if os.name == 'nt':
+            argv = [os.environ.get('COMSPEC', 'cmd.exe'), '/Q', '/K']
+        else:
+            argv = ['/bin/sh']
+        self.process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, text=True, errors='replace', bufsize=1)
+        self.tail = deque(maxlen=20)
+        self._lock = threading.Lock()
+        self._lines: queue.Queue = queue.Queue()
+        threading.Thread(target=self._read_lines, daemon=True).start()
+        if os.name != 'nt':
+            self.process.stdin.write(self.POSIX_RUNNER)
+        
+    @property
+    def alive(self) -> bool:
+        """Check whether the shell process is still running."""
+        return self.process.poll() is None
+    
+    def _read_lines(self) -> None:
+        """Move the shell's output lines into the line queue; None marks the end of the output."""
+        for line in self.process.stdout:
+            self._lines.put(line)
+        self._lines.put(None)
+        
+    def run(self, command: str, on_line: Optional[Callable[[str], Any]] = None,
+            timeout: Optional[float] = None) -> Tuple[int, str]:
+        """Run a command and return its exit code and output.
+        
+        With on_line, output lines are passed to the callback as they arrive
+        instead of being collected, and only the last lines are kept. timeout
+        overrides the session's limit for this command. Raises ValueError for
+        a command that cannot be framed and TimeoutError, after killing the
+        shell, when the command stays silent for too long.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if os.name == 'nt':
+            if command.count('"') % 2:
+                raise ValueError("unbalanced double quote in command")
+            script = f"({command}) < NUL\necho.\necho {self.sentinel} %errorlevel%\n"
+        else:
+            script = f"__ws_run <<'{self.sentinel}'\n{command}\n{self.sentinel}\nprintf '\\n%s %d\\n' {self.sentinel} $?\n"
+            
+        with self._lock:
+            if not self.alive:
+                raise RuntimeError("Shell session is closed")
+            self.tail.clear()
+            self.process.stdin.write(script)
+            self.process.stdin.flush()
+            
+            output = []
+            pending = None
+            while True:
+                try:
+                    line = self._lines.get(timeout=timeout)
+                except queue.Empty:
+                    self.process.kill()
+                    raise TimeoutError(f"no output for {timeout:g}s") from None
+                if line is None:
+                    raise RuntimeError("Shell session exited")
+                if line.startswith(self.sentinel):
+                    # The line before the sentinel ends with the newline printed ahead of it.
+                    if pending is not None and pending[:-1]:
+                        self._emit(pending[:-1], output, on_line)
+                    return int(line.split()[1]), ''.join(output)
+                if pending is not None:
+                    self._emit(pending, output, on_line)
+                pending = line
+        
+    def _emit(self, line: str, output: List[str], on_line: Optional[Callable[[str], Any]]) -> None:
+        """Deliver one output line to the callback or the collected output."""
+        self.tail.append(line.rstrip('\r\n'))
+        if on_line is None:
+            output.append(line)
+        else:
+            on_line(line.rstrip('\r\n'))
+            
+    def close(self) -> None:
+        """Terminate the shell process."""
+        if self.alive:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Write a file atomically by writing a temporary file and renaming it over the target."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.ws-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+RUN_CACHE_OPTIONS = ('ttl', 'env', 'inputs')
+DEFAULT_RUN_CACHE_TTL = 60.0
+DEFAULT_RUN_CACHE_ENV = ('PATH',)
+
+SNAPSHOT_MAGIC = b"WSSNAP"
+SNAPSHOT_VERSION = 1
+CHECKPOINT_MAGIC = b"WSCKPT"
+CHECKPOINT_VERSION = 1
+
+class FunctionCache:
+    """Bounded LRU cache of a function's results keyed by its arguments, with an optional TTL."""
+    
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: 'OrderedDict[Tuple[Any, ...], Tuple[Any, Optional[float]]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+    def get(self, key: Tuple[Any, ...]) -> Tuple[bool, Any]:
+        """Return (True, value) for a live entry, or (False, None) on a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0]
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+            
+    def put(self, key: Tuple[Any, ...], value: Any) -> None:
+        """Store a result, evicting the least recently used entries beyond maxsize."""
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl if self.ttl else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                
+    def clear(self) -> None:
+        """Drop all cached results; the statistics are kept."""
+        with self.lock:
+            self.entries.clear()
+            
+    def stats(self) -> str:
+        """Describe the cache's hit rate, size and limits."""
+        ttl = f" ttl={self.ttl:g}s" if self.ttl else ""
+        return f"hits={self.hits} misses={self.misses} size={len(self.entries)}/{self.maxsize}{ttl}"
+
+class CommandCache:
+    """LRU cache of command results with an optional on-disk store.
+    
+    Entries are keyed by a digest of the command, working directory, selected
+    environment variables and input file stamps. With a directory set, entries
+    are also written there as JSON files, so they survive between runs.
+    """
+    
+    def __init__(self, maxsize: int = 256, directory: Optional[str] = None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+    @staticmethod
+    def key(command: Union[str, List[str]], cwd: str, env: Dict[str, Optional[str]], inputs: List[str]) -> str:
+        """Digest what a command's output depends on; input files count by path, size and mtime."""
+        stamps = []
+        for path in inputs:
+            try:
+                stat = os.stat(path)
+                stamps.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+            except OSError:
+                stamps.append([os.path.abspath(path), None, None])
+        material = json.dumps([command, cwd, sorted(env.items()), stamps])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+        
+    def get(self, key: str, ttl: float) -> Optional[Dict[str, Any]]:
+        """Return the entry for key from memory or disk if it is at most ttl seconds old, or None on a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.directory:
+                try:
+                    with open(self._path(key), 'r', encoding='utf-8') as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    entry = None
+            if entry is not None and entry['time'] + ttl > time.time():
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                self._evict()
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.entries.pop(key, None)
+            self.misses += 1
+            return None
+            
+    def put(self, key: str, stdout: str, stderr: str, returncode: int) -> Dict[str, Any]:
+        """Store a command result stamped with the current time."""
+        entry = {'stdout': stdout, 'stderr': stderr, 'returncode': returncode, 'time': time.time()}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._evict()
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+                write_atomic(self._path(key), json.dumps(entry).encode('utf-8'))
+        return entry
+    
+    def _evict(self) -> None:
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            
+    def clear(self) -> None:
+        """Drop all cached results, including the on-disk store; the statistics are kept."""
+        with self.lock:
+            self.entries.clear()
+            if self.directory and os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.endswith('.json'):
+                        try:
+                            os.remove(os.path.join(self.directory, name))
+                        except OSError:
+                            pass
+                            
+    def stats(self) -> str:
+        """Describe the cache's hit rate, size and store."""
+        store = f" store={self.directory}" if self.directory else ""
+        return f"hits={self.hits} misses={self.misses} size={len(self.entries)}/{self.maxsize}{store}"
+
+class StringBuilder:
+    """A mutable string kept as a list of chunks and joined only when it is read.
+    
+    Appending is amortised O(1), so building a large report line by line takes
+    linear time. Reading joins the chunks once and keeps the result as a single
+    chunk. Snapshots store the joined text as a plain string.
+    """
+    __slots__ = ('chunks', 'length')
+    
+    def __init__(self, text: str = ""):
+        self.chunks: List[str] = [text] if text else []
+        self.length = len(text)
+        
+    def append(self, text: str) -> None:
+        """Add text to the end of the builder."""
+        self.chunks.append(text)
+        self.length += len(text)
+        
+    def clear(self) -> None:
+        """Remove all text."""
+        self.chunks.clear()
+        self.length = 0
+        
+    def __str__(self) -> str:
+        if len(self.chunks) > 1:
+            self.chunks[:] = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+        
+    def __len__(self) -> int:
+        return self.length
+        
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, StringBuilder):
+            other = str(other)
+        return str(self) == other if isinstance(other, str) else NotImplemented
+        
+    __hash__ = None
+        
+    def __add__(self, other: Any) -> str:
+        return str(self) + str(other)
+        
+    def __radd__(self, other: Any) -> str:
+        return str(other) + str(self)
+        
+    def __contains__(self, text: str) -> bool:
+        return text in str(self)
+        
+    def __getitem__(self, index: Any) -> str:
+        return str(self)[index]
+        
+    def __repr__(self) -> str:
+        return f"StringBuilder({len(self.chunks)} chunks, {self.length} chars)"
+        
+    def __reduce__(self):
+        return (str, (str(self),))
+
+class Vector:
+    """A numeric vector stored in a NumPy float64 array, or in array('d') without NumPy.
+    
+    Arithmetic operators work element-wise with a vector of the same length or
+    with a number, and aggregates run over the whole vector in one call.
+    Appended values are buffered and merged into the array when it is next read.
+    Percentiles use the nearest-rank method, like process monitor statistics.
+    """
+    __slots__ = ('_data', '_pending')
+    
+    def __init__(self, values: Any = ()):
+        if numpy is not None:
+            if isinstance(values, Iterator):
+                self._data = numpy.fromiter(values, dtype=numpy.float64)
+            else:
+                self._data = numpy.array(values, dtype=numpy.float64).ravel()
+        else:
+            self._data = array.array('d', values)
+        self._pending: List[float] = []
+        
+    @property
+    def data(self) -> Any:
+        """The vector's values as a NumPy array or array('d')."""
+        if self._pending:
+            if numpy is not None:
+                self._data = numpy.concatenate((self._data, self._pending))
+            else:
+                self._data.extend(self._pending)
+            self._pending = []
+        return self._data
+    
+    def append(self, value: Any) -> None:
+        """Add a value to the end of the vector."""
+        self._pending.append(float(value))
+        
+    def __len__(self) -> int:
+        return len(self._data) + len(self._pending)
+    
+    def __iter__(self) -> Iterator[float]:
+        return iter(self.data.tolist())
+    
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return Vector(self.data[index])
+        return float(self.data[index])
+    
+    def _binary(self, other: Any, op: Callable[[Any, Any], Any], reflected: bool = False) -> Any:
+        data = self.data
+        if isinstance(other, Vector):
+            other = other.data
+            if len(other) != len(data):
+                raise ValueError(f"vector lengths differ: {len(data)} and {len(other)}")
+        elif not isinstance(other, (int, float)) or isinstance(other, bool):
+            return NotImplemented
+        left, right = (other, data) if reflected else (data, other)
+        if numpy is not None or isinstance(other, array.array):
+            return Vector(op(left, right) if numpy is not None else map(op, left, right))
+        if reflected:
+            return Vector(op(other, value) for value in data)
+        return Vector(op(value, other) for value in data)
+    
+    def __add__(self, other): return self._binary(other, operator.add)
+    def __radd__(self, other): return self._binary(other, operator.add, True)
+    def __sub__(self, other): return self._binary(other, operator.sub)
+    def __rsub__(self, other): return self._binary(other, operator.sub, True)
+    def __mul__(self, other): return self._binary(other, operator.mul)
+    def __rmul__(self, other): return self._binary(other, operator.mul, True)
+    def __truediv__(self, other): return self._binary(other, operator.truediv)
+    def __rtruediv__(self, other): return self._binary(other, operator.truediv, True)
+    def __floordiv__(self, other): return self._binary(other, operator.floordiv)
+    def __rfloordiv__(self, other): return self._binary(other, operator.floordiv, True)
+    def __mod__(self, other): return self._binary(other, operator.mod)
+    def __rmod__(self, other): return self._binary(other, operator.mod, True)
+    def __pow__(self, other): return self._binary(other, operator.pow)
+    def __rpow__(self, other): return self._binary(other, operator.pow, True)
+    
+    def __neg__(self) -> 'Vector':
+        return Vector(-self.data) if numpy is not None else Vector(-value for value in self.data)
+    
+    def __abs__(self) -> 'Vector':
+        return Vector(numpy.abs(self.data)) if numpy is not None else Vector(abs(value) for value in self.data)
+    
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Vector):
+            return NotImplemented
+        return len(self) == len(other) and self.data.tolist() == other.data.tolist()
+    
+    __hash__ = None
+    
+    def sum(self) -> float:
+        return float(numpy.sum(self.data)) if numpy is not None else math.fsum(self.data)
+    
+    def mean(self) -> float:
+        if not len(self):
+            raise ValueError("mean of an empty vector")
+        return self.sum() / len(self)
+    
+    def min(self) -> float:
+        if not len(self):
+            raise ValueError("min of an empty vector")
+        return float(numpy.min(self.data)) if numpy is not None else min(self.data)
+    
+    def max(self) -> float:
+        if not len(self):
+            raise ValueError("max of an empty vector")
+        return float(numpy.max(self.data)) if numpy is not None else max(self.data)
+    
+    def percentiles(self, percentiles: List[float]) -> List[float]:
+        """Return the nearest-rank value of each percentile (0-100)."""
+        count = len(self)
+        if not count:
+            raise ValueError("percentile of an empty vector")
+        ranks = []
+        for percentile in percentiles:
+            if not 0 <= percentile <= 100:
+                raise ValueError(f"percentile out of range: {percentile:g}")
+            ranks.append(max(0, math.ceil(percentile / 100 * count) - 1))
+        if numpy is not None:
+            return numpy.partition(self.data, ranks)[ranks].tolist()
+        values = sorted(self.data)
+        return [values[rank] for rank in ranks]
+    
+    def histogram(self, bins: int = 10) -> List[Dict[str, float]]:
+        """Count the values in equal-width bins between the minimum and maximum."""
+        if bins < 1:
+            raise ValueError("histogram needs at least one bin")
+        low, high = self.min(), self.max()
+        width = (high - low) / bins or 1.0
+        if numpy is not None:
+            counts = numpy.histogram(self.data, bins, (low, low + width * bins))[0].tolist()
+        else:
+            counts = [0] * bins
+            for value in self.data:
+                counts[min(int((value - low) / width), bins - 1)] += 1
+        return [{'low': low + i * width, 'high': low + (i + 1) * width, 'count': count}
+                for i, count in enumerate(counts)]
+    
+    def sort(self, reverse: bool = False) -> None:
+        """Sort the values in place."""
+        if numpy is not None:
+            self._data = numpy.sort(self.data)[::-1].copy() if reverse else numpy.sort(self.data)
+        else:
+            self._data = array.array('d', sorted(self.data, reverse=reverse))
+            
+    def summary(self) -> Dict[str, float]:
+        """Return count, sum, min, max, avg and nearest-rank percentiles, like process stats."""
+        if not len(self):
+            return {'count': 0}
+        count, total = len(self), self.sum()
+        if numpy is not None:
+            low, high = self.min(), self.max()
+            values = self.percentiles(list(PERCENTILES))
+        else:
+            ordered = sorted(self.data)
+            low, high = ordered[0], ordered[-1]
+            values = [ordered[max(0, math.ceil(percentile / 100 * count) - 1)] for percentile in PERCENTILES]
+        summary = {'count': count, 'sum': total, 'min': low, 'max': high, 'avg': total / count}
+        for percentile, value in zip(PERCENTILES, values):
+            summary[f'p{percentile}'] = value
+        return summary
+    
+    def __str__(self) -> str:
+        values = self[:10].data.tolist()
+        shown = ', '.join(f"{value:g}" for value in values)
+        return f"[{shown}, ... ({len(self)} values)]" if len(self) > 10 else f"[{shown}]"
+    
+    def __repr__(self) -> str:
+        return f"Vector({len(self)} values)"
+    
+    def __reduce__(self):
+        return (Vector, (array.array('d', self.data.tolist() if numpy is not None else self.data),))
+
+RECORD_FORMATS = ('csv', 'jsonl')
+
+def read_records(path: str, record_format: str, delimiter: str = ',', header: bool = True) -> Iterator[Any]:
+    """Stream the records of a CSV or JSON Lines file one at a time."""
+    if record_format == 'csv':
+        with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f, delimiter=delimiter) if header else csv.reader(f, delimiter=delimiter)
+            yield from reader
+        return
+        
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: {str(e)}") from None
+
+class RecordWriter:
+    """A buffered CSV or JSON Lines writer that stays open across write commands.
+    
+    Records are written into a large file buffer and reach the disk in batches.
+    A CSV file written from map records gets a header row taken from the keys
+    of the first record.
+    """
+    BUFFER_SIZE = 1 << 20
+    
+    def __init__(self, path: str, record_format: str, append: bool = False, delimiter: str = ','):
+        self.path = path
+        self.format = record_format
+        self.file = open(path, 'a' if append else 'w', newline='' if record_format == 'csv' else None,
+                         encoding='utf-8', buffering=self.BUFFER_SIZE)
+        self.writer = csv.writer(self.file, delimiter=delimiter) if record_format == 'csv' else None
+        self.fieldnames: Optional[List[str]] = None
+        self.records = 0
+        self.lock = threading.Lock()
+        
+    def write(self, record: Any) -> None:
+        """Write one record: a map, or a list of values for CSV."""
+        with self.lock:
+            if self.writer is None:
+                self.file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+            elif isinstance(record, dict):
+                if self.fieldnames is None:
+                    self.fieldnames = list(record)
+                    if self.file.tell() == 0:
+                        self.writer.writerow(self.fieldnames)
+                self.writer.writerow([record.get(name, '') for name in self.fieldnames])
+            else:
+                self.writer.writerow(record)
+            self.records += 1
+            
+    def close(self) -> None:
+        """Flush buffered records and close the file."""
+        with self.lock:
+            self.file.close()
+
+class SnapshotUnpickler(pickle.Unpickler):
+    """Unpickler that only reconstructs builtin and common standard library value types."""
+    
+    SAFE_GLOBALS = {
+        ('builtins', name) for name in
+        ('set', 'frozenset', 'bytearray', 'complex', 'range', 'slice', 'list', 'dict', 'tuple', 'bytes', 'str')
+    } | {
+        ('collections', 'OrderedDict'), ('collections', 'deque'), ('collections', 'defaultdict'),
+        ('datetime', 'datetime'), ('datetime', 'date'), ('datetime', 'time'), ('datetime', 'timedelta'),
+        ('datetime', 'timezone'), ('decimal', 'Decimal'), ('fractions', 'Fraction'),
+        ('array', 'array'), ('array', '_array_reconstructor'),
+    }
+    
+    def find_class(self, module: str, name: str) -> Any:
+        if (module, name) in self.SAFE_GLOBALS:
+            return super().find_class(module, name)
+        if name == 'Vector' and module in ('__main__', 'ws', __name__):
+            return Vector
+        raise pickle.UnpicklingError(f"type {module}.{name} is not allowed in snapshots")
+
+MODULE_CACHE: Dict[str, Tuple[Tuple[int, int], List[Any]]] = {}
+MODULE_CACHE_LOCK = threading.Lock()
+PARSE_CACHE_DIR = "__wscache__"
+PARSE_CACHE_MAGIC = b"WSPARSE"
+PARSE_CACHE_VERSION = 2
+
+def code_fingerprint(functions: List[Callable[..., Any]], *tables: Any) -> bytes:
+    """Digest the bytecode of functions, with the tables they depend on, to detect a changed parser."""
+    digest = hashlib.sha256(repr(tables).encode('utf-8'))
+    pending = [function.__code__ for function in functions]
+    while pending:
+        code = pending.pop()
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode('utf-8'))
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                pending.append(const)
+            elif isinstance(const, frozenset):
+                digest.update(repr(sorted(map(repr, const))).encode('utf-8'))
+            else:
+                digest.update(repr(const).encode('utf-8'))
+    return digest.digest()[:16]
+
+def parse_cache_path(path: str, digest: str) -> str:
+    """Return the on-disk parse cache file for a source file and content digest."""
+    return os.path.join(os.path.dirname(path), PARSE_CACHE_DIR, f"{os.path.basename(path)}.{digest[:16]}.wsc")
+
+def read_parse_cache(path: str, digest: str, parser: bytes) -> Optional[List[Any]]:
+    """Load parsed code from the on-disk parse cache, or return None if there is no entry written by this parser."""
+    try:
+        with open(parse_cache_path(path, digest), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    header = PARSE_CACHE_MAGIC + struct.pack('<H', PARSE_CACHE_VERSION) + parser
+    if not data.startswith(header):
+        return None
+    try:
+        return SnapshotUnpickler(io.BytesIO(data[len(header):])).load()
+    except Exception:
+        return None
+
+def write_parse_cache(path: str, digest: str, parser: bytes, parsed_code: List[Any]) -> None:
+    """Store parsed code in the on-disk parse cache, ignoring unwritable directories."""
+    cache_path = parse_cache_path(path, digest)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        payload = pickle.dumps(parsed_code, pickle.HIGHEST_PROTOCOL)
+        write_atomic(cache_path, PARSE_CACHE_MAGIC + struct.pack('<H', PARSE_CACHE_VERSION) + parser + payload)
+    except OSError:
+        pass
+
+PFOREACH_MODES = ("thread", "process")
+
+_pforeach_worker: Optional[Tuple[Any, List[Any], str, Dict[str, Any]]] = None
+
+def _pforeach_init(state: bytes) -> None:
+    """Set up a process pool worker with the definitions and loop body shipped once per worker."""
+    global _pforeach_worker
+    definitions, body, var_name, variables = pickle.loads(state)
+    interpreter = WSInterpreter()
+    interpreter.functions, interpreter.compiled_functions = definitions['functions'], definitions['compiled_functions']
+    interpreter.function_params, interpreter.function_scopes = definitions['function_params'], definitions['function_scopes']
+    _pforeach_worker = (interpreter, body, var_name, variables)
+
+def _pforeach_task(item: Any) -> Tuple[Any, List[str], str]:
+    """Run the loop body for one item in a process pool worker, capturing what it prints."""
+    interpreter, body, var_name, variables = _pforeach_worker
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result, errors = interpreter.run_iteration(body, variables, var_name, item)
+    try:
+        pickle.dumps(result)
+    except Exception:
+        result = str(result)
+    return result, errors, output.getvalue()
+
+# Bounds on values built by expressions, so that a script cannot exhaust memory or
+# hang the interpreter with an expression such as 9 ** 9 ** 9 or "x" * 10 ** 12.
+MAX_EXPRESSION_INT_BITS = 1 << 17
+MAX_EXPRESSION_LENGTH = 1 << 24
+SEQUENCE_TYPES = (str, bytes, bytearray, list, tuple)
+
+def _bounded_length(length: int) -> None:
+    if length > MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"result too large ({length} items, the limit is {MAX_EXPRESSION_LENGTH})")
+
+def _bounded_bits(bits: int) -> None:
+    if bits > MAX_EXPRESSION_INT_BITS:
+        raise ValueError(f"integer result too large (about {bits} bits, the limit is {MAX_EXPRESSION_INT_BITS})")
+
+def _is_int(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def bounded_add(left: Any, right: Any) -> Any:
+    """Add or concatenate, refusing sequences longer than MAX_EXPRESSION_LENGTH."""
+    if isinstance(left, SEQUENCE_TYPES) and isinstance(right, SEQUENCE_TYPES):
+        _bounded_length(len(left) + len(right))
+    return left + right
+
+def bounded_mul(left: Any, right: Any) -> Any:
+    """Multiply or repeat a sequence, refusing results beyond the expression limits."""
+    if isinstance(left, SEQUENCE_TYPES) and _is_int(right):
+        _bounded_length(len(left) * max(right, 0))
+    elif isinstance(right, SEQUENCE_TYPES) and _is_int(left):
+        _bounded_length(len(right) * max(left, 0))
+    elif _is_int(left) and _is_int(right):
+        _bounded_bits(left.bit_length() + right.bit_length())
+    return left * right
+
+def bounded_pow(base: Any, exponent: Any) -> Any:
+    """Raise to a power, refusing integer results larger than MAX_EXPRESSION_INT_BITS."""
+    if _is_int(base) and _is_int(exponent) and exponent > 0 and abs(base) > 1:
+        _bounded_bits((base.bit_length() - 1) * exponent)
+    return base ** exponent
+
+def bounded_lshift(value: Any, shift: Any) -> Any:
+    """Shift left, refusing integer results larger than MAX_EXPRESSION_INT_BITS."""
+    if _is_int(value) and _is_int(shift) and value and shift > 0:
+        _bounded_bits(value.bit_length() + shift)
+    return value << shift
+
+FORMAT_FIELD_SIZES = re.compile(r'%[-+ #0]*(\d*)(?:\.(\d*))?')
+
+def bounded_mod(left: Any, right: Any) -> Any:
+    """Modulo or %-formatting, refusing format fields wider than MAX_EXPRESSION_LENGTH."""
+    if isinstance(left, (str, bytes)):
+        text = left if isinstance(left, str) else left.decode('latin-1')
+        for width, precision in FORMAT_FIELD_SIZES.findall(text):
+            _bounded_length(max(int(width or 0), int(precision or 0)))
+    return left % right
+
+def bounded_bytes(source: Any = b"", *args: Any) -> bytes:
+    """bytes() that refuses to allocate more than MAX_EXPRESSION_LENGTH zero bytes."""
+    if _is_int(source):
+        _bounded_length(source)
+    return bytes(source, *args)
+
+class ExpressionEvaluator:
+    """Restricted evaluator for WS arithmetic, comparison, boolean and string expressions.
+    
+    Expressions are parsed with the Python grammar, checked against a whitelist
+    of node types and compiled into closures that read variables from a plain
+    dictionary. Compiled expressions are cached by source text. Attribute
+    syntax only reads fields of map values (`row.name`); other attribute
+    access, calls to anything but a few pure builtins, comprehensions and
+    lambdas are rejected; arbitrary Python is only available through `exec`.
+    """
+    
+    BINARY_OPERATORS = {
+        ast.Add: bounded_add, ast.Sub: operator.sub, ast.Mult: bounded_mul,
+        ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: bounded_mod,
+        ast.Pow: bounded_pow, ast.LShift: bounded_lshift, ast.RShift: operator.rshift,
+        ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.BitXor: operator.xor,
+    }
+    UNARY_OPERATORS = {
+        ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_, ast.Invert: operator.invert,
+    }
+    COMPARE_OPERATORS = {
+        ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+        ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Is: operator.is_, ast.IsNot: operator.is_not,
+        ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+    }
+    SAFE_FUNCTIONS = {
+        'len': len, 'int': int, 'float': float, 'str': str, 'bool': bool,
+        'abs': abs, 'min': min, 'max': max, 'round': round, 'bytes': bounded_bytes, 'hex': buffer_hex,
+        'find': buffer_find, 'crc32': lambda data: buffer_hash(data, 'crc32'),
+        'md5': lambda data: buffer_hash(data, 'md5'), 'sha256': lambda data: buffer_hash(data, 'sha256'),
+        'vector': lambda values=(): Vector(values),
+    }
+    MAX_CACHE_SIZE = 4096
+    
+    def __init__(self):
+        self._cache: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+        
+    def evaluate(self, expression: str, variables: Dict[str, Any]) -> Any:
+        """Evaluate an expression against a variable dictionary."""
+        return self.compile(expression)(variables)
+    
+    def compile(self, expression: str) -> Callable[[Dict[str, Any]], Any]:
+        """Compile an expression into a closure taking the variable dictionary."""
+        compiled = self._cache.get(expression)
+        if compiled is not None:
+            return compiled
+            
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+            compiled = self._compile_node(tree.body)
+        except (SyntaxError, ValueError) as e:
+            error_type, error_args = type(e), e.args
+            
+            def compiled(variables):
+                raise error_type(*error_args)
+                
+        if len(self._cache) >= self.MAX_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[expression] = compiled
+        return compiled
+    
+    def _compile_node(self, node: ast.AST) -> Callable[[Dict[str, Any]], Any]:
+        """Compile a single whitelisted AST node."""
+        if isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float, complex, str, bytes, type(None))):
+                raise ValueError(f"Unsupported literal: {node.value!r}")
+            value = node.value
+            return lambda variables: value
+            
+        if isinstance(node, ast.Name):
+            return self._compile_name(node.id)
+            
+        if isinstance(node, ast.BinOp):
+            op = self.BINARY_OPERATORS.get(type(node.op))
+            if op is None:
+                raise ValueError(f"Unsupported operator: {type(node.op).__name__}")
+            return self._compile_binary(op, node.left, node.right)
+            
+        if isinstance(node, ast.UnaryOp):
+            op = self.UNARY_OPERATORS[type(node.op)]
+            operand = self._compile_node(node.operand)
+            return lambda variables: op(operand(variables))
+            
+        if isinstance(node, ast.BoolOp):
+            values = [self._compile_node(value) for value in node.values]
+            if isinstance(node.op, ast.And):
+                def boolean_and(variables):
+                    result = True
+                    for value in values:
+                        result = value(variables)
+                        if not result:
+                            return result
+                    return result
+                return boolean_and
+                
+            def boolean_or(variables):
+                result = False
+                for value in values:
+                    result = value(variables)
+                    if result:
+                        return result
+                return result
+            return boolean_or
+            
+        if isinstance(node, ast.Compare):
+            ops = [self.COMPARE_OPERATORS[type(op)] for op in node.ops]
+            if len(ops) == 1:
+                return self._compile_binary(ops[0], node.left, node.comparators[0])
+                
+            operands = [self._compile_node(node.left)] + [self._compile_node(c) for c in node.comparators]
+            
+            def chained_compare(variables):
+                left = operands[0](variables)
+                for op, operand in zip(ops, operands[1:]):
+                    right = operand(variables)
+                    if not op(left, right):
+                        return False
+                    left = right
+                return True
+            return chained_compare
+            
+        if isinstance(node, ast.IfExp):
+            test, body, orelse = (self._compile_node(n) for n in (node.test, node.body, node.orelse))
+            return lambda variables: body(variables) if test(variables) else orelse(variables)
+            
+        if isinstance(node, ast.Subscript):
+            value = self._compile_node(node.value)
+            index = self._compile_node(node.slice)
+            return lambda variables: value(variables)[index(variables)]
+            
+        if isinstance(node, ast.Attribute):
+            value, field = self._compile_node(node.value), node.attr
+            
+            def field_access(variables):
+                record = value(variables)
+                if not isinstance(record, dict):
+                    raise TypeError(f"'{type(record).__name__}' value has no field '{field}'")
+                try:
+                    return record[field]
+                except KeyError:
+                    raise KeyError(f"Field not found: {field}") from None
+            return field_access
+            
+        if isinstance(node, ast.Slice):
+            parts = [self._compile_node(n) if n is not None else (lambda variables: None)
+                     for n in (node.lower, node.upper, node.step)]
+            return lambda variables: slice(*(part(variables) for part in parts))
+            
+        if isinstance(node, (ast.List, ast.Tuple)):
+            items = [self._compile_node(item) for item in node.elts]
+            container = list if isinstance(node, ast.List) else tuple
+            return lambda variables: container(item(variables) for item in items)
+            
+        if isinstance(node, ast.Call):
+            if (not isinstance(node.func, ast.Name) or node.func.id not in self.SAFE_FUNCTIONS
+                    or node.keywords or any(isinstance(arg, ast.Starred) for arg in node.args)):
+                raise ValueError("Function calls are not allowed in expressions (use exec)")
+            function = self.SAFE_FUNCTIONS[node.func.id]
+            args = [self._compile_node(arg) for arg in node.args]
+            return lambda variables: function(*(arg(variables) for arg in args))
+            
+        raise ValueError(f"Unsupported expression element: {type(node).__name__}")
+    
+    def _compile_name(self, name: str) -> Callable[[Dict[str, Any]], Any]:
+        """Compile a variable lookup."""
+        def load(variables):
+            try:
+                return variables[name]
+            except KeyError:
+                raise NameError(f"name '{name}' is not defined") from None
+        return load
+    
+    def _compile_binary(self, op: Callable[[Any, Any], Any], left: ast.AST, right: ast.AST) -> Callable[[Dict[str, Any]], Any]:
+        """Compile a binary operation, with fast paths for variable and literal operands."""
+        if isinstance(left, ast.Name) and isinstance(right, ast.Constant) and isinstance(right.value, (int, float)):
+            name, constant = left.id, right.value
+            
+            def name_constant(variables):
+                try:
+                    return op(variables[name], constant)
+                except KeyError:
+                    raise NameError(f"name '{name}' is not defined") from None
+            return name_constant
+            
+        if isinstance(left, ast.Name) and isinstance(right, ast.Name):
+            left_name, right_name = left.id, right.id
+            
+            def name_name(variables):
+                try:
+                    return op(variables[left_name], variables[right_name])
+                except KeyError as e:
+                    raise NameError(f"name '{e.args[0]}' is not defined") from None
+            return name_name
+            
+        left_value, right_value = self._compile_node(left), self._compile_node(right)
+        return lambda variables: op(left_value(variables), right_value(variables))
+
+class ExecutionContext:
+    """Mutable state of a single WS run.
+    
+    Parsed scripts and function definitions belong to the interpreter and are
+    shared; variables and control-flow bookkeeping belong to a context, so one
+    interpreter can serve several runs at once, one context per run.
+    """
+    
+    def __init__(self, variables: Optional[Dict[str, Any]] = None):
+        self.variables: Dict[str, Any] = dict(variables or {})
+        self.current_function_scope: Optional[str] = None
+        self.last_result: Any = None
+        self.in_else_block = False
+        self.last_condition_result = False
+        self.module_namespace: Optional[str] = None
+        self.import_stack: List[str] = []
+        self.call_depth = 0
+        self.errors: deque = deque(maxlen=100)
+        self.frames: Optional[List['ExecutionFrame']] = None
+
+class CallDepthError(Exception):
+    """Raised when WS function calls nest deeper than the interpreter's max_call_depth."""
+
+UNSET = object()
+
+class ExecutionFrame:
+    """One entry of the executor's explicit stack: a statement list and how to leave it.
+    
+    `kind` is None for a plain block, 'if' for the taken branch of an if, 'while'
+    for a loop body (re-entered while `test` holds) and 'call' for a function
+    body, where `scope` is the caller's function scope to restore, `saved` holds
+    the caller's values of the parameter names (UNSET if they had none) and
+    `cache` receives the result of a cached function under `cache_key`.
+    """
+    __slots__ = ('code', 'index', 'result', 'kind', 'test', 'iteration', 'scope', 'saved', 'cache', 'cache_key')
+    
+    def __init__(self, code: List[Any], kind: Optional[str] = None,
+                 test: Optional[Callable[[Dict[str, Any]], Any]] = None, scope: Optional[str] = None):
+        self.code = code
+        self.index = 0
+        self.result = None
+        self.kind = kind
+        self.test = test
+        self.iteration = 1
+        self.scope = scope
+        self.saved: Dict[str, Any] = {}
+        self.cache: Optional[FunctionCache] = None
+        self.cache_key: Optional[Tuple[Any, ...]] = None
+
+class ContextAttribute:
+    """Interpreter attribute stored on the execution context active in the calling thread."""
+    
+    def __init__(self, name: str):
+        self.name = name
+        
+    def __get__(self, interpreter, owner=None):
+        if interpreter is None:
+            return self
+        return getattr(interpreter.context, self.name)
+        
+    def __set__(self, interpreter, value):
+        setattr(interpreter.context, self.name, value)
+
 class WSInterpreter:
-    def __init__(self, debug=False):
-        self.variables: Dict[str, Any] = {}
+    variables = ContextAttribute('variables')
+    current_function_scope = ContextAttribute('current_function_scope')
+    last_result = ContextAttribute('last_result')
+    _in_else_block = ContextAttribute('in_else_block')
+    _last_condition_result = ContextAttribute('last_condition_result')
+    _module_namespace = ContextAttribute('module_namespace')
+    _import_stack = ContextAttribute('import_stack')
+    
+    def __init__(self, debug=False, max_concurrency=1, max_call_depth=DEFAULT_MAX_CALL_DEPTH):
+        self.default_context = ExecutionContext()
+        self._local = threading.local()
+        self._definitions_lock = threading.RLock()
+        self.compiled_scripts: Dict[str, List[Union[List[str], List[List[str]]]]] = {}
         self.functions: Dict[str, List[str]] = {}
         self.function_scopes: Dict[str, Set[str]] = {}  
-        self.current_function_scope = None
+        self.compiled_functions: Dict[str, List[Union[List[str], List[List[str]]]]] = {}
+        self.function_params: Dict[str, List[str]] = {}
+        self.function_caches: Dict[str, FunctionCache] = {}
+        self.imported_modules: Dict[str, str] = {}
+        self.search_paths: List[str] = []
         self.debug = debug
-        self.last_result = None
+        self.max_call_depth = max_call_depth
+        self._block_cache: Dict[int, Tuple[List[str], Any]] = {}
+        self._parser_digest: Optional[bytes] = None
+        self._body_cache: Dict[Tuple[str, ...], List[Any]] = {}
+        self.evaluator = ExpressionEvaluator()
+        self.scheduler = Scheduler(self._execute_scheduled, max_concurrency)
+        self.output_tail_lines = 20
+        self.run_mode = "shell"
+        self.shell_session: Optional[ShellSession] = None
+        self.session_timeout: Optional[float] = None
+        self.record_writers: Dict[str, RecordWriter] = {}
+        self.process_sampler = ProcessSampler()
+        self.command_cache = CommandCache()
+        self.checkpoint_path: Optional[str] = None
+        self.checkpoint_saved = False
+        self.typer = TextTyper()
+        self.image_matcher = ImageMatcher()
         self.commands = {
             'run': self.run_command,
             'exec': self.exec_python,
             'print': self.print_output,
             'wait': self.wait_time,
             'click': self.mouse_click,
+            'screen': self.screen_operations,
             'type': self.keyboard_type,
             'window': self.window_operations,
+            'shell': self.shell_operations,
+            'import': self.import_module,
+            'snapshot': self.snapshot_operations,
             'registry': self.registry_operations,
             'process': self.process_operations,
             'file': self.file_operations,
+            'csv': self.csv_operations,
+            'jsonl': self.jsonl_operations,
+            'buffer': self.buffer_operations,
+            'vector': self.vector_operations,
+            'cache': self.cache_operations,
             'if': self.conditional,
             'else': self.else_block,
             'while': self.while_loop,
+            'foreach': self.foreach_loop,
+            'pforeach': self.pforeach_loop,
             'function': self.define_function,
+            'every': self.every_block,
+            'at': self.at_block,
             'call': self.call_function,
             'set': self.set_variable,
             'get': self.get_variable,
             'list': self.list_command,
             'help': self.help_command,
         }
-        self._in_else_block = False
-        self._last_condition_result = False
+        self.block_handlers = {
+            'if': self.conditional,
+            'else': self.else_block,
+            'while': self.while_loop,
+            'foreach': self.foreach_loop,
+            'pforeach': self.pforeach_loop,
+            'function': self.define_function,
+            'every': self.every_block,
+            'at': self.at_block,
+            'csv': self.record_loop,
+            'jsonl': self.record_loop,
+        }
         self._capture_output = True 
 
+    @property
+    def context(self) -> ExecutionContext:
+        """Return the execution context of the run active in this thread."""
+        return getattr(self._local, 'context', None) or self.default_context
+
+    def compile(self, code: str) -> List[Union[List[str], List[List[str]]]]:
+        """Parse a script once and share the parsed code between runs."""
+        parsed_code = self.compiled_scripts.get(code)
+        if parsed_code is None:
+            parsed_code = self.parse(code)
+            with self._definitions_lock:
+                self.compiled_scripts.setdefault(code, parsed_code)
+        return parsed_code
+
+    def run(self, code: Union[str, List[Union[List[str], List[List[str]]]]],
+            variables: Optional[Dict[str, Any]] = None, context: Optional[ExecutionContext] = None) -> ExecutionContext:
+        """Execute a script in a fresh execution context, or the given one, and return that context.
+        
+        Runs may be started from several threads at once; each sees its own
+        variables while sharing the interpreter's parsed code and functions.
+        """
+        parsed_code = self.compile(code) if isinstance(code, str) else code
+        context = context or ExecutionContext(variables)
+        previous = getattr(self._local, 'context', None)
+        self._local.context = context
+        try:
+            context.last_result = self.execute(parsed_code)
+        finally:
+            self._local.context = previous
+        return context
+
+    def _opens_block(self, line: str) -> bool:
+        """Check whether a line starts a block that is closed by 'end'."""
+        if any(line.startswith(cmd) for cmd in ['if', 'while', 'function']):
+            return True
+        words = line.split(maxsplit=2)
+        if words and words[0] in RECORD_FORMATS:
+            return words[1:2] == ['each']
+        return bool(words) and words[0] != 'else' and words[0] in self.block_handlers
+
     def parse(self, code: str) -> List[Union[List[str], List[List[str]]]]:
         """Parse WS code into executable commands."""
+        parsed_lines = []
+        for block_type, segment in self._top_level_segments(code):
+            if block_type:
+                parsed_lines.append([block_type, segment])
+            else:
+                parsed = self._parse_statement(segment)
+                if parsed:
+                    parsed_lines.append(parsed)
+        return parsed_lines
+
+    def _parse_statement(self, line: str) -> Optional[List[str]]:
+        """Tokenize a top-level statement line, reporting lines that cannot be parsed."""
+        comment_pos = line.find('#')
+        if comment_pos > 0:
+            line = line[:comment_pos].strip()
+        try:
+            return self._tokenize(line) or None
+        except Exception as e:
+            print(f"Error parsing line: {line}")
+            print(f"Error details: {str(e)}")
+            return None
+
+    def _top_level_segments(self, code: str) -> Iterator[Tuple[Optional[str], Any]]:
+        """Split WS code into (block_type, block_lines) and (None, line) top-level segments."""
         if not code.strip():
-            return []
+            return
             
         lines = code.strip().split('\n')
-        parsed_lines = []
         
         i = 0
         while i < len(lines):
@@ -84,13 +2413,13 @@ class WSInterpreter:
                 i += 1
                 continue
     
-            if any(line.startswith(cmd) for cmd in ['if', 'while', 'function', 'else']):
+            if self._opens_block(line) or line.startswith('else'):
                 block_type = line.split()[0]  
                 block = [line]
                 i += 1
                 
                 if block_type == 'else':
-                    parsed_lines.append([block_type, block])
+                    yield block_type, block
                     continue
                 
                 depth = 1
@@ -98,14 +2427,13 @@ class WSInterpreter:
                 while i < len(lines) and depth > 0:
                     current_line = lines[i].strip()
                     
-       
                     if not current_line or current_line.startswith('#'):
                         i += 1
                         continue
                     
                     if current_line.startswith('end'):
                         depth -= 1
-                    elif any(current_line.startswith(cmd) for cmd in ['if', 'while', 'function']):
+                    elif self._opens_block(current_line):
                         depth += 1
                     
                     block.append(current_line)
@@ -113,90 +2441,482 @@ class WSInterpreter:
                     if depth == 0:
                         break
                         
-         
-                parsed_lines.append([block_type, block])
+                yield block_type, block
             else:
-          
-                comment_pos = line.find('#')
-                if comment_pos > 0:
-                    line = line[:comment_pos].strip()
+                yield None, line
+                i += 1
+
+    def optimize(self, parsed_code: List[Union[List[str], List[List[str]]]]) -> List[Union[List[str], List[List[str]]]]:
+        """Fold constants and remove dead branches from parsed WS code."""
+        return WSOptimizer(self).optimize(parsed_code)
+
+    def execute(self, parsed_code: List[Union[List[str], List[List[str]]]]) -> Any:
+        """Execute parsed WS code.
+        
+        if, while and call push frames on an explicit stack instead of recursing,
+        so WS recursion depth is limited by max_call_depth rather than by the
+        Python stack.
+        """
+        return self._run_frames([ExecutionFrame(parsed_code)])
+
+    def _run_frames(self, stack: List[ExecutionFrame]) -> Any:
+        """Run the executor loop over a stack of frames until it is empty; return the root frame's result."""
+        context = self.context
+        root = stack[0]
+        outermost = context.frames is None
+        if outermost:
+            context.frames = stack
+        try:
+            while stack:
+                frame = stack[-1]
+                if frame.index >= len(frame.code):
+                    if self._leave_frame(frame, context):
+                        continue
+                    stack.pop()
+                    if stack:
+                        stack[-1].result = frame.result
+                    continue
                 
+                command = frame.code[frame.index]
+                frame.index += 1
+                if not command:
+                    continue
+            
                 try:
-                
-                    tokens = re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")++', line)
-                    tokens = [token.strip('"') if token.startswith('"') and token.endswith('"') else token for token in tokens]
-                    if tokens: 
-                        parsed_lines.append(tokens)
+                    keyword = command[0]
+                    if keyword == 'call':
+                        call = self._enter_call(command[1:], context)
+                        if isinstance(call, ExecutionFrame):
+                            stack.append(call)
+                        else:
+                            frame.result = call
+                    elif keyword == 'checkpoint':
+                        frame.result = self.save_checkpoint(command[1:], stack if stack is context.frames else None)
+                    elif keyword == 'if' and len(command) >= 2:
+                        branch = self._enter_if(command[1])
+                        if isinstance(branch, ExecutionFrame):
+                            stack.append(branch)
+                        else:
+                            frame.result = branch
+                    elif keyword == 'while' and len(command) >= 2:
+                        loop = self._enter_while(command[1])
+                        if isinstance(loop, ExecutionFrame):
+                            stack.append(loop)
+                        else:
+                            frame.result = loop
+                    elif len(command) == 2 and isinstance(command[1], list) and keyword in self.block_handlers:
+                        frame.result = self.block_handlers[keyword](command[1])
+                    elif isinstance(keyword, str) and keyword in self.commands:
+                        if keyword == 'print' and len(command) > 2 and command[1] == 'file' and command[2] == 'read':
+                            file_path = command[3]
+                            try:
+                                with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+                                    content = f.read()
+                                    self.print_output([content])
+                                    frame.result = content
+                            except Exception as e:
+                                error_msg = f"Error reading file: {str(e)}"
+                                print(error_msg)
+                                frame.result = error_msg
+                        else:
+                            frame.result = self.commands[keyword](command[1:])
+                    
+                        if keyword == 'set' and len(command) > 2 and command[2] == 'exec':
+                            var_name = command[1]
+                            exec_result = frame.result
+                            self.variables[var_name] = exec_result
+                    else:
+                        print(f"Unknown command: {command[0]}")
+                except CallDepthError as e:
+                    while any(unwound.kind == 'call' for unwound in stack):
+                        unwound = stack.pop()
+                        if unwound.kind == 'call':
+                            self._leave_call(unwound, context)
+                    if context.call_depth:
+                        raise
+                    stack[-1].result = f"Error: {str(e)}"
+                    print(stack[-1].result)
                 except Exception as e:
-                    print(f"Error parsing line: {line}")
-                    print(f"Error details: {str(e)}")
+                    print(f"Error executing command {command}: {str(e)}")
+                    context.errors.append(str(e))
+                    if self.debug:
+                        import traceback
+                        traceback.print_exc()
+        finally:
+            if outermost:
+                context.frames = None
+        
+        self.last_result = root.result
+        return root.result
+
+    def _leave_frame(self, frame: ExecutionFrame, context: ExecutionContext) -> bool:
+        """Finish a frame whose statements have run; return True when a loop starts another iteration."""
+        if frame.kind == 'while':
+            try:
+                if frame.test(context.variables) and frame.iteration < MAX_LOOP_ITERATIONS:
+                    frame.index = 0
+                    frame.iteration += 1
+                    frame.result = None
+                    return True
+            except Exception as e:
+                frame.result = f"Error in while loop: {str(e)}"
+                context.errors.append(frame.result)
+                return False
+            if frame.iteration >= MAX_LOOP_ITERATIONS:
+                print("Warning: Maximum loop iterations reached (possible infinite loop)")
+        elif frame.kind == 'call':
+            if frame.cache is not None:
+                frame.cache.put(frame.cache_key, frame.result)
+            self._leave_call(frame, context)
+        elif frame.kind == 'if':
+            context.in_else_block = False
+        return False
+
+    def _leave_call(self, frame: ExecutionFrame, context: ExecutionContext) -> None:
+        """Return to the caller of a function frame, restoring its scope and the variables the parameters shadowed."""
+        for name, value in frame.saved.items():
+            if value is UNSET:
+                context.variables.pop(name, None)
+            else:
+                context.variables[name] = value
+        context.current_function_scope = frame.scope
+        context.call_depth -= 1
+
+    def _compiled_block(self, block: List[str]) -> Any:
+        """Return the parsed form of an if or while block, parsing each block only once."""
+        cached = self._block_cache.get(id(block))
+        if cached is not None and cached[0] is block:
+            return cached[1]
+            
+        if block[0].startswith('if '):
+            condition, body, else_body = self._split_if_block(block)
+            compiled = (condition, self._parse_block_body(body), self._parse_block_body(else_body) if else_body else None)
+        else:
+            compiled = (block[0][6:], self._parse_block_body(block[1:-1] if block[-1] == 'end' else block[1:]))
+            
+        if len(self._block_cache) >= ExpressionEvaluator.MAX_CACHE_SIZE:
+            self._block_cache.clear()
+        self._block_cache[id(block)] = (block, compiled)
+        return compiled
+
+    def _enter_if(self, block: List[str]) -> Any:
+        """Evaluate an if condition and return the frame of the branch to run, or the statement result."""
+        if not block:
+            return None
+        if not block[0].startswith('if '):
+            return f"Invalid if statement: {block[0]}"
+            
+        condition, body, else_body = self._compiled_block(block)
+        try:
+            condition_met = self.evaluator.evaluate(condition, self.variables)
+        except Exception as e:
+            self._last_condition_result = False
+            self.context.errors.append(f"Error in condition: {str(e)}")
+            return self.context.errors[-1]
+            
+        self._last_condition_result = condition_met
+        if condition_met:
+            return ExecutionFrame(body, 'if')
+        if else_body:
+            return ExecutionFrame(else_body)
+        self._in_else_block = True
+        return None
+
+    def _enter_while(self, block: List[str]) -> Any:
+        """Evaluate a while condition and return the frame of the loop body, or the statement result."""
+        if not block:
+            return None
+        if not block[0].startswith('while '):
+            return f"Invalid while statement: {block[0]}"
+            
+        condition, body = self._compiled_block(block)
+        try:
+            test = self.evaluator.compile(condition)
+            if not test(self.variables):
+                return None
+        except Exception as e:
+            self.context.errors.append(f"Error in while loop: {str(e)}")
+            return self.context.errors[-1]
+        return ExecutionFrame(body, 'while', test=test)
+
+    def _enter_call(self, args: List[str], context: ExecutionContext) -> Any:
+        """Return the frame of a function body, switching to the function's scope, or an error message."""
+        if not args:
+            return "Error: No function name specified"
+            
+        func_name = self._qualify_function_name(args[0])
+        
+        if func_name not in self.functions:
+            error_msg = f"Function '{func_name}' not defined"
+            print(error_msg)
+            context.errors.append(error_msg)
+            return error_msg
+        
+        for parent_scope, nested_funcs in list(self.function_scopes.items()):
+            if func_name in nested_funcs and context.current_function_scope != parent_scope:
+                error_msg = f"Function '{func_name}' not defined"
+                print(error_msg)
+                context.errors.append(error_msg)
+                return error_msg
                 
-                i += 1
+        params = self.function_params.get(func_name, [])
+        if len(args) - 1 < len(params):
+            missing = ', '.join(params[len(args) - 1:])
+            error_msg = f"Error: Function '{func_name}' missing argument(s): {missing}"
+            print(error_msg)
+            context.errors.append(error_msg)
+            return error_msg
+        values = [self._token_value(arg) for arg in args[1:len(params) + 1]]
+        cache, cache_key = self.function_caches.get(func_name), tuple(values)
+        if cache is not None:
+            try:
+                hit, value = cache.get(cache_key)
+            except TypeError:
+                cache = None
+            else:
+                if hit:
+                    return value
                 
-        return parsed_lines
-
-    def execute(self, parsed_code: List[Union[List[str], List[List[str]]]]) -> Any:
-        """Execute parsed WS code."""
-        result = None
+        if context.call_depth >= self.max_call_depth:
+            raise CallDepthError(f"Maximum call depth of {self.max_call_depth} exceeded calling '{func_name}'")
         
-        for command in parsed_code:
-            if not command:
-                continue
+        compiled = self.compiled_functions.get(func_name)
+        if compiled is None:
+            compiled = self.compiled_functions[func_name] = self._parse_block_body(self.functions[func_name])
+            
+        frame = ExecutionFrame(compiled, 'call', scope=context.current_function_scope)
+        for param, value in zip(params, values):
+            frame.saved.setdefault(param, context.variables.get(param, UNSET))
+            context.variables[param] = value
+        frame.cache, frame.cache_key = cache, cache_key
+        context.current_function_scope = func_name
+        context.call_depth += 1
+        return frame
+
+    def run_command(self, args: List[str]) -> str:
+        """Run a Windows command."""
+        if not args:
+            return "Error: No command specified"
+            
+        mode, args = self._split_run_mode(args)
+            
+        if args[0] == "cached" and len(args) > 1:
+            return self._cached_command(args[1:], mode)
+            
+        if mode == "session":
+            return self._session_command(args)
+            
+        if args[0] == "stream" and len(args) > 1:
+            return self._stream_command(self._command_for_mode(args[1:], mode))
+            
+        if len(args) > 2 and args[-2] in ('>', '>>'):
+            return self._redirect_command(self._command_for_mode(args[:-2], mode), args[-1],
+                                          append=args[-2] == '>>')
             
+        cmd = self._command_for_mode(args, mode)
+        try:
+            result = subprocess.run(cmd, shell=mode == "shell", capture_output=True, text=True)
+            if result.returncode != 0 and result.stderr:
+                return f"Command error: {result.stderr}"
+            return result.stdout
+        except Exception as e:
+            return f"Error executing command: {str(e)}"
+
+    def _split_run_mode(self, args: List[str]) -> Tuple[str, List[str]]:
+        """Split an explicit shell/argv/session prefix from run arguments, defaulting to the shell mode setting."""
+        if args[0] in RUN_MODES and len(args) > 1:
+            return args[0], args[1:]
+        return self.run_mode, args
+
+    def _run_lines(self, args: List[str]) -> Union['CommandStream', List[str], str]:
+        """Return the output of a run command for foreach, dispatched like run itself.
+        
+        Shell and argv commands return a CommandStream whose lines arrive as they
+        are produced; session and cached commands return their collected lines.
+        Errors are returned as a message.
+        """
+        mode, args = self._split_run_mode(args)
+        if args[0] == "stream" and len(args) > 1:
+            args = args[1:]
+        if args[0] == "cached" and len(args) > 1:
+            result = self._cached_command(args[1:], mode)
+            return result if result.startswith(("Error", "Command error")) else result.splitlines()
+        if mode == "session":
+            result = self._run_in_session(args)
+            if isinstance(result, str):
+                return result
+            code, output = result
+            return self._session_error(code) if code != 0 else output.splitlines()
+        return CommandStream(self._command_for_mode(args, mode), self.output_tail_lines)
+
+    def _cached_command(self, args: List[str], mode: str) -> str:
+        """Run a command through the command cache: run cached [ttl=60s] [env=A,B] [inputs=f1,f2] <cmd>.
+        
+        ttl is the maximum age of a reused result; the key covers the
+        command, working directory, the listed environment variables (PATH by
+        default) and the size and modification time of the input files.
+        """
+        options = {}
+        while args and args[0].partition('=')[0] in RUN_CACHE_OPTIONS and '=' in args[0]:
+            name, _, value = args.pop(0).partition('=')
+            options[name] = value
+        if args and args[0] in RUN_MODES and len(args) > 1:
+            mode, args = args[0], args[1:]
+        if not args:
+            return "Error: No command specified"
+        if mode == "session" or args[0] == "stream" or (len(args) > 2 and args[-2] in ('>', '>>')):
+            return "Error: run cached only supports plain shell and argv commands"
+        try:
+            ttl = parse_duration(options.get('ttl', str(DEFAULT_RUN_CACHE_TTL)))
+        except ValueError as e:
+            return f"Error: {str(e)}"
+        env_names = options['env'].split(',') if options.get('env') else DEFAULT_RUN_CACHE_ENV
+        inputs = [path for path in options.get('inputs', '').split(',') if path]
+        
+        cmd = self._command_for_mode(args, mode)
+        key = self.command_cache.key(cmd, os.getcwd(), {name: os.environ.get(name) for name in env_names}, inputs)
+        entry = self.command_cache.get(key, ttl)
+        if self.debug:
+            print(f"[run cache] {'hit' if entry else 'miss'}: {join_command(args)} ({self.command_cache.stats()})")
+        if entry is None:
             try:
-                if len(command) >= 2 and command[0] in ['if', 'while', 'function', 'else']:
-                    block_type = command[0]
-                    block_content = command[1]
-                    
-                    if block_type == 'if':
-                        result = self.conditional(block_content)
-                    elif block_type == 'else':
-                        result = self.else_block(block_content)
-                    elif block_type == 'while':
-                        result = self.while_loop(block_content)
-                    elif block_type == 'function':
-                        result = self.define_function(block_content)
-                elif isinstance(command[0], str) and command[0] in self.commands:
-                    if command[0] == 'print' and len(command) > 2 and command[1] == 'file' and command[2] == 'read':
-                        file_path = command[3]
-                        try:
-                            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-                                content = f.read()
-                                self.print_output([content])
-                                result = content
-                        except Exception as e:
-                            error_msg = f"Error reading file: {str(e)}"
-                            print(error_msg)
-                            result = error_msg
-                    else:
-                        result = self.commands[command[0]](command[1:])
-                    
-                    if command[0] == 'set' and len(command) > 2 and command[2] == 'exec':
-                        var_name = command[1]
-                        exec_result = result
-                        self.variables[var_name] = exec_result
-                else:
-                    print(f"Unknown command: {command[0]}")
+                result = subprocess.run(cmd, shell=mode == "shell", capture_output=True, text=True)
             except Exception as e:
-                print(f"Error executing command {command}: {str(e)}")
-                if self.debug:
-                    import traceback
-                    traceback.print_exc()
+                return f"Error executing command: {str(e)}"
+            entry = self.command_cache.put(key, result.stdout, result.stderr, result.returncode)
+        if entry['returncode'] != 0 and entry['stderr']:
+            return f"Command error: {entry['stderr']}"
+        return entry['stdout']
+
+    def _command_for_mode(self, args: List[str], mode: str) -> Union[str, List[str]]:
+        """Build a shell command line, or keep the tokens as an argv for shell-free execution."""
+        return list(args) if mode == "argv" else join_command(args)
+
+    def _session_command(self, args: List[str]) -> str:
+        """Run a command in the persistent shell session, opening it on first use."""
+        on_line = None
+        if args[0] == "stream" and len(args) > 1:
+            args = args[1:]
+            on_line = lambda line: print(line, flush=True)
+            
+        result = self._run_in_session(args, on_line)
+        if isinstance(result, str):
+            return result
+        code, output = result
+        if code != 0:
+            return self._session_error(code)
+        return "" if on_line else output
+
+    def _run_in_session(self, args: List[str], on_line: Optional[Callable[[str], Any]] = None) -> Union[Tuple[int, str], str]:
+        """Run a command in the shell session, opening it on first use; return (exit code, output) or an error.
         
-        self.last_result = result
-        return result
+        A leading timeout=<duration> limits how long this command may stay silent.
+        """
+        timeout = None
+        if args[0].startswith('timeout=') and len(args) > 1:
+            try:
+                timeout = parse_duration(args[0][len('timeout='):])
+            except ValueError as e:
+                return f"Error: {str(e)}"
+            args = args[1:]
+        if self.shell_session is None or not self.shell_session.alive:
+            self.shell_session = ShellSession(self.session_timeout)
+        try:
+            return self.shell_session.run(join_command(args), on_line, timeout)
+        except TimeoutError as e:
+            self.shell_session = ShellSession(self.session_timeout)
+            return f"Error: Command timed out ({str(e)}); shell session restarted"
+        except Exception as e:
+            return f"Error executing command: {str(e)}"
 
-    def run_command(self, args: List[str]) -> str:
-        """Run a Windows command."""
+    def _session_error(self, code: int) -> str:
+        """Describe a failed session command with the last lines of its output."""
+        tail = '\n'.join(self.shell_session.tail)
+        return f"Command error (exit code {code})" + (f":\n{tail}" if tail else "")
+
+    def shell_operations(self, args: List[str]) -> str:
+        """Manage the persistent shell session and the default run mode."""
         if not args:
-            return "Error: No command specified"
+            return "Error: No shell operation specified"
             
-        cmd = ' '.join(args)
+        operation = args[0]
+        
+        if operation == "open":
+            if self.shell_session is None or not self.shell_session.alive:
+                try:
+                    self.shell_session = ShellSession(self.session_timeout)
+                except Exception as e:
+                    return f"Shell session error: {str(e)}"
+            return "Shell session started"
+        
+        elif operation == "close":
+            if self.shell_session is not None:
+                self.shell_session.close()
+                self.shell_session = None
+            return "Shell session closed"
+        
+        elif operation == "run" and len(args) > 1:
+            return self._session_command(args[1:])
+        
+        elif operation == "timeout":
+            if len(args) > 1:
+                try:
+                    self.session_timeout = None if args[1] in ('none', '0') else parse_duration(args[1])
+                except ValueError as e:
+                    return f"Error: {str(e)}"
+                if self.shell_session is not None:
+                    self.shell_session.timeout = self.session_timeout
+            return self.session_timeout
+        
+        elif operation == "mode":
+            if len(args) > 1:
+                if args[1] not in RUN_MODES:
+                    return f"Error: Unknown run mode: {args[1]}"
+                self.run_mode = args[1]
+            return self.run_mode
+        
+        else:
+            return f"Unknown shell operation: {operation}"
+
+    def reset(self) -> None:
+        """Forget variables, definitions, imports and scheduled jobs while keeping parse caches and the shell session."""
+        self.default_context = ExecutionContext()
+        with self._definitions_lock:
+            self.functions.clear()
+            self.function_scopes.clear()
+            self.compiled_functions.clear()
+            self.function_params.clear()
+            self.function_caches.clear()
+            self.imported_modules.clear()
+        self.scheduler = Scheduler(self._execute_scheduled, self.scheduler.max_concurrency)
+
+    def close(self) -> None:
+        """Release resources held by the interpreter, such as the shell session and open record writers."""
+        if self.shell_session is not None:
+            self.shell_session.close()
+            self.shell_session = None
+        for writer in list(self.record_writers.values()):
+            writer.close()
+        self.record_writers.clear()
+        self.process_sampler.remove()
+
+    def _stream_command(self, cmd: Union[str, List[str]]) -> str:
+        """Run a command, printing its output line by line as it is produced."""
+        stream = CommandStream(cmd, self.output_tail_lines)
         try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-            if result.returncode != 0 and result.stderr:
-                return f"Command error: {result.stderr}"
-            return result.stdout
+            for line in stream.lines():
+                print(line, flush=True)
+        except Exception as e:
+            return f"Error executing command: {str(e)}"
+        return stream.error_report() if stream.returncode else ""
+
+    def _redirect_command(self, cmd: Union[str, List[str]], path: str, append: bool = False) -> str:
+        """Run a command, streaming its stdout into a file."""
+        stream = CommandStream(cmd, self.output_tail_lines)
+        try:
+            if stream.copy_to(path, append=append):
+                return stream.error_report()
+            return f"Successfully wrote command output to {path}"
         except Exception as e:
             return f"Error executing command: {str(e)}"
 
@@ -252,6 +2972,9 @@ class WSInterpreter:
         if not args:
             return "Error: No wait time specified"
             
+        if args[0] == "until":
+            return self.wait_until(args[1:])
+            
         try:
             seconds = float(args[0])
             time.sleep(seconds)
@@ -260,6 +2983,62 @@ class WSInterpreter:
         except Exception as e:
             return f"Error during wait: {str(e)}"
 
+    def wait_until(self, args: List[str]) -> Any:
+        """Wait until a file, process, window or expression condition holds; return False on timeout."""
+        timeout = None
+        if len(args) >= 2 and args[-2] == "timeout":
+            try:
+                timeout = float(self._replace_variables(args[-1]))
+            except ValueError:
+                return f"Error: Invalid timeout: {args[-1]}"
+            args = args[:-2]
+            
+        if not args:
+            return "Error: No wait condition specified"
+            
+        try:
+            if args[0] == "file" and len(args) > 2 and args[1] == "exists":
+                path = self._replace_variables(' '.join(args[2:]))
+                return wait_for_path(path, lambda: os.path.exists(path), timeout)
+                
+            if args[0] == "file" and len(args) > 2 and args[1] == "changed":
+                path = self._replace_variables(' '.join(args[2:]))
+                
+                def signature():
+                    try:
+                        stat = os.stat(path)
+                        return stat.st_mtime_ns, stat.st_size
+                    except OSError:
+                        return None
+                        
+                initial = signature()
+                return wait_for_path(path, lambda: signature() != initial, timeout)
+                
+            if args[0] == "process" and len(args) > 2 and args[1] == "exits":
+                pid = int(self._replace_variables(args[2]))
+                return wait_for_process_exit(pid, timeout)
+                
+            if args[0] == "screen" and len(args) > 2 and args[1] == "shows":
+                search, match = self._screen_search(args[2:]), None
+                
+                def shows():
+                    nonlocal match
+                    match = search()
+                    return match is not None
+                    
+                return match if poll_until(shows, timeout) else False
+                
+            if args[0] == "window" and len(args) > 1:
+                title = self._replace_variables(' '.join(args[1:]))
+                return poll_until(lambda: bool(pyautogui.getWindowsWithTitle(title)), timeout)
+                
+            test = self.evaluator.compile(' '.join(args))
+            return poll_until(lambda: test(self.variables), timeout)
+        except ValueError as e:
+            return f"Error: Invalid wait condition: {str(e)}"
+        except Exception as e:
+            return f"Error during wait: {str(e)}"
+
     def mouse_click(self, args: List[str]) -> None:
         """Perform a mouse click."""
         try:
@@ -274,6 +3053,54 @@ class WSInterpreter:
         except Exception as e:
             return f"Error during mouse click: {str(e)}"
 
+    def screen_operations(self, args: List[str]) -> Any:
+        """Find a template image on the screen or in an image file."""
+        if not args:
+            return "Error: No screen operation specified"
+            
+        if args[0] == "find" and len(args) > 1:
+            try:
+                return self._screen_search(args[1:])()
+            except ValueError as e:
+                return f"Error: {str(e)}"
+            except Exception as e:
+                return f"Error finding image: {str(e)}"
+        
+        return f"Unknown screen operation: {args[0]}"
+
+    def _screen_search(self, args: List[str]) -> Callable[[], Optional[Dict[str, Any]]]:
+        """Parse '<image> [x y width height] [confidence] [source=<file>]' into a function that runs one search.
+        
+        The search returns a map with the centre (x, y), bounds and score of the
+        best match, or None when nothing matches with the given confidence.
+        """
+        positional, options = parse_options([self._replace_variables(arg) for arg in args])
+        if not positional:
+            raise ValueError("No image specified")
+        template, numbers = positional[0], positional[1:]
+        if len(numbers) not in (0, 1, 4, 5):
+            raise ValueError(f"Invalid region or confidence: {' '.join(numbers)} (expected [x y width height] [confidence])")
+        region = tuple(int(value) for value in numbers[:4]) if len(numbers) >= 4 else None
+        confidence = float(numbers[-1]) if len(numbers) in (1, 5) else DEFAULT_MATCH_CONFIDENCE
+        source = options.get('source')
+        
+        def search():
+            if source:
+                image = load_gray_image(source)
+                if region:
+                    image = crop_image(image, *region)
+            else:
+                image = grab_screen(region)
+            match = self.image_matcher.find(image, template, confidence)
+            if match is None:
+                return None
+            left, top, width, height, score = match
+            if region:
+                left, top = left + region[0], top + region[1]
+            return {'x': left + width // 2, 'y': top + height // 2, 'left': left, 'top': top,
+                    'width': width, 'height': height, 'confidence': round(score, 4)}
+        return search
+
     def keyboard_type(self, args: List[str]) -> None:
         """Type text using the keyboard."""
         if not args:
@@ -286,9 +3113,11 @@ class WSInterpreter:
         text = self._replace_variables(text)
         
         try:
-            pyautogui.write(text)
+            method = self.typer.type(text)
         except Exception as e:
             return f"Error typing text: {str(e)}"
+        if self.debug:
+            print(f"[type] {len(text)} characters via {method}")
 
     def window_operations(self, args: List[str]) -> None:
         """Perform window operations."""
@@ -357,6 +3186,9 @@ class WSInterpreter:
 
     def process_operations(self, args: List[str]) -> Any:
         """Perform process operations."""
+        if args and args[0] in ("monitor", "unmonitor", "stats", "export"):
+            return self._monitor_operations(args)
+            
         if not psutil:
             return "Error: Process operations limited (psutil module not found)"
             
@@ -401,9 +3233,11 @@ class WSInterpreter:
                 return f"Process kill error: {str(e)}"
         
         elif operation == "start" and len(args) > 1:
-            program = ' '.join(args[1:])
+            argv = args[2:] if args[1] == "argv" else args[1:]
+            shell = args[1] != "argv" and self.run_mode != "argv"
+            program = ' '.join(argv)
             try:
-                subprocess.Popen(program, shell=True)
+                subprocess.Popen(program if shell else argv, shell=shell)
                 return f"Started: {program}"
             except Exception as e:
                 return f"Process start error: {str(e)}"
@@ -411,6 +3245,51 @@ class WSInterpreter:
         else:
             return f"Unknown process operation: {operation}"
 
+    def _monitor_operations(self, args: List[str]) -> Any:
+        """Start, stop, query and export background process monitors."""
+        if psutil is None and not os.path.isdir('/proc'):
+            return "Error: Process monitoring requires psutil or a /proc file system"
+            
+        positional, options = parse_options(args)
+        operation = positional[0]
+        
+        try:
+            if operation == "unmonitor":
+                removed = self.process_sampler.remove(positional[1] if len(positional) > 1 else None)
+                return f"Stopped {removed} monitor(s)"
+                
+            if len(positional) < 2:
+                return f"Error: process {operation} requires a PID or process name"
+            target = positional[1]
+            
+            if operation == "monitor":
+                monitor = ProcessMonitor(target, parse_duration(options.get('interval', '1s')),
+                                         int(options.get('capacity', 3600)))
+                if not monitor.pids and target.isdigit():
+                    return f"Error: No process with PID {target}"
+                self.process_sampler.add(monitor)
+                return f"Monitoring {target} ({len(monitor.pids)} process(es)) every {monitor.interval:g}s"
+                
+            monitor = self.process_sampler.monitors.get(target)
+            if monitor is None:
+                return f"Error: {target} is not being monitored"
+                
+            if operation == "stats":
+                metrics = positional[2:] or list(PROCESS_METRICS)
+                stats = {metric: monitor.ring.summary(metric) for metric in metrics}
+                for metric, summary in stats.items():
+                    print(f"{target} {metric}: " + ' '.join(f"{key}={value:.6g}" for key, value in summary.items()))
+                return stats[metrics[0]] if len(metrics) == 1 else stats
+                
+            if len(positional) < 3:
+                return "Error: Usage: process export <pid|name> <path.csv>"
+            rows = monitor.ring.to_csv(positional[2])
+            return f"Exported {rows} sample(s) to {positional[2]}"
+        except Exception as e:
+            error_msg = f"Process monitor error: {str(e)}"
+            print(error_msg)
+            return error_msg
+
     def file_operations(self, args: List[str]) -> Any:
         """Perform file operations."""
         if not args:
@@ -429,8 +3308,68 @@ class WSInterpreter:
             except Exception as e:
                 return f"File read error: {str(e)}"
         
+        elif operation == "readbytes" and len(args) > 1:
+            file_path = args[1]
+            try:
+                with open(file_path, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return f"Error: File not found: {file_path}"
+            except Exception as e:
+                return f"File read error: {str(e)}"
+        
+        elif operation == "map" and len(args) > 1:
+            file_path = args[1]
+            try:
+                with open(file_path, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        return memoryview(b"")
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                return memoryview(mapped)
+            except FileNotFoundError:
+                return f"Error: File not found: {file_path}"
+            except Exception as e:
+                return f"File map error: {str(e)}"
+        
+        elif operation == "hash" and len(args) > 1:
+            file_path = args[1]
+            algorithm = args[2] if len(args) > 2 else "sha256"
+            try:
+                return hash_file(file_path, algorithm)
+            except FileNotFoundError:
+                return f"Error: File not found: {file_path}"
+            except Exception as e:
+                return f"File hash error: {str(e)}"
+        
+        elif operation == "patch" and len(args) > 3:
+            file_path = args[1]
+            data = self._binary_argument(args[3:])
+            if data is None:
+                return f"Error: Invalid byte value: {' '.join(args[3:])}"
+            try:
+                offset = int(args[2], 0)
+                with open(file_path, 'r+b') as f:
+                    f.seek(offset)
+                    f.write(data)
+                return f"Successfully patched {len(data)} bytes at offset {offset} in {file_path}"
+            except ValueError:
+                return f"Error: Invalid offset: {args[2]}"
+            except FileNotFoundError:
+                return f"Error: File not found: {file_path}"
+            except Exception as e:
+                return f"File patch error: {str(e)}"
+        
         elif operation == "write" and len(args) > 2:
             file_path = args[1]
+            data = self._binary_argument(args[2:]) if args[2].startswith('$') else None
+            if data is not None:
+                try:
+                    with open(file_path, 'wb') as f:
+                        f.write(data)
+                    return f"Successfully wrote to {file_path}"
+                except Exception as e:
+                    return f"File write error: {str(e)}"
+                    
             content = ' '.join(args[2:])
             
             content = self._process_escape_sequences(content)
@@ -445,6 +3384,15 @@ class WSInterpreter:
         
         elif operation == "append" and len(args) > 2:
             file_path = args[1]
+            data = self._binary_argument(args[2:]) if args[2].startswith('$') else None
+            if data is not None:
+                try:
+                    with open(file_path, 'ab') as f:
+                        f.write(data)
+                    return f"Successfully appended to {file_path}"
+                except Exception as e:
+                    return f"File append error: {str(e)}"
+                    
             content = ' '.join(args[2:])
             
             content = self._process_escape_sequences(content)
@@ -471,29 +3419,52 @@ class WSInterpreter:
             file_path = args[1]
             return os.path.exists(file_path)
         
+        elif operation == "search":
+            matches = self.search_files(args[1:])
+            if isinstance(matches, str):
+                return matches
+            results = []
+            for match in matches:
+                print(f"{match['path']}:{match['line']}:{match['column']}: {match['text']}")
+                results.append(match)
+            return results
+        
         else:
             return f"Unknown file operation: {operation}"
 
-    def conditional(self, block: List[str]) -> None:
+    def _binary_argument(self, args: List[str]) -> Optional[Any]:
+        """Resolve a `$var` reference or expression to a bytes-like value, or None."""
+        if len(args) == 1 and args[0].startswith('$') and args[0][1:] in self.variables:
+            value = self.variables[args[0][1:]]
+        else:
+            try:
+                value = self.evaluator.evaluate(' '.join(args), self.variables)
+            except Exception:
+                return None
+        return value if isinstance(value, BYTES_LIKE) else None
+
+    def conditional(self, block: List[str]) -> Any:
         """Execute a conditional block."""
-        if not block:
-            return None
-            
-        first_line = block[0]
-        if not first_line.startswith('if '):
-            return f"Invalid if statement: {first_line}"
-            
-        condition = first_line[3:]  
+        return self.execute([['if', block]])
+
+    def _split_if_block(self, block: List[str]) -> Tuple[str, List[str], List[str]]:
+        """Split an if block into its condition, body and else body."""
+        condition = block[0][3:]  
         
         body = []
         else_block = []
         i = 1
         in_else = False
+        depth = 0
         
         while i < len(block):
-            if block[i] == 'end':
-                break
-            elif block[i].startswith('else'):
+            if block[i].startswith('end'):
+                if depth == 0:
+                    break
+                depth -= 1
+            elif self._opens_block(block[i]):
+                depth += 1
+            elif block[i].startswith('else') and depth == 0:
                 in_else = True
                 i += 1
                 continue
@@ -503,26 +3474,8 @@ class WSInterpreter:
             else:
                 else_block.append(block[i])
             i += 1
-        
-        try:
-            exec_globals = globals().copy()
-            exec_globals.update(self.variables)
-            condition_met = eval(condition, exec_globals, self.variables)
-            self._last_condition_result = condition_met
             
-            if condition_met:
-                result = self._execute_block_body(body)
-                self._in_else_block = False
-                return result
-            else:
-                if else_block:
-                    result = self._execute_block_body(else_block)
-                    return result
-                self._in_else_block = True
-                return None
-        except Exception as e:
-            self._last_condition_result = False
-            return f"Error in condition: {str(e)}"
+        return condition, body, else_block
 
     def else_block(self, block: List[str]) -> Any:
         """Execute an else block."""
@@ -542,38 +3495,395 @@ class WSInterpreter:
         
     def while_loop(self, block: List[str]) -> Any:
         """Execute a while loop."""
+        return self.execute([['while', block]])
+
+    def foreach_loop(self, block: List[str]) -> Any:
+        """Execute a block once for every item of a collection or line of command output."""
         if not block:
             return None
             
-        first_line = block[0]
-        if not first_line.startswith('while '):
-            return f"Invalid while statement: {first_line}"
+        header = self._tokenize(block[0])
+        if len(header) < 4 or header[2] != 'in':
+            return f"Invalid foreach statement: {block[0]}"
             
-        condition = first_line[6:]  
-        
-        body = block[1:-1] if block[-1] == 'end' else block[1:]
+        var_name, source = header[1], header[3:]
+        body = self._parse_block_body(block[1:-1] if block[-1] == 'end' else block[1:])
         
+        stream = None
+        if source[0] == 'run' and len(source) > 1:
+            items = self._run_lines(source[1:])
+            if isinstance(items, str):
+                print(items)
+                return items
+            if isinstance(items, CommandStream):
+                stream, items = items, items.lines()
+        else:
+            items = self._iterate_source(source)
+            if isinstance(items, str):
+                return items
+                
+        last_result = None
         try:
-            max_iterations = 1000  
-            iteration = 0
-            last_result = None
+            for item in items:
+                self.variables[var_name] = item
+                last_result = self.execute(body)
+        except CallDepthError:
+            raise
+        except Exception as e:
+            return f"Error in foreach loop: {str(e)}"
             
-            exec_globals = globals().copy()
-            exec_globals.update(self.variables)
+        if stream is not None and stream.returncode:
+            error_msg = stream.error_report()
+            print(error_msg)
+            return error_msg
+        return last_result
+
+    def pforeach_loop(self, block: List[str]) -> Any:
+        """Run a block for every item of a collection in parallel, each iteration in its own variable scope."""
+        if not block:
+            return None
             
-            while eval(condition, exec_globals, self.variables) and iteration < max_iterations:
-                last_result = self._execute_block_body(body)
-                iteration += 1
-                
-                
-                exec_globals.update(self.variables)
-                
-            if iteration >= max_iterations:
-                print("Warning: Maximum loop iterations reached (possible infinite loop)")
+        header, options = parse_options(self._tokenize(block[0]))
+        if len(header) < 4 or header[2] != 'in':
+            return f"Invalid pforeach statement: {block[0]}"
+            
+        mode = options.get('mode', 'thread')
+        if mode not in PFOREACH_MODES:
+            return f"Error: Invalid pforeach mode: {mode} (expected thread or process)"
+        try:
+            workers = int(options.get('workers', os.cpu_count() or 1))
+        except ValueError:
+            return f"Error: Invalid workers value: {options['workers']}"
+            
+        var_name = header[1]
+        body = self._parse_block_body(block[1:-1] if block[-1] == 'end' else block[1:])
+        items = self._iterate_source(header[3:])
+        if isinstance(items, str):
+            return items
+        items = list(items)
+        
+        try:
+            if mode == "process":
+                outcomes = self._pforeach_processes(body, var_name, items, workers)
+            else:
+                variables = dict(self.variables)
+                with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                    outcomes = list(pool.map(lambda item: self.run_iteration(body, variables, var_name, item), items))
+        except Exception as e:
+            error_msg = f"Error in pforeach loop: {str(e)}"
+            print(error_msg)
+            return error_msg
+            
+        results = []
+        for index, (result, errors) in enumerate(outcomes):
+            if errors:
+                print(f"pforeach item {index} ({items[index]}) failed: {errors[0]}")
+                result = f"Error: {errors[0]}"
+            results.append(result)
+        if 'results' in options:
+            self.variables[options['results']] = results
+        return results
+
+    def run_iteration(self, body: List[Any], variables: Dict[str, Any], var_name: str, item: Any) -> Tuple[Any, List[str]]:
+        """Run a loop body for one item in a fresh context; return its result and the errors it reported."""
+        try:
+            context = self.run(body, {**variables, var_name: item})
+        except Exception as e:
+            return None, [str(e)]
+        return context.last_result, list(context.errors)
+
+    def _pforeach_processes(self, body: List[Any], var_name: str, items: List[Any], workers: int) -> List[Tuple[Any, List[str]]]:
+        """Run pforeach iterations in a process pool; the body and definitions are sent once per worker.
+        
+        Output printed by each iteration is shown in input order once the iteration's turn comes.
+        """
+        variables = {}
+        for name, value in self.variables.items():
+            try:
+                pickle.dumps(value)
+                variables[name] = value
+            except Exception:
+                pass
+        definitions = {
+            'functions': self.functions,
+            'compiled_functions': self.compiled_functions,
+            'function_params': self.function_params,
+            'function_scopes': self.function_scopes,
+        }
+        state = pickle.dumps((definitions, body, var_name, variables), pickle.HIGHEST_PROTOCOL)
+        sys.stdout.flush()
+        outcomes = []
+        with ProcessPoolExecutor(max_workers=max(1, workers), initializer=_pforeach_init, initargs=(state,)) as pool:
+            for result, errors, output in pool.map(_pforeach_task, items, chunksize=max(1, len(items) // (workers * 4))):
+                if output:
+                    print(output, end='')
+                outcomes.append((result, errors))
+        return outcomes
+
+    def _iterate_source(self, source: List[str]) -> Any:
+        """Resolve a foreach source to an iterable, or return an error message."""
+        if source[0] in self.commands and source[0] not in self.block_handlers:
+            value = self._command_value(source[0], source[1:])
+        elif len(source) == 1 and source[0].startswith('$') and source[0][1:] in self.variables:
+            value = self.variables[source[0][1:]]
+        else:
+            try:
+                value = self.evaluator.evaluate(' '.join(source), self.variables)
+            except Exception as e:
+                return f"Error in foreach source: {str(e)}"
                 
-            return last_result
+        if isinstance(value, str):
+            return value.splitlines()
+        try:
+            return iter(value)
+        except TypeError:
+            return f"Error: Cannot iterate over {type(value).__name__}"
+
+    def record_loop(self, block: List[str]) -> Any:
+        """Execute a block once for every record of a CSV or JSON Lines file."""
+        header = self._tokenize(block[0])
+        positional, options = parse_options(header)
+        if len(positional) != 5 or positional[1] != 'each' or positional[3] != 'in':
+            return f"Invalid {header[0]} statement: {block[0]}"
+            
+        record_format, var_name, path = positional[0], positional[2], self._replace_variables(positional[4])
+        body = self._parse_block_body(block[1:-1] if block[-1] == 'end' else block[1:])
+        
+        last_result = None
+        try:
+            records = read_records(path, record_format, options.get('delimiter', ','),
+                                   options.get('header', 'yes').lower() not in ('no', 'false', '0'))
+            for record in records:
+                self.variables[var_name] = record
+                last_result = self.execute(body)
+        except CallDepthError:
+            raise
+        except Exception as e:
+            error_msg = f"Error in {record_format} loop: {str(e)}"
+            print(error_msg)
+            return error_msg
+        return last_result
+
+    def csv_operations(self, args: List[str]) -> Any:
+        """Open, write and close buffered CSV writers."""
+        return self._record_operations('csv', args)
+
+    def jsonl_operations(self, args: List[str]) -> Any:
+        """Open, write and close buffered JSON Lines writers."""
+        return self._record_operations('jsonl', args)
+
+    def _record_operations(self, record_format: str, args: List[str]) -> Any:
+        """Handle open/write/close for a record format."""
+        if not args:
+            return f"Error: No {record_format} operation specified"
+            
+        operation = args[0]
+        
+        try:
+            if operation == "open" and len(args) > 1:
+                positional, options = parse_options(args[1:])
+                path = os.path.abspath(self._replace_variables(positional[0]))
+                self._close_writer(path)
+                self.record_writers[path] = RecordWriter(path, record_format, append='append' in positional[1:],
+                                                         delimiter=options.get('delimiter', ','))
+                return f"Opened {path}"
+            
+            elif operation == "write" and len(args) > 2:
+                path = os.path.abspath(self._replace_variables(args[1]))
+                writer = self.record_writers.get(path)
+                if writer is None or writer.format != record_format:
+                    self._close_writer(path)
+                    writer = self.record_writers[path] = RecordWriter(path, record_format)
+                writer.write(self._record_value(record_format, args[2:]))
+                return writer.records
+            
+            elif operation == "close":
+                paths = [os.path.abspath(self._replace_variables(args[1]))] if len(args) > 1 else list(self.record_writers)
+                for path in paths:
+                    self._close_writer(path)
+                return f"Closed {len(paths)} {record_format} writer(s)"
+            
+            else:
+                return f"Unknown {record_format} operation: {operation}"
         except Exception as e:
-            return f"Error in while loop: {str(e)}"
+            error_msg = f"{record_format.upper()} error: {str(e)}"
+            print(error_msg)
+            return error_msg
+
+    def _close_writer(self, path: str) -> None:
+        """Flush and close the record writer of a path, if one is open."""
+        writer = self.record_writers.pop(path, None)
+        if writer is not None:
+            writer.close()
+
+    def _record_value(self, record_format: str, tokens: List[str]) -> Any:
+        """Build the record to write from expression tokens, or key=expression pairs for JSON Lines."""
+        if record_format == 'jsonl' and len(tokens) > 1:
+            record = {}
+            for token in tokens:
+                key, sep, expression = token.partition('=')
+                if not sep:
+                    raise ValueError(f"Expected key=value, got: {token}")
+                record[key] = self._token_value(expression)
+            return record
+        values = [self._token_value(token) for token in tokens]
+        return values[0] if len(values) == 1 and isinstance(values[0], dict) or record_format == 'jsonl' else values
+
+    def _token_value(self, token: str) -> Any:
+        """Evaluate a token as an expression, falling back to its text with variables replaced."""
+        if token.startswith('$') and token[1:] in self.variables:
+            return self.variables[token[1:]]
+        try:
+            return self.evaluator.evaluate(token, self.variables)
+        except Exception:
+            return self._replace_variables(token)
+
+    def buffer_operations(self, args: List[str]) -> Any:
+        """Build text in a string builder variable and write it to a file."""
+        if len(args) < 2:
+            return "Error: buffer requires an operation and a variable name"
+            
+        operation, var_name = args[0], args[1]
+        
+        if operation in ("append", "line"):
+            builder = self.variables.get(var_name)
+            if not isinstance(builder, StringBuilder):
+                builder = self.variables[var_name] = StringBuilder("" if builder is None else str(builder))
+            text = self._replace_variables(self._process_escape_sequences(' '.join(args[2:])))
+            builder.append(text + '\n' if operation == "line" else text)
+            return len(builder)
+        
+        elif operation == "new":
+            self.variables[var_name] = StringBuilder()
+            return 0
+        
+        elif operation == "flush":
+            if len(args) < 4 or args[2] != "to":
+                return "Error: Usage: buffer flush <var> to <path> [append]"
+            builder = self.variables.get(var_name)
+            if builder is None:
+                return f"Error: Variable '{var_name}' not found"
+            try:
+                with open(args[3], 'a' if 'append' in args[4:] else 'w', encoding='utf-8') as f:
+                    if isinstance(builder, StringBuilder):
+                        f.writelines(builder.chunks)
+                    else:
+                        f.write(str(builder))
+                written = len(builder)
+                if isinstance(builder, StringBuilder):
+                    builder.clear()
+                return written
+            except Exception as e:
+                error_msg = f"Error writing buffer: {str(e)}"
+                print(error_msg)
+                return error_msg
+        
+        elif operation == "clear":
+            if isinstance(self.variables.get(var_name), StringBuilder):
+                self.variables[var_name].clear()
+            return 0
+        
+        else:
+            return f"Unknown buffer operation: {operation}"
+
+    def vector_operations(self, args: List[str]) -> Any:
+        """Build numeric vectors and compute aggregates over a whole vector in one command."""
+        if len(args) < 2:
+            return "Error: vector requires an operation and a variable name"
+            
+        operation, var_name, rest = args[0], args[1], args[2:]
+        try:
+            if operation == "new":
+                vector = self.variables[var_name] = Vector(self._numbers(self._token_value(token) for token in rest))
+                return len(vector)
+            
+            elif operation == "from":
+                positional, options = parse_options(rest)
+                if len(positional) == 3 and positional[0] == "csv":
+                    values = self._csv_column(self._replace_variables(positional[1]), positional[2],
+                                              options.get('delimiter', ','))
+                elif positional:
+                    values = self._iterate_source(positional)
+                    if isinstance(values, str):
+                        return values
+                    if 'field' in options:
+                        values = (item[options['field']] for item in values)
+                else:
+                    return "Error: Usage: vector from <var> <collection> [field=<name>] | csv <path> <column>"
+                vector = self.variables[var_name] = Vector(self._numbers(values))
+                return len(vector)
+            
+            elif operation == "sizes":
+                vector = self.variables[var_name] = Vector(os.stat(path).st_size for path in self.scan_files(rest))
+                return len(vector)
+            
+            elif operation == "append":
+                vector = self.variables.get(var_name)
+                if not isinstance(vector, Vector):
+                    vector = self.variables[var_name] = Vector()
+                for value in self._numbers(self._token_value(token) for token in rest):
+                    vector.append(value)
+                return len(vector)
+            
+            vector = self.variables.get(var_name)
+            if not isinstance(vector, Vector):
+                return f"Error: Variable '{var_name}' is not a vector"
+                
+            if operation in ("sum", "mean", "min", "max"):
+                return getattr(vector, operation)()
+            
+            elif operation == "count":
+                return len(vector)
+            
+            elif operation == "percentile":
+                if not rest:
+                    return "Error: Usage: vector percentile <var> <percentile>..."
+                values = vector.percentiles([float(self._token_value(token)) for token in rest])
+                return values[0] if len(values) == 1 else values
+            
+            elif operation == "histogram":
+                histogram = vector.histogram(int(rest[0]) if rest else 10)
+                for bin in histogram:
+                    print(f"{bin['low']:>12g} - {bin['high']:<12g} {bin['count']}")
+                return histogram
+            
+            elif operation == "sort":
+                vector.sort(reverse=rest[:1] == ["desc"])
+                return len(vector)
+            
+            elif operation == "stats":
+                summary = vector.summary()
+                print(f"{var_name}: " + ' '.join(f"{key}={value:g}" for key, value in summary.items()))
+                return summary
+            
+            else:
+                return f"Unknown vector operation: {operation}"
+        except (ValueError, TypeError, KeyError, IndexError, OSError) as e:
+            return f"Error: {str(e)}"
+
+    def _numbers(self, values: Any) -> Iterator[float]:
+        """Convert numbers and numeric strings to floats, skipping empty values."""
+        for value in values:
+            if value is None or (isinstance(value, str) and not value.strip()):
+                continue
+            try:
+                yield float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Not a number: {value!r}") from None
+
+    def _csv_column(self, path: str, column: str, delimiter: str = ',') -> Iterator[str]:
+        """Yield the cells of one CSV column, chosen by header name or zero-based index."""
+        rows = read_records(path, 'csv', delimiter, header=False)
+        header = next(rows, [])
+        if column in header:
+            index = header.index(column)
+        elif column.isdigit():
+            index = int(column)
+        else:
+            raise ValueError(f"Column not found: {column}")
+        for row in rows:
+            if index < len(row):
+                yield row[index]
 
     def _process_escape_sequences(self, text: str) -> str:
         """Process escape sequences in strings."""
@@ -587,14 +3897,71 @@ class WSInterpreter:
         if not text:
             return text
             
+        if '$' not in text:
+            return text
         result = text
-        for var_name, var_value in self.variables.items():
-            result = result.replace(f"${var_name}", str(var_value))
-        return result
+        if '.' in result:
+            result = FIELD_REFERENCE.sub(self._replace_field, result)
+        return VARIABLE_REFERENCE.sub(self._replace_reference, result)
+
+    def _replace_reference(self, match: 're.Match[str]') -> str:
+        """Replace a $name reference with the longest variable name it starts with."""
+        name = match.group(1)
+        while name:
+            if name in self.variables:
+                return str(self.variables[name]) + match.group(1)[len(name):]
+            name = name[:-1]
+        return match.group(0)
+
+    def _replace_field(self, match: 're.Match[str]') -> str:
+        """Replace a $record.field reference when the variable holds a map with that field."""
+        record = self.variables.get(match.group(1))
+        if isinstance(record, dict) and match.group(2) in record:
+            return str(record[match.group(2)])
+        return match.group(0)
 
     def _execute_block_body(self, body_lines: List[str]) -> Any:
         """Helper method to execute the body of a block."""
+        return self.execute(self._parse_block_body(body_lines))
+
+    def _parse_block_body(self, body_lines: List[str]) -> List[Union[List[str], List[List[str]]]]:
+        """Parse the body lines of a block into executable commands, reusing the result for identical bodies."""
+        key = tuple(body_lines)
+        parsed_body = self._body_cache.get(key)
+        if parsed_body is not None:
+            return parsed_body
+            
         parsed_body = []
+        for block_type, segment in self._group_lines(body_lines):
+            if block_type:
+                parsed_body.append([block_type, segment])
+            else:
+                try:
+                    tokens = self._tokenize(segment)
+                    if tokens: 
+                        parsed_body.append(tokens)
+                except:
+                    print(f"Error parsing line in block: {segment}")
+        
+        if len(self._body_cache) >= ExpressionEvaluator.MAX_CACHE_SIZE:
+            self._body_cache.clear()
+        self._body_cache[key] = parsed_body
+        return parsed_body
+
+    def _tokenize(self, line: str) -> List[str]:
+        """Split a single statement line into tokens, stripping quotes and trailing comments."""
+        comment_pos = line.find('#')
+        if comment_pos > 0:
+            line = line[:comment_pos].strip()
+            
+        keyword = line.split(None, 1)[0] if line.strip() else ''
+        pattern = EXPRESSION_TOKEN_PATTERN if keyword in EXPRESSION_STATEMENTS else TOKEN_PATTERN
+        tokens = pattern.findall(line)
+        return [token.strip('"') if token.startswith('"') and token.endswith('"') else token for token in tokens]
+
+    def _group_lines(self, body_lines: List[str]) -> List[Tuple[Optional[str], Any]]:
+        """Group block body lines into (block_type, block_lines) and (None, line) segments."""
+        segments = []
         i = 0
         while i < len(body_lines):
             line = body_lines[i].strip()
@@ -603,7 +3970,7 @@ class WSInterpreter:
                 i += 1
                 continue
                 
-            if any(line.startswith(cmd) for cmd in ['if', 'while', 'function', 'else']):
+            if self._opens_block(line) or line.startswith('else'):
                 block_type = line.split()[0]
                 nested_block = [line]
                 i += 1
@@ -613,7 +3980,7 @@ class WSInterpreter:
                     current_line = body_lines[i].strip()
                     if current_line.startswith('end'):
                         depth -= 1
-                    elif any(current_line.startswith(cmd) for cmd in ['if', 'while', 'function']):
+                    elif self._opens_block(current_line):
                         depth += 1
                     
                     nested_block.append(current_line)
@@ -621,22 +3988,74 @@ class WSInterpreter:
                     if depth == 0:
                         break
                         
-                parsed_body.append([block_type, nested_block])
+                segments.append((block_type, nested_block))
             else:
-                try:
-                    comment_pos = line.find('#')
-                    if comment_pos > 0:
-                        line = line[:comment_pos].strip()
-                    
-                    tokens = re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")++', line)
-                    tokens = [token.strip('"') if token.startswith('"') and token.endswith('"') else token for token in tokens]
-                    if tokens: 
-                        parsed_body.append(tokens)
-                except:
-                    print(f"Error parsing line in block: {line}")
+                segments.append((None, line))
                 i += 1
+                
+        return segments
+
+    def every_block(self, block: List[str]) -> str:
+        """Schedule a block to run at a fixed interval."""
+        if not block:
+            return "Error: Empty every block"
+            
+        header, options = parse_options(block[0].split()[1:])
+        if len(header) != 1:
+            return f"Invalid every statement: {block[0]}"
+            
+        try:
+            interval = parse_duration(header[0])
+            if interval <= 0:
+                return f"Error: Invalid interval: {header[0]}"
+            return self._schedule_block(block, options, interval=interval)
+        except ValueError as e:
+            return f"Error: {str(e)}"
+
+    def at_block(self, block: List[str]) -> str:
+        """Schedule a block to run daily at a time of day (HH:MM or HH:MM:SS)."""
+        if not block:
+            return "Error: Empty at block"
+            
+        header, options = parse_options(block[0].split()[1:])
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})(?::(\d{2}))?', header[0]) if len(header) == 1 else None
+        if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+            return f"Invalid at statement: {block[0]}"
+            
+        time_of_day = (int(match.group(1)), int(match.group(2)), int(match.group(3) or 0))
+        try:
+            return self._schedule_block(block, options, time_of_day=time_of_day)
+        except ValueError as e:
+            return f"Error: {str(e)}"
+
+    def _schedule_block(self, block: List[str], options: Dict[str, str], **timing) -> str:
+        """Register an every/at block with the scheduler, parsing its body once."""
+        misfire = options.get("misfire", "skip")
+        if misfire not in ("skip", "catchup"):
+            raise ValueError(f"Invalid misfire policy: {misfire}")
+        count = int(options["count"]) if "count" in options else None
+        
+        body = block[1:-1] if block[-1] == 'end' else block[1:]
+        job = ScheduledJob(block[0], self._parse_block_body(body), misfire=misfire, count=count, **timing)
+        self.scheduler.add(job)
+        return f"Scheduled '{job.name}'"
+
+    def _execute_scheduled(self, body: List[Any]) -> Any:
+        """Run an every/at body in its own execution context that shares the script's variables.
         
-        return self.execute(parsed_body)
+        Bodies may run concurrently, so each needs its own executor stack, call
+        depth and if/else state; errors are reported to the script's context.
+        """
+        context = ExecutionContext()
+        context.variables = self.default_context.variables
+        self.run(body, context=context)
+        self.default_context.errors.extend(context.errors)
+        return context.last_result
+
+    def run_scheduled(self) -> None:
+        """Run scheduled every/at blocks until all of them have finished."""
+        if self.scheduler.jobs:
+            self.scheduler.run()
 
     def define_function(self, block: List[str]) -> str:
         """Define a function."""
@@ -647,50 +4066,93 @@ class WSInterpreter:
         if not first_line.startswith('function '):
             return f"Invalid function definition: {first_line}"
             
-        parts = first_line.split(maxsplit=1)
-        if len(parts) < 2:
+        header = self.parse_function_header(first_line)
+        if header is None:
             return "Error: Function name not specified"
             
-        func_name = parts[1]
-        
-        if self.current_function_scope:
-            if self.function_scopes.get(self.current_function_scope) is None:
-                self.function_scopes[self.current_function_scope] = set()
-            self.function_scopes[self.current_function_scope].add(func_name)
+        func_name, params, cache_options = header
+        cache = None
+        if cache_options is not None:
+            cache = FunctionCache(int(cache_options.get('maxsize', 128)),
+                                  parse_duration(cache_options['ttl']) if 'ttl' in cache_options else None)
+        if self._module_namespace and not self.current_function_scope:
+            func_name = f"{self._module_namespace}.{func_name}"
         
         body = block[1:-1] if block[-1] == 'end' else block[1:]
-        self.functions[func_name] = body
+        compiled = self._parse_block_body(body)
+        with self._definitions_lock:
+            if self.current_function_scope:
+                self.function_scopes.setdefault(self.current_function_scope, set()).add(func_name)
+            self.compiled_functions[func_name] = compiled
+            self.function_params[func_name] = params
+            if cache is None:
+                self.function_caches.pop(func_name, None)
+            else:
+                self.function_caches[func_name] = cache
+            self.functions[func_name] = body
         
         return f"Function '{func_name}' defined"
         
-    def call_function(self, args: List[str]) -> Any:
-        """Call a defined function."""
+    def parse_function_header(self, line: str) -> Optional[Tuple[str, List[str], Optional[Dict[str, str]]]]:
+        """Split 'function [cached] <name> [params...] [maxsize=N] [ttl=T]' into name, params and cache options."""
+        words, options = parse_options(line.split()[1:])
+        cache_options = None
+        if len(words) > 1 and words[0] == 'cached':
+            words, cache_options = words[1:], options
+        if not words:
+            return None
+        return words[0], words[1:], cache_options
+
+    def cache_operations(self, args: List[str]) -> str:
+        """Clear or show the result caches of cached functions, or of run cached with 'run'."""
         if not args:
-            return "Error: No function name specified"
+            return "Error: No cache operation specified"
             
-        func_name = args[0]
-        
-        if func_name not in self.functions:
-            error_msg = f"Function '{func_name}' not defined"
-            print(error_msg)
-            return error_msg
-        
-        for parent_scope, nested_funcs in self.function_scopes.items():
-            if func_name in nested_funcs:
-                if self.current_function_scope != parent_scope:
-                    error_msg = f"Function '{func_name}' not defined"
-                    print(error_msg)
-                    return error_msg
-        
-        previous_scope = self.current_function_scope
-        
-        self.current_function_scope = func_name
-        
-        result = self._execute_block_body(self.functions[func_name])
+        operation = args[0]
+        if args[1:] == ["run"]:
+            if operation == "clear":
+                self.command_cache.clear()
+                return "Cleared run cache"
+            elif operation == "stats":
+                stats = f"run: {self.command_cache.stats()}"
+                print(stats)
+                return stats
+            return f"Unknown cache operation: {operation}"
+            
+        names = [self._qualify_function_name(args[1])] if len(args) > 1 else list(self.function_caches)
+        for name in names:
+            if name not in self.function_caches:
+                return f"Error: Function '{name}' is not cached"
+                
+        if operation == "clear":
+            for name in names:
+                self.function_caches[name].clear()
+            return f"Cleared {len(names)} function cache(s)"
         
-        self.current_function_scope = previous_scope
+        elif operation == "stats":
+            stats = [f"{name}: {self.function_caches[name].stats()}" for name in names]
+            for line in stats:
+                print(line)
+            return "\n".join(stats)
         
-        return result
+        else:
+            return f"Unknown cache operation: {operation}"
+
+    def _qualify_function_name(self, func_name: str) -> str:
+        """Resolve a bare function name to the current module's namespace when it is defined there."""
+        if func_name in self.functions:
+            return func_name
+        if self.current_function_scope and '.' in self.current_function_scope:
+            namespace = self.current_function_scope.rsplit('.', 1)[0]
+        else:
+            namespace = self._module_namespace
+        if namespace and f"{namespace}.{func_name}" in self.functions:
+            return f"{namespace}.{func_name}"
+        return func_name
+
+    def call_function(self, args: List[str]) -> Any:
+        """Call a defined function."""
+        return self.execute([['call'] + list(args)])
 
     def set_variable(self, args: List[str]) -> Any:
         """Set a variable value."""
@@ -721,18 +4183,325 @@ class WSInterpreter:
                     print(f"Error in exec: {str(e)}")
                     self.variables[var_name] = f"Error: {str(e)}"
                     return None
+        elif args[1] == 'from' and len(args) > 2 and args[2] in self.commands:
+            if not self._is_value_command(args[2:]):
+                error_msg = f"Error: '{' '.join(args[2:4])}' does not return a value"
+                print(error_msg)
+                return error_msg
+            result = self._command_value(args[2], args[3:])
+            self.variables[var_name] = result
+            return result
         else:
             try:
-                exec_globals = globals().copy()
-                exec_globals.update(self.variables)
-                evaluated_value = eval(value, exec_globals, self.variables)
+                evaluated_value = self.evaluator.evaluate(value, self.variables)
                 self.variables[var_name] = evaluated_value
             except:
-                for existing_var, existing_val in self.variables.items():
-                    value = value.replace(f"${existing_var}", str(existing_val))
-                self.variables[var_name] = value
+                self.variables[var_name] = self._replace_variables(value)
             return self.variables[var_name]
 
+    def import_module(self, args: List[str]) -> str:
+        """Import a WS file once, defining its functions under a namespace."""
+        if not args:
+            return "Error: No module specified"
+            
+        name = args[0]
+        namespace = args[2] if len(args) > 2 and args[1] == "as" else None
+        path = self._resolve_module(name)
+        if path is None:
+            error_msg = f"Error: Module not found: {name}"
+            print(error_msg)
+            return error_msg
+        namespace = namespace or os.path.splitext(os.path.basename(path))[0]
+        
+        if path in self._import_stack:
+            chain = ' -> '.join(os.path.basename(p) for p in self._import_stack[self._import_stack.index(path):] + [path])
+            error_msg = f"Error: Circular import: {chain}"
+            print(error_msg)
+            return error_msg
+        with self._definitions_lock:
+            if path in self.imported_modules:
+                return f"Module '{self.imported_modules[path]}' already imported"
+                
+            try:
+                parsed_code = self._load_module(path)
+            except Exception as e:
+                error_msg = f"Error importing {name}: {str(e)}"
+                print(error_msg)
+                return error_msg
+                
+            previous_namespace = self._module_namespace
+            self._import_stack.append(path)
+            self._module_namespace = namespace
+            try:
+                self.execute(parsed_code)
+            finally:
+                self._import_stack.pop()
+                self._module_namespace = previous_namespace
+            self.imported_modules[path] = namespace
+        return f"Imported {name} as {namespace}"
+
+    def _resolve_module(self, name: str) -> Optional[str]:
+        """Find a module file in the importing module's directory and the search paths."""
+        candidates = [name] if name.endswith('.ws') else [name + '.ws', name]
+        if os.path.isabs(name):
+            directories = ['']
+        else:
+            directories = [os.path.dirname(self._import_stack[-1])] if self._import_stack else []
+            directories += self.search_paths
+            directories += [d for d in os.environ.get('WS_PATH', '').split(os.pathsep) if d]
+            directories.append(os.getcwd())
+            
+        for directory in directories:
+            for candidate in candidates:
+                path = os.path.join(directory, candidate)
+                if os.path.isfile(path):
+                    return os.path.realpath(path)
+        return None
+
+    def _parser_fingerprint(self) -> bytes:
+        """Identify the parser that produced cached parse trees, so changes to statement grouping invalidate them."""
+        if self._parser_digest is None:
+            cls = type(self)
+            self._parser_digest = code_fingerprint(
+                [cls.parse, cls._parse_statement, cls._top_level_segments, cls._opens_block, cls._tokenize],
+                TOKEN_PATTERN.pattern, EXPRESSION_TOKEN_PATTERN.pattern, sorted(EXPRESSION_STATEMENTS),
+                RECORD_FORMATS, sorted(self.block_handlers))
+        return self._parser_digest
+
+    def _load_module(self, path: str) -> List[Union[List[str], List[List[str]]]]:
+        """Return the parsed code of a module, parsing it at most once per process."""
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with MODULE_CACHE_LOCK:
+            cached = MODULE_CACHE.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+            
+        with open(path, 'rb') as f:
+            source = f.read()
+        digest = hashlib.sha256(source).hexdigest()
+        parsed_code = read_parse_cache(path, digest, self._parser_fingerprint())
+        if parsed_code is None:
+            parsed_code = self.parse(source.decode('utf-8', errors='replace'))
+            write_parse_cache(path, digest, self._parser_fingerprint(), parsed_code)
+            
+        with MODULE_CACHE_LOCK:
+            MODULE_CACHE[path] = (key, parsed_code)
+        return parsed_code
+
+    def snapshot_operations(self, args: List[str]) -> str:
+        """Save or load interpreter state snapshots."""
+        if len(args) < 2:
+            return "Error: snapshot requires an operation (save/load) and a path"
+            
+        operation, path = args[0], ' '.join(args[1:])
+        
+        if operation == "save":
+            try:
+                skipped = self.save_snapshot(path)
+            except Exception as e:
+                return f"Snapshot save error: {str(e)}"
+            for name, reason in skipped.items():
+                print(f"Warning: variable '{name}' not saved in snapshot: {reason}")
+            return f"Snapshot saved to {path}" + (f" ({len(skipped)} variables skipped)" if skipped else "")
+        
+        elif operation == "load":
+            try:
+                skipped = self.load_snapshot(path)
+            except FileNotFoundError:
+                return f"Error: File not found: {path}"
+            except Exception as e:
+                return f"Snapshot load error: {str(e)}"
+            for name, reason in skipped.items():
+                print(f"Warning: variable '{name}' not restored from snapshot: {reason}")
+            return f"Snapshot loaded from {path}"
+        
+        else:
+            return f"Unknown snapshot operation: {operation}"
+
+    def save_snapshot(self, path: str) -> Dict[str, str]:
+        """Write variables and function definitions to a snapshot file.
+        
+        Returns the names of variables that could not be serialized, with the reason.
+        """
+        state, skipped = self._snapshot_state()
+        payload = SNAPSHOT_MAGIC + struct.pack('<H', SNAPSHOT_VERSION) + pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        write_atomic(path, payload)
+        return skipped
+
+    def _snapshot_state(self) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """Collect variables and function definitions for a snapshot, with the variables that were skipped."""
+        variables, skipped = {}, {}
+        for name, value in self.variables.items():
+            try:
+                variables[name] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                skipped[name] = f"{type(value).__name__} is not serializable ({str(e)})"
+                
+        state = {
+            'ws_version': VERSION,
+            'variables': variables,
+            'functions': self.functions,
+            'function_scopes': self.function_scopes,
+            'compiled_functions': self.compiled_functions,
+            'function_params': self.function_params,
+            'function_caches': {name: (cache.maxsize, cache.ttl) for name, cache in self.function_caches.items()},
+        }
+        return state, skipped
+
+    def load_snapshot(self, path: str) -> Dict[str, str]:
+        """Restore variables and function definitions from a snapshot file.
+        
+        Returns the names of variables that could not be restored, with the reason.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        header_size = len(SNAPSHOT_MAGIC) + 2
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise ValueError("not a WS snapshot file")
+        version, = struct.unpack('<H', data[len(SNAPSHOT_MAGIC):header_size])
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {version} (expected {SNAPSHOT_VERSION})")
+            
+        return self._restore_state(SnapshotUnpickler(io.BytesIO(data[header_size:])).load())
+
+    def _restore_state(self, state: Dict[str, Any]) -> Dict[str, str]:
+        """Apply the variables and function definitions of a snapshot state, returning variables that failed."""
+        skipped = {}
+        for name, value in state['variables'].items():
+            try:
+                self.variables[name] = SnapshotUnpickler(io.BytesIO(value)).load()
+            except Exception as e:
+                skipped[name] = str(e)
+        self.functions.update(state['functions'])
+        for scope, nested in state['function_scopes'].items():
+            self.function_scopes.setdefault(scope, set()).update(nested)
+        self.compiled_functions.update(state['compiled_functions'])
+        self.function_params.update(state.get('function_params', {}))
+        for name, (maxsize, ttl) in state.get('function_caches', {}).items():
+            self.function_caches[name] = FunctionCache(maxsize, ttl)
+        return skipped
+
+    def save_checkpoint(self, args: List[str], stack: Optional[List[ExecutionFrame]]) -> str:
+        """Atomically write variables, definitions and the executor position to the checkpoint file."""
+        label = self._replace_variables(' '.join(args)) or "checkpoint"
+        if self.checkpoint_path is None:
+            return "Error: No checkpoint file; run a script file to use checkpoint"
+        if stack is None:
+            return "Error: checkpoint is only supported in top-level code, if/while blocks and function bodies"
+            
+        context = self.context
+        functions, scope = [], context.current_function_scope
+        for frame in reversed(stack):
+            functions.append(scope if frame.kind == 'call' else None)
+            if frame.kind == 'call':
+                scope = frame.scope
+        state, skipped = self._snapshot_state()
+        frames = []
+        for frame, function in zip(stack, reversed(functions)):
+            saved = {}
+            for name, value in frame.saved.items():
+                try:
+                    saved[name] = None if value is UNSET else pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                except Exception as e:
+                    skipped[name] = f"{type(value).__name__} is not serializable ({str(e)})"
+            frames.append({'index': frame.index, 'kind': frame.kind, 'iteration': frame.iteration,
+                           'scope': frame.scope, 'function': function, 'saved': saved})
+        state.update({
+            'label': label,
+            'fingerprint': self._checkpoint_fingerprint(stack),
+            'frames': frames,
+            'current_function_scope': context.current_function_scope,
+            'call_depth': context.call_depth,
+            'imported_modules': dict(self.imported_modules),
+        })
+        for name, reason in skipped.items():
+            print(f"Warning: variable '{name}' not saved in checkpoint: {reason}")
+        try:
+            payload = CHECKPOINT_MAGIC + struct.pack('<H', CHECKPOINT_VERSION) + pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+            write_atomic(self.checkpoint_path, payload)
+        except Exception as e:
+            return f"Error saving checkpoint: {str(e)}"
+        self.checkpoint_saved = True
+        if self.debug:
+            print(f"[checkpoint] {label} saved to {self.checkpoint_path}")
+        return f"Checkpoint {label} saved"
+
+    def resume(self, parsed_code: List[Union[List[str], List[List[str]]]], path: str) -> Any:
+        """Restore the state saved by the last checkpoint in path and continue executing parsed_code from there.
+        
+        Raises ValueError when the statements that ran before the checkpoint
+        were changed since; later statements may be edited freely.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        header_size = len(CHECKPOINT_MAGIC) + 2
+        if not data.startswith(CHECKPOINT_MAGIC):
+            raise ValueError("not a WS checkpoint file")
+        version, = struct.unpack('<H', data[len(CHECKPOINT_MAGIC):header_size])
+        if version != CHECKPOINT_VERSION:
+            raise ValueError(f"unsupported checkpoint version {version} (expected {CHECKPOINT_VERSION})")
+        state = SnapshotUnpickler(io.BytesIO(data[header_size:])).load()
+        
+        for name, reason in self._restore_state(state).items():
+            print(f"Warning: variable '{name}' not restored from checkpoint: {reason}")
+        try:
+            stack = self._resume_stack(parsed_code, state['frames'])
+        except (IndexError, KeyError, TypeError, ValueError):
+            stack = None
+        if stack is None or self._checkpoint_fingerprint(stack) != state['fingerprint']:
+            raise ValueError(f"the script changed before checkpoint '{state['label']}'; cannot resume")
+            
+        self.imported_modules.update(state['imported_modules'])
+        self.current_function_scope = state['current_function_scope']
+        self.context.call_depth = state['call_depth']
+        print(f"Resuming from checkpoint '{state['label']}'")
+        return self._run_frames(stack)
+
+    def _resume_stack(self, parsed_code: List[Any], frames: List[Dict[str, Any]]) -> List[ExecutionFrame]:
+        """Rebuild the executor stack described by a checkpoint's frames."""
+        stack = [ExecutionFrame(parsed_code)]
+        for depth, saved in enumerate(frames):
+            frame = stack[-1]
+            if saved['index'] > len(frame.code):
+                raise ValueError("checkpoint position is past the end of its block")
+            frame.index, frame.iteration = saved['index'], saved['iteration']
+            if depth + 1 == len(frames):
+                break
+                
+            statement, inner = frame.code[frame.index - 1], frames[depth + 1]
+            kind = inner['kind']
+            if kind == 'call' and statement[0] == 'call':
+                name = inner['function']
+                code = self.compiled_functions.get(name)
+                if code is None:
+                    code = self.compiled_functions[name] = self._parse_block_body(self.functions[name])
+                call = ExecutionFrame(code, 'call', scope=inner['scope'])
+                call.saved = {name: UNSET if value is None else SnapshotUnpickler(io.BytesIO(value)).load()
+                              for name, value in inner.get('saved', {}).items()}
+                stack.append(call)
+            elif kind == 'while' and statement[0] == 'while':
+                condition, body = self._compiled_block(statement[1])
+                stack.append(ExecutionFrame(body, 'while', test=self.evaluator.compile(condition)))
+            elif kind in ('if', None) and statement[0] == 'if':
+                condition, body, else_body = self._compiled_block(statement[1])
+                stack.append(ExecutionFrame(body if kind == 'if' else else_body or [], kind))
+            else:
+                raise ValueError(f"statement {statement[0]} cannot hold a {kind or 'block'} frame")
+        return stack
+
+    def _checkpoint_fingerprint(self, stack: List[ExecutionFrame]) -> str:
+        """Hash the statements each frame has already run; blocks still running count by their first line."""
+        digest = hashlib.sha256()
+        for depth, frame in enumerate(stack):
+            done = list(frame.code[:frame.index])
+            if depth < len(stack) - 1 and done:
+                statement = done.pop()
+                done.append([statement[0], statement[1][0]] if len(statement) == 2 and isinstance(statement[1], list)
+                            else statement)
+            digest.update(json.dumps([frame.kind, done], default=str).encode('utf-8'))
+        return digest.hexdigest()
+
     def get_variable(self, args: List[str]) -> Any:
         """Get a variable value."""
         if not args:
@@ -750,16 +4519,14 @@ class WSInterpreter:
             return "Error: No list type specified"
             
         list_type = args[0]
-        output = []
         
         if list_type == "files":
-            pattern = args[1] if len(args) > 1 else "*"
             try:
-                files = glob.glob(pattern)
-                for file in files:
+                count = 0
+                for file in self.scan_files(args[1:]):
                     print(file)
-                    output.append(file)
-                return "\n".join(output)
+                    count += 1
+                return count
             except Exception as e:
                 error_msg = f"Error listing files: {str(e)}"
                 print(error_msg)
@@ -772,11 +4539,20 @@ class WSInterpreter:
             return "\n".join(var_list)
         
         elif list_type == "funcs" or list_type == "functions":
-            func_list = list(self.functions.keys())
+            func_list = [f"{name} (cached: {self.function_caches[name].stats()})" if name in self.function_caches else name
+                         for name in self.functions]
             for func in func_list:
                 print(func)
             return "\n".join(func_list)
         
+        elif list_type == "jobs":
+            job_list = [f"{job.name}: runs={job.runs} missed={job.missed} next="
+                        f"{'done' if job.finished() else time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job.next_run))}"
+                        for job in self.scheduler.jobs]
+            for job in job_list:
+                print(job)
+            return "\n".join(job_list)
+        
         elif list_type == "commands":
             cmd_list = list(self.commands.keys())
             for cmd in cmd_list:
@@ -788,6 +4564,90 @@ class WSInterpreter:
             print(error_msg)
             return error_msg
 
+    def scan_files(self, args: List[str]) -> FileScan:
+        """Build a lazy file scan from a glob pattern and key=value filters."""
+        positional, options = parse_options(args)
+        file_type = options.get('type')
+        if file_type not in (None, 'file', 'dir'):
+            raise ValueError(f"Invalid type: {file_type} (expected file or dir)")
+        return FileScan(
+            positional[0] if positional else "*",
+            file_type=file_type,
+            extensions=re.split(r'[|;,]', options['ext']) if 'ext' in options else None,
+            min_size=parse_size(options['min_size']) if 'min_size' in options else None,
+            max_size=parse_size(options['max_size']) if 'max_size' in options else None,
+            newer=parse_duration(options['newer']) if 'newer' in options else None,
+            older=parse_duration(options['older']) if 'older' in options else None,
+            limit=int(options['limit']) if 'limit' in options else None,
+            workers=int(options.get('workers', 1)),
+            hidden=options.get('hidden', 'no').lower() in ('yes', 'true', '1'),
+        )
+
+    def search_files(self, args: List[str]) -> Any:
+        """Search the files matching a glob for a regex in parallel; return an iterator of matches or an error."""
+        positional, options = parse_options(args)
+        flags = [token for token in positional[3:] if token in ('recursive', 'first')]
+        if len(positional) < 3 or positional[1] != 'in' or len(flags) != len(positional) - 3:
+            return "Error: Usage: file search <regex> in <glob> [recursive] [first] [ignorecase=yes] [workers=N] [filters]"
+        ignorecase = options.pop('ignorecase', 'no').lower() in ('yes', 'true', '1')
+        try:
+            regex = re.compile(positional[0].encode('utf-8'), re.MULTILINE | (re.IGNORECASE if ignorecase else 0))
+        except re.error as e:
+            return f"Error: Invalid search pattern: {str(e)}"
+        pattern = positional[2].replace(os.sep, '/')
+        if 'recursive' in flags and '**' not in pattern.split('/'):
+            directory, _, name = pattern.rpartition('/')
+            pattern = f"{directory}/**/{name}" if directory else f"**/{name}"
+        options['type'] = 'file'
+        try:
+            workers = max(1, int(options.pop('workers'))) if 'workers' in options else None
+            files = self.scan_files([pattern] + [f"{key}={value}" for key, value in options.items()])
+        except ValueError as e:
+            return f"Error: {str(e)}"
+        first = 'first' in flags
+        pool_size = workers or min(32, (os.cpu_count() or 1) + 4)
+        
+        def search(path: str) -> List[Dict[str, Any]]:
+            try:
+                return search_file(path, regex, first)
+            except OSError:
+                return []
+                
+        def matches() -> Iterator[Dict[str, Any]]:
+            # Keep at most two files per worker in flight, so the scan stays lazy and memory bounded.
+            pool = ThreadPoolExecutor(max_workers=pool_size)
+            running: Set[Any] = set()
+            try:
+                for path in files:
+                    running.add(pool.submit(search, path))
+                    if len(running) >= 2 * pool_size:
+                        done, running = wait_futures(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield from future.result()
+                while running:
+                    done, running = wait_futures(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+        return matches()
+
+    def _is_value_command(self, tokens: List[str]) -> bool:
+        """Whether tokens name a command and subcommand whose result can be stored in a variable."""
+        if len(tokens) < 2 or tokens[0] not in VALUE_COMMANDS or tokens[0] not in self.commands:
+            return False
+        subcommands = VALUE_COMMANDS[tokens[0]]
+        return subcommands is None or tokens[1] in subcommands
+
+    def _command_value(self, name: str, args: List[str]) -> Any:
+        """Run a command whose result is used as a value; file listings stay lazy and are not printed."""
+        if name == 'list' and args[:1] == ['files']:
+            return self.scan_files(args[1:])
+        if name == 'file' and args[:1] == ['search']:
+            matches = self.search_files(args[1:])
+            return matches if isinstance(matches, str) else list(matches)
+        return self.commands[name](args)
+
     def help_command(self, args: List[str]) -> str:
         """Show help information."""
         help_text = ""
@@ -796,10 +4656,10 @@ class WSInterpreter:
             help_text = """WS Language Help:
 Available command categories:
 - Basic: print, set, get, wait, help, list
-- Windows: run, click, type, window
-- Files: file read/write/append/delete
-- Advanced: exec, registry, process
-- Control: if, while, function, call
+- Windows: run, click, type, window, screen
+- Files: file read/readbytes/map/hash/patch/write/append/delete/search, csv, jsonl, buffer, vector
+- Advanced: exec, shell, snapshot, checkpoint, registry, process
+- Control: if, while, foreach, pforeach, function, call, import, every, at
 
 Use 'help <command>' for more information on a specific command."""
             print(help_text)
@@ -810,27 +4670,57 @@ Use 'help <command>' for more information on a specific command."""
         if command == "print":
             help_text = "print <text> - Print text to console. Variables can be referenced with $varname."
         elif command == "set":
-            help_text = "set <var_name> <value> - Set a variable. Can use 'set var exec code' to execute Python."
+            help_text = "set <var_name> <value> - Set a variable. Can use 'set var exec code' to execute Python or 'set var from <command> ...' to store a command result."
         elif command == "get":
             help_text = "get <var_name> - Get a variable's value."
         elif command == "wait":
-            help_text = "wait <seconds> - Wait for the specified number of seconds."
+            help_text = ("wait <seconds> - Wait for the specified number of seconds.\n"
+                         "wait until file exists/changed <path> | process exits <pid> | window <title> | "
+                         "screen shows <image> | <expr> "
+                         "[timeout <seconds>] - Wait for a condition.")
         elif command == "run":
-            help_text = "run <command> - Run a Windows command."
+            help_text = ("run [shell|argv|session] <command> - Run a Windows command.\n"
+                         "run stream <command> - Print output as it is produced.\n"
+                         "run <command> > <path> - Stream stdout into a file (>> appends).\n"
+                         "run session [stream] [timeout=<duration>] <command> - Run in the persistent shell session, "
+                         "giving up if the command prints nothing for the duration.\n"
+                         "run cached [ttl=60s] [env=VAR,...] [inputs=path,...] <command> - Reuse the output of an "
+                         "identical earlier run.")
         elif command == "exec":
             help_text = "exec <python_code> - Execute Python code."
         elif command == "click":
             help_text = "click [x y] - Perform a mouse click, optionally at specified coordinates."
+        elif command == "screen":
+            help_text = ("screen find <image> [x y width height] [confidence] [source=<file>] - Find an image on the "
+                         "screen (or in an image file) and return its centre x, y, bounds and confidence.\n"
+                         "wait until screen shows <image> [x y width height] [confidence] [timeout <seconds>] - "
+                         "Wait for an image to appear.")
         elif command == "type":
-            help_text = "type <text> - Type text using the keyboard."
+            help_text = ("type <text> - Type text using the keyboard; long text is pasted through the clipboard "
+                         "(see --type-strategy).")
         elif command == "window":
             help_text = "window focus/close <window_name> - Perform operations on windows."
         elif command == "file":
-            help_text = "file read/write/append/delete <path> [content] - Perform file operations."
+            help_text = ("file read/readbytes/map/hash/patch/write/append/delete <path> [content] - Perform file operations. "
+                         "file search <regex> in <glob> [recursive] [first] - Search files in parallel for a pattern.")
+        elif command == "shell":
+            help_text = ("shell open/close/run <command>/timeout [duration]/mode [shell|argv|session] - Manage the "
+                         "persistent shell session and choose how 'run' executes commands.")
+        elif command == "import":
+            help_text = ("import <file[.ws]> [as <namespace>] - Run a WS file once and define its functions as "
+                         "<namespace>.<function>.")
+        elif command == "snapshot":
+            help_text = "snapshot save/load <path> - Save or restore variables and function definitions."
+        elif command == "checkpoint":
+            help_text = ("checkpoint <label> - Save variables, definitions and the current position so that "
+                         "'ws.py --resume <script>.ckpt <script>' continues from here.")
         elif command == "registry":
             help_text = "registry read/write <hkey> <path> <name> [value] - Perform registry operations."
         elif command == "process":
-            help_text = "process list/kill/start [pid/program] - Perform process operations."
+            help_text = ("process list/kill/start [pid/program] - Perform process operations.\n"
+                         "process monitor <pid|name> [interval=1s] [capacity=3600] / process stats <pid|name> [metric...] / "
+                         "process export <pid|name> <path.csv> / process unmonitor [pid|name] - Sample CPU, RSS, handles "
+                         "and I/O in the background.")
         elif command == "if":
             help_text = "if <condition>\n    commands...\nend - Conditional execution block."
         elif command == "else":
@@ -838,58 +4728,764 @@ Use 'help <command>' for more information on a specific command."""
         elif command == "while":
             help_text = "while <condition>\n    commands...\nend - Loop execution while condition is true."
         elif command == "function":
-            help_text = "function <name>\n    commands...\nend - Define a function."
+            help_text = ("function [cached] <name> [params...] [maxsize=N] [ttl=T]\n    commands...\nend - Define a function. "
+                         "A cached function remembers its result for each set of arguments.")
+        elif command == "cache":
+            help_text = ("cache clear|stats [function|run] - Clear or show the result caches of cached functions "
+                         "or of run cached.")
+        elif command == "every":
+            help_text = ("every <interval> [count=N] [misfire=skip|catchup]\n    commands...\nend - "
+                         "Run a block repeatedly, e.g. every 30s. Intervals accept ms, s, m, h and d.")
+        elif command == "at":
+            help_text = ("at <HH:MM[:SS]> [count=N] [misfire=skip|catchup]\n    commands...\nend - "
+                         "Run a block every day at the given time.")
+        elif command == "foreach":
+            help_text = ("foreach <var> in <collection|command>\n    commands...\nend - "
+                         "Loop over a collection, the lines of a string or the output of 'run <command>'.")
+        elif command == "buffer":
+            help_text = ("buffer new|append|line|clear <var> [text] / buffer flush <var> to <path> [append] - "
+                         "Build text in linear time and write it to a file.")
+        elif command == "vector":
+            help_text = ("vector new|append <var> <numbers...> / vector from <var> <collection> [field=<name>] / "
+                         "vector from <var> csv <path> <column> / vector sizes <var> <list files args> - Build a "
+                         "numeric vector.\n"
+                         "vector sum|mean|min|max|count|stats|sort <var> / vector percentile <var> <p>... / "
+                         "vector histogram <var> [bins] - Aggregate a vector in one command; arithmetic such as "
+                         "'set scaled v * 2 + 1' works element-wise.")
+        elif command in RECORD_FORMATS:
+            help_text = (f"{command} each <var> in <path>\n    commands...\nend - Loop over the records of a "
+                         f"{'CSV' if command == 'csv' else 'JSON Lines'} file; fields are read as <var>.<field>. "
+                         f"{command} open <path> [append] / {command} write <path> <values...> / {command} close [path] - "
+                         "Buffered writers.")
+        elif command == "pforeach":
+            help_text = ("pforeach <var> in <collection|command> [workers=N] [mode=thread|process] [results=<var>]\n"
+                         "    commands...\nend - Run the block for all items in parallel, each in its own variable scope; "
+                         "results are collected in input order.")
         elif command == "call":
             help_text = "call <function_name> - Call a defined function."
         elif command == "list":
-            help_text = "list files/vars/funcs/commands [pattern] - List various elements."
+            help_text = ("list files/vars/funcs/jobs/commands [pattern] - List various elements. "
+                         "list files accepts ** patterns and type=file|dir ext=py|txt min_size= max_size= "
+                         "newer= older= limit= workers= hidden=yes filters.")
         else:
             help_text = f"No help available for '{command}'."
             
         print(help_text)
         return help_text
 
-def run_ws_file(file_path: str, debug=False) -> None:
-    """Run a WS script file."""
+class WSOptimizer:
+    """Static optimization pass applied to parsed WS code before execution.
+    
+    The pass folds literal expressions, propagates variables that are assigned
+    exactly once from a literal value, removes if/while blocks whose condition
+    is known at optimization time and pre-substitutes `$name` references to
+    such constants. Optimized and unoptimized code produce the same output.
+    """
+    
+    FOLDABLE_NODES = (ast.Expression, ast.Constant, ast.Name, ast.Load, ast.BinOp, ast.UnaryOp,
+                      ast.BoolOp, ast.Compare, ast.operator, ast.unaryop, ast.boolop, ast.cmpop)
+    MAX_FOLDED_EXPONENT = 64
+    
+    def __init__(self, interpreter: 'WSInterpreter'):
+        self.interpreter = interpreter
+        self.constants: Dict[str, Any] = {}
+        self.assignments: Optional[Counter] = None
+        
+    def optimize(self, parsed_code: List[Union[List[str], List[List[str]]]]) -> List[Union[List[str], List[List[str]]]]:
+        """Return an optimized copy of parsed WS code."""
+        self.constants = {}
+        self.assignments = self._count_assignments(parsed_code)
+        return self._optimize_statements(list(parsed_code))
+    
+    def _count_assignments(self, parsed_code: List[Any]) -> Optional[Counter]:
+        """Count assignments per variable, or return None if any statement may assign arbitrary names."""
+        counts = Counter()
+        lines = []
+        for command in parsed_code:
+            if len(command) >= 2 and isinstance(command[1], list):
+                lines.extend(command[1])
+            elif command:
+                lines.append(command)
+                
+        for line in lines:
+            if isinstance(line, str):
+                if line.startswith(('else', 'end')):
+                    continue
+                tokens = self.interpreter._tokenize(line)
+            else:
+                tokens = line
+            assigned = self._statement_assigns(tokens)
+            if assigned is None:
+                return None
+            counts.update(assigned)
+        return counts
+    
+    def _statement_assigns(self, tokens: List[str]) -> Optional[List[str]]:
+        """Return the variable names a statement may assign, or None if that is unknown."""
+        if not tokens:
+            return []
+        # Modules, snapshots and resumed checkpoints can replace any variable.
+        if tokens[0] in ('exec', 'import', 'checkpoint') or tokens[:2] == ['snapshot', 'load']:
+            return None
+        if tokens[0] == 'set' and len(tokens) > 1:
+            if len(tokens) > 2 and (tokens[2] == 'exec' or tokens[2:5] == ['from', 'snapshot', 'load']):
+                return None
+            return [tokens[1]]
+        if tokens[0] == 'function':
+            header = self.interpreter.parse_function_header(' '.join(tokens))
+            return header[1] if header else []
+        if tokens[0] == 'pforeach':
+            return [parse_options(tokens)[1].get('results', tokens[1] if len(tokens) > 1 else '')]
+        if tokens[0] in ('buffer', 'vector') and len(tokens) > 2:
+            return [tokens[2]]
+        if tokens[0] in RECORD_FORMATS and len(tokens) > 2 and tokens[1] == 'each':
+            return [tokens[2]]
+        if tokens[0] == 'foreach' and len(tokens) > 3:
+            assigned = self._statement_assigns(tokens[3:])
+            return None if assigned is None else [tokens[1]] + assigned
+        return []
+    
+    def _optimize_statements(self, parsed_code: List[Any]) -> List[Any]:
+        """Optimize top-level statements, registering constants as they are assigned."""
+        optimized = []
+        has_else = any(len(command) >= 2 and command[0] == 'else' and isinstance(command[1], list)
+                       for command in parsed_code)
+        
+        i = 0
+        while i < len(parsed_code):
+            command = parsed_code[i]
+            i += 1
+            if not command:
+                continue
+                
+            if len(command) >= 2 and isinstance(command[1], list):
+                block_type, block = command[0], command[1]
+                if block_type == 'if':
+                    branch = None if has_else else self._fold_if(block)
+                    if branch is not None:
+                        parsed_code[i:i] = [self.interpreter._tokenize(line) for line in branch]
+                        continue
+                    optimized.append([block_type, self._rewrite_lines(block)])
+                elif block_type == 'while':
+                    if self._is_dead_loop(block):
+                        continue
+                    optimized.append([block_type, self._optimize_block(block)])
+                elif block_type == 'function':
+                    optimized.append([block_type, self._optimize_block(block)])
+                else:
+                    optimized.append(command)
+                continue
+                
+            tokens = self._rewrite_statement(command)
+            if (tokens[0] == 'set' and len(tokens) == 3 and self.assignments is not None
+                    and self.assignments[tokens[1]] == 1):
+                folded, value = self._fold_expression(tokens[2])
+                if folded and self._literal_token(value) is not None:
+                    self.constants[tokens[1]] = value
+            optimized.append(tokens)
+            
+        return optimized
+    
+    def _optimize_lines(self, lines: List[str]) -> List[str]:
+        """Optimize the body lines of a while loop or function."""
+        optimized = []
+        segments = self.interpreter._group_lines(lines)
+        has_else = any(block_type == 'else' for block_type, _ in segments)
+        
+        for block_type, segment in segments:
+            if block_type is None:
+                optimized.append(self._rewrite_line(segment))
+            elif block_type == 'if':
+                branch = None if has_else else self._fold_if(segment)
+                if branch is not None:
+                    optimized.extend(self._rewrite_line(line) for line in branch)
+                else:
+                    optimized.extend(self._rewrite_lines(segment))
+            elif block_type == 'while':
+                if not self._is_dead_loop(segment):
+                    optimized.extend(self._optimize_block(segment))
+            elif block_type == 'function':
+                optimized.extend(self._optimize_block(segment))
+            else:
+                optimized.extend(segment)
+                
+        return optimized
+    
+    def _optimize_block(self, block: List[str]) -> List[str]:
+        """Optimize a while or function block, keeping its header and end line."""
+        if block[-1] == 'end' and len(block) > 1:
+            return [block[0]] + self._optimize_lines(block[1:-1]) + ['end']
+        return [block[0]] + self._optimize_lines(block[1:])
+    
+    def _rewrite_lines(self, block: List[str]) -> List[str]:
+        """Rewrite the simple statements of a block without changing its structure."""
+        return [line if self._is_structure_line(line) else self._rewrite_line(line) for line in block]
+    
+    def _is_structure_line(self, line: str) -> bool:
+        """Check whether a line opens, separates or closes a block."""
+        return self.interpreter._opens_block(line) or line.startswith(('else', 'end'))
+    
+    def _fold_if(self, block: List[str]) -> Optional[List[str]]:
+        """Return the lines of the branch an if block always takes, or None if unknown."""
+        if not block[0].startswith('if '):
+            return None
+            
+        inner = block[1:-1] if block[-1] == 'end' else block[1:]
+        if any(self.interpreter._opens_block(line) or line.startswith('end') for line in inner):
+            return None
+            
+        condition, body, else_body = self.interpreter._split_if_block(block)
+        folded, value = self._fold_expression(condition)
+        if not folded:
+            return None
+        return body if value else else_body
+    
+    def _is_dead_loop(self, block: List[str]) -> bool:
+        """Check whether a while loop condition is known to be false."""
+        if not block[0].startswith('while '):
+            return False
+        folded, value = self._fold_expression(block[0][6:])
+        return folded and not value
+    
+    def _fold_expression(self, expression: str) -> Tuple[bool, Any]:
+        """Evaluate an expression built only from literals and known constants."""
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except (SyntaxError, ValueError):
+            return False, None
+            
+        for node in ast.walk(tree):
+            if not isinstance(node, self.FOLDABLE_NODES):
+                return False, None
+            if isinstance(node, ast.Name) and node.id not in self.constants:
+                return False, None
+            if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+                exponent = node.right
+                if not (isinstance(exponent, ast.Constant) and isinstance(exponent.value, (int, float))
+                        and abs(exponent.value) <= self.MAX_FOLDED_EXPONENT):
+                    return False, None
+                    
+        try:
+            value = self.interpreter.evaluator.evaluate(expression, self.constants)
+        except Exception:
+            return False, None
+        return True, value
+    
+    def _literal_token(self, value: Any) -> Optional[str]:
+        """Return a token that evaluates back to a numeric or boolean value."""
+        if isinstance(value, bool):
+            return repr(value)
+        if isinstance(value, (int, float)) and math.isfinite(value):
+            try:
+                return repr(value)
+            except ValueError:
+                return None
+        return None
+    
+    def _rewrite_line(self, line: str) -> str:
+        """Rewrite a single statement line, keeping the original if it cannot be re-serialized."""
+        tokens = self.interpreter._tokenize(line)
+        if not tokens:
+            return line
+        rewritten = self._rewrite_statement(tokens)
+        if rewritten == tokens:
+            return line
+        
+        parts = []
+        for token in rewritten:
+            if re.fullmatch(r'[^\s,"#]+', token):
+                parts.append(token)
+            else:
+                parts.append(f'"{token}"')
+        new_line = ' '.join(parts)
+        
+        if self.interpreter._tokenize(new_line) != rewritten:
+            return line
+        return new_line
+    
+    def _rewrite_statement(self, tokens: List[str]) -> List[str]:
+        """Fold constant expressions and interpolations in a single statement."""
+        command = tokens[0]
+        if command == 'set' and len(tokens) > 2 and tokens[2] != 'exec':
+            folded, value = self._fold_expression(' '.join(tokens[2:]))
+            literal = self._literal_token(value) if folded else None
+            if literal is not None:
+                return ['set', tokens[1], literal]
+        elif command == 'print' and not (len(tokens) > 1 and tokens[1] == 'file'):
+            return [command] + [self._interpolate(token) for token in tokens[1:]]
+        elif command == 'type':
+            return [command] + [self._interpolate(token) for token in tokens[1:]]
+        elif command == 'file' and len(tokens) > 2 and tokens[1] in ('write', 'append'):
+            return tokens[:3] + [self._interpolate(token) for token in tokens[3:]]
+        return tokens
+    
+    def _interpolate(self, text: str) -> str:
+        """Substitute `$name` references to constants that no other variable name can shadow."""
+        if '$' not in text or self.assignments is None:
+            return text
+            
+        for name, value in self.constants.items():
+            reference = f"${name}"
+            if reference not in text:
+                continue
+            if any(other != name and (other.startswith(name) or name.startswith(other))
+                   for other in self.assignments):
+                continue
+            text = text.replace(reference, str(value))
+        return text
+
+class IncrementalParser:
+    """Re-parse a changing script, reusing the parsed form of unchanged top-level segments.
+    
+    Each top-level statement or block is keyed by its source lines; only new or
+    edited segments are tokenized again. Unchanged blocks keep their identity,
+    so the interpreter's caches of parsed if/while and function bodies stay valid.
+    """
+    
+    def __init__(self, interpreter: 'WSInterpreter'):
+        self.interpreter = interpreter
+        self.segments: Dict[Tuple[Optional[str], Tuple[str, ...]], Any] = {}
+        self.reused = 0
+        self.parsed = 0
+        
+    def parse(self, code: str) -> List[Union[List[str], List[List[str]]]]:
+        """Parse code, returning the same statements WSInterpreter.parse would."""
+        segments, parsed_code = {}, []
+        self.reused = self.parsed = 0
+        for block_type, segment in self.interpreter._top_level_segments(code):
+            key = (block_type, tuple(segment) if block_type else (segment,))
+            if key in self.segments:
+                parsed = self.segments[key]
+                self.reused += 1
+            else:
+                parsed = [block_type, segment] if block_type else self.interpreter._parse_statement(segment)
+                self.parsed += 1
+            segments[key] = parsed
+            if parsed:
+                parsed_code.append(parsed)
+        self.segments = segments
+        return parsed_code
+
+def watched_files_signature(paths: List[str]) -> Dict[str, Optional[Tuple[int, int]]]:
+    """Return the modification time and size of each file, or None for missing files."""
+    signature = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature[path] = None
+    return signature
+
+def run_ws_watch(file_path: str, debug=False, optimize=False, max_concurrency=1, search_paths=None,
+                 max_call_depth=DEFAULT_MAX_CALL_DEPTH, run_cache=None, type_strategy="auto") -> None:
+    """Run a WS script, then re-run it whenever it or one of its imported modules changes."""
+    interpreter = WSInterpreter(debug=debug, max_concurrency=max_concurrency, max_call_depth=max_call_depth)
+    interpreter.search_paths = [os.path.dirname(os.path.abspath(file_path))] + list(search_paths or [])
+    interpreter.command_cache.directory = run_cache
+    interpreter.typer.strategy = type_strategy
+    parser = IncrementalParser(interpreter)
+    
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+                    code = f.read()
+                parsed_code = parser.parse(code)
+                if optimize:
+                    parsed_code = interpreter.optimize(parsed_code)
+                interpreter.reset()
+                interpreter.execute(parsed_code)
+                interpreter.run_scheduled()
+            except FileNotFoundError:
+                print(f"Error: File not found: {file_path}")
+            except Exception as e:
+                print(f"Error running WS file: {str(e)}")
+                if debug:
+                    import traceback
+                    traceback.print_exc()
+                    
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f"[watch] Finished in {elapsed:.1f} ms ({parser.parsed} segment(s) parsed, "
+                  f"{parser.reused} reused); waiting for changes...", flush=True)
+            
+            watched = [os.path.abspath(file_path)] + list(interpreter.imported_modules)
+            signature = watched_files_signature(watched)
+            poll_until(lambda: watched_files_signature(watched) != signature, max_delay=0.1)
+    except KeyboardInterrupt:
+        print("\n[watch] Stopped")
+    finally:
+        interpreter.close()
+
+DEFAULT_COORDINATOR_ADDRESS = "127.0.0.1:7878"
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """Split a host:port string; the host defaults to 127.0.0.1."""
+    host, _, port = address.rpartition(':')
+    return host or "127.0.0.1", int(port)
+
+def send_message(stream: Any, message: Dict[str, Any]) -> None:
+    """Write one JSON message line to a binary stream or socket."""
+    data = json.dumps(message, default=str).encode('utf-8') + b'\n'
+    if isinstance(stream, socket.socket):
+        stream.sendall(data)
+    else:
+        stream.write(data)
+        stream.flush()
+
+class DistributedJob:
+    """One (script, params) entry of the coordinator's work queue."""
+    __slots__ = ('id', 'name', 'source', 'params', 'attempts', 'worker', 'ok', 'result', 'errors', 'output')
+    
+    def __init__(self, job_id: int, name: str, source: str, params: Optional[Dict[str, Any]] = None):
+        self.id = job_id
+        self.name = name
+        self.source = source
+        self.params = dict(params or {})
+        self.attempts = 0
+        self.worker: Optional[str] = None
+        self.ok: Optional[bool] = None
+        self.result: Any = None
+        self.errors: List[str] = []
+        self.output: List[str] = []
+        
+    def to_dict(self) -> Dict[str, Any]:
+        return {'id': self.id, 'script': self.name, 'params': self.params, 'ok': self.ok,
+                'attempts': self.attempts, 'worker': self.worker, 'result': self.result,
+                'errors': self.errors, 'output': ''.join(self.output)}
+
+def load_jobs(path: str) -> List[DistributedJob]:
+    """Read a JSON Lines job file of {"script": path, "params": {...}} entries.
+    
+    Script paths are relative to the job file; the script source is read here
+    and shipped to the workers, so they need not share a filesystem.
+    """
+    base, jobs, sources = os.path.dirname(os.path.abspath(path)), [], {}
+    for record in read_records(path, 'jsonl'):
+        script = os.path.join(base, record['script'])
+        if script not in sources:
+            with open(script, 'r', encoding='utf-8', errors='replace') as f:
+                sources[script] = f.read()
+        jobs.append(DistributedJob(len(jobs) + 1, record['script'], sources[script], record.get('params')))
+    return jobs
+
+class JobCoordinator:
+    """Hand out jobs to workers, collect their results and requeue failed attempts."""
+    
+    def __init__(self, jobs: List[DistributedJob], retries: int = 0):
+        self.jobs = jobs
+        self.retries = retries
+        self.pending = deque(jobs)
+        self.remaining = len(jobs)
+        self.started: Optional[float] = None
+        self._condition = threading.Condition()
+        
+    def next_job(self, worker: str) -> Optional[DistributedJob]:
+        """Block until a job is pending and assign it to worker; None once every job has finished."""
+        with self._condition:
+            while not self.pending and self.remaining:
+                self._condition.wait()
+            if not self.remaining:
+                return None
+            job = self.pending.popleft()
+            job.attempts += 1
+            job.worker = worker
+            job.output = []
+            if self.started is None:
+                self.started = time.perf_counter()
+            return job
+        
+    def release(self, job: DistributedJob) -> None:
+        """Put back a job that never reached its worker, without counting the attempt."""
+        with self._condition:
+            job.attempts -= 1
+            self.pending.appendleft(job)
+            self._condition.notify_all()
+            
+    def output(self, job: DistributedJob, text: str) -> None:
+        """Record and print a line the job printed on its worker."""
+        job.output.append(text)
+        print(f"[{job.name}#{job.id}] {text}", end='' if text.endswith('\n') else '\n', flush=True)
+        
+    def finish(self, job: DistributedJob, ok: bool, result: Any = None, errors: Optional[List[str]] = None) -> None:
+        """Record the outcome of an attempt, requeueing failed jobs that have retries left."""
+        with self._condition:
+            job.errors = list(errors or [])
+            if not ok and job.attempts <= self.retries:
+                print(f"[coordinator] Job {job.id} ({job.name}) failed on {job.worker}, retrying: "
+                      f"{'; '.join(job.errors)}", flush=True)
+                self.pending.append(job)
+            else:
+                job.ok, job.result = ok, result
+                self.remaining -= 1
+                status = "ok" if ok else "failed: " + '; '.join(job.errors)
+                print(f"[coordinator] Job {job.id} ({job.name}) {status} "
+                      f"[{job.worker}, attempt {job.attempts}]", flush=True)
+            self._condition.notify_all()
+            
+    def wait(self) -> None:
+        """Block until every job has finished."""
+        with self._condition:
+            while self.remaining:
+                self._condition.wait()
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    """Serve one worker slot: send it jobs on request and relay its output and results."""
+    
+    def handle(self) -> None:
+        coordinator = self.server.coordinator
+        worker, job = "%s:%d" % self.client_address[:2], None
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                kind = message.get('type')
+                if kind == 'hello':
+                    worker = message.get('worker', worker)
+                elif kind == 'request':
+                    job = coordinator.next_job(worker)
+                    if job is None:
+                        send_message(self.wfile, {'type': 'done'})
+                        break
+                    try:
+                        send_message(self.wfile, {'type': 'job', 'id': job.id, 'name': job.name,
+                                                  'script': job.source, 'params': job.params})
+                    except OSError:
+                        coordinator.release(job)
+                        job = None
+                        break
+                elif kind == 'output' and job is not None:
+                    coordinator.output(job, message.get('data', ''))
+                elif kind == 'result' and job is not None:
+                    coordinator.finish(job, bool(message.get('ok')), message.get('result'), message.get('errors'))
+                    job = None
+        except (OSError, ValueError):
+            pass
+        finally:
+            if job is not None:
+                coordinator.finish(job, False, errors=[f"worker {worker} disconnected"])
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, address: Tuple[str, int], coordinator: JobCoordinator):
+        super().__init__(address, CoordinatorHandler)
+        self.coordinator = coordinator
+
+def run_ws_coordinator(jobs_file: str, address: str = DEFAULT_COORDINATOR_ADDRESS, retries: int = 0,
+                       results_file: Optional[str] = None) -> bool:
+    """Serve the jobs of a job file to workers until all have finished; return whether all succeeded."""
+    try:
+        jobs = load_jobs(jobs_file)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error: Cannot load jobs from {jobs_file}: {e}")
+        return False
+    coordinator = JobCoordinator(jobs, retries)
+    server = CoordinatorServer(parse_address(address), coordinator)
+    host, port = server.server_address[:2]
+    print(f"[coordinator] Listening on {host}:{port} with {len(jobs)} job(s)", flush=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        coordinator.wait()
+    except KeyboardInterrupt:
+        print("\n[coordinator] Stopped")
+    finally:
+        server.shutdown()
+        server.server_close()
+        
+    finished = [job for job in jobs if job.ok is not None]
+    failed = sum(1 for job in finished if not job.ok)
+    elapsed = time.perf_counter() - coordinator.started if coordinator.started else 0.0
+    workers = len({job.worker for job in finished})
+    print(f"[coordinator] {len(finished)} job(s) finished on {workers} worker(s) in {elapsed:.2f}s: "
+          f"{len(finished) - failed} ok, {failed} failed", flush=True)
+    if results_file:
+        writer = RecordWriter(results_file, 'jsonl')
+        for job in jobs:
+            writer.write(job.to_dict())
+        writer.close()
+    return len(finished) == len(jobs) and not failed
+
+class ThreadOutput(io.TextIOBase):
+    """A stdout stand-in that hands what a thread prints to that thread's sink, if it has one."""
+    
+    def __init__(self, stream: Any):
+        self.stream = stream
+        self._local = threading.local()
+        
+    @contextlib.contextmanager
+    def capture(self, sink: Callable[[str], Any]) -> Iterator[None]:
+        previous = getattr(self._local, 'sink', None)
+        self._local.sink = sink
+        try:
+            yield
+        finally:
+            self._local.sink = previous
+            
+    def write(self, text: str) -> int:
+        sink = getattr(self._local, 'sink', None)
+        if sink is None:
+            return self.stream.write(text)
+        sink(text)
+        return len(text)
+    
+    def flush(self) -> None:
+        self.stream.flush()
+
+def connect_with_retry(address: Tuple[str, int], timeout: float = 10.0) -> Optional[socket.socket]:
+    """Connect to address, retrying until the timeout so workers may start before the coordinator."""
+    connection = []
+    
+    def attempt():
+        try:
+            connection.append(socket.create_connection(address))
+            return True
+        except OSError:
+            return False
+        
+    return connection[0] if poll_until(attempt, timeout=timeout, initial_delay=0.05) else None
+
+def _worker_slot(new_interpreter: Callable[[], 'WSInterpreter'], output: ThreadOutput, address: Tuple[str, int],
+                 name: str) -> int:
+    """Pull and run jobs over one connection until the coordinator is done; return the number run.
+    
+    Each job gets a fresh interpreter, so functions, run mode and the shell session
+    of one job are not visible to the next.
+    """
+    sock = connect_with_retry(address)
+    if sock is None:
+        print(f"Error: Cannot connect to coordinator at {address[0]}:{address[1]}")
+        return 0
+    completed = 0
+    with sock, sock.makefile('rb') as reader:
+        send_message(sock, {'type': 'hello', 'worker': name})
+        while True:
+            send_message(sock, {'type': 'request'})
+            line = reader.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            if message.get('type') != 'job':
+                break
+            pending = []
+            
+            def sink(text):
+                pending.append(text)
+                if '\n' in text:
+                    send_message(sock, {'type': 'output', 'data': ''.join(pending)})
+                    pending.clear()
+                    
+            with output.capture(sink):
+                interpreter = new_interpreter()
+                try:
+                    context = interpreter.run(message['script'], message.get('params'))
+                    result = context.variables.get('result', context.last_result)
+                    errors = list(context.errors)
+                except Exception as e:
+                    result, errors = None, [str(e)]
+                finally:
+                    interpreter.close()
+            if pending:
+                send_message(sock, {'type': 'output', 'data': ''.join(pending)})
+            try:
+                json.dumps(result)
+            except (TypeError, ValueError):
+                result = str(result)
+            send_message(sock, {'type': 'result', 'ok': not errors, 'result': result, 'errors': errors})
+            completed += 1
+    return completed
+
+def run_ws_worker(address: str = DEFAULT_COORDINATOR_ADDRESS, concurrency: int = 1, debug=False,
+                  search_paths=None, max_call_depth=DEFAULT_MAX_CALL_DEPTH) -> None:
+    """Run jobs from a coordinator in this warm process, at most `concurrency` at a time."""
+    def new_interpreter():
+        interpreter = WSInterpreter(debug=debug, max_call_depth=max_call_depth)
+        interpreter.search_paths = [os.getcwd()] + list(search_paths or [])
+        return interpreter
+        
+    target = parse_address(address)
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    output = ThreadOutput(sys.stdout)
+    sys.stdout, completed = output, 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            slots = [pool.submit(_worker_slot, new_interpreter, output, target, f"{name}/{slot}")
+                     for slot in range(max(1, concurrency))]
+            completed = sum(slot.result() for slot in slots)
+    except KeyboardInterrupt:
+        print("\n[worker] Stopped")
+    except OSError as e:
+        print(f"Error: Lost connection to coordinator: {e}")
+    finally:
+        sys.stdout = output.stream
+    print(f"[worker] {name} ran {completed} job(s)", flush=True)
+
+def run_ws_file(file_path: str, debug=False, optimize=False, max_concurrency=1, search_paths=None,
+                max_call_depth=DEFAULT_MAX_CALL_DEPTH, run_cache=None, resume=None, type_strategy="auto") -> None:
+    """Run a WS script file, or continue it from the checkpoint file given as resume."""
+    interpreter = None
     try:
         with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
             code = f.read()
             
-        interpreter = WSInterpreter(debug=debug)
+        interpreter = WSInterpreter(debug=debug, max_concurrency=max_concurrency, max_call_depth=max_call_depth)
+        interpreter.search_paths = [os.path.dirname(os.path.abspath(file_path))] + list(search_paths or [])
+        interpreter.command_cache.directory = run_cache
+        interpreter.typer.strategy = type_strategy
+        interpreter.checkpoint_path = file_path + '.ckpt'
         parsed_code = interpreter.parse(code)
-        interpreter.execute(parsed_code)
-    except FileNotFoundError:
-        print(f"Error: File not found: {file_path}")
+        if optimize:
+            parsed_code = interpreter.optimize(parsed_code)
+        if resume:
+            interpreter.resume(parsed_code, resume)
+        else:
+            interpreter.execute(parsed_code)
+        interpreter.run_scheduled()
+        if not interpreter.context.errors and interpreter.checkpoint_saved:
+            os.remove(interpreter.checkpoint_path)
+    except FileNotFoundError as e:
+        print(f"Error: File not found: {e.filename or file_path}")
     except Exception as e:
         print(f"Error running WS file: {str(e)}")
         if debug:
             import traceback
             traceback.print_exc()
+    finally:
+        if interpreter is not None:
+            interpreter.close()
 
-def run_ws_repl(debug=False) -> None:
+def run_ws_repl(debug=False, search_paths=None, max_call_depth=DEFAULT_MAX_CALL_DEPTH, run_cache=None,
+                type_strategy="auto") -> None:
     """Run the WS interactive REPL."""
-    interpreter = WSInterpreter(debug=debug)
+    interpreter = WSInterpreter(debug=debug, max_call_depth=max_call_depth)
+    interpreter.search_paths = list(search_paths or [])
+    interpreter.command_cache.directory = run_cache
+    interpreter.typer.strategy = type_strategy
     print("WS Language Interpreter (Windows Scripting)")
     print("Type 'exit' to quit, 'help' for help")
     
-    while True:
-        try:
-            line = input("ws> ")
-            if line.lower() == 'exit':
-                break
+    try:
+        while True:
+            try:
+                line = input("ws> ")
+                if line.lower() == 'exit':
+                    break
+                    
+                parsed_line = interpreter.parse(line)
+                result = interpreter.execute(parsed_line)
                 
-            parsed_line = interpreter.parse(line)
-            result = interpreter.execute(parsed_line)
-            
-            if result is not None and not (isinstance(result, str) and not result):
-                print(f"=> {result}")
-        except KeyboardInterrupt:
-            print("\nUse 'exit' to quit")
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            if debug:
-                import traceback
-                traceback.print_exc()
+                if result is not None and not (isinstance(result, str) and not result):
+                    print(f"=> {result}")
+            except KeyboardInterrupt:
+                print("\nUse 'exit' to quit")
+            except Exception as e:
+                print(f"Error: {str(e)}")
+                if debug:
+                    import traceback
+                    traceback.print_exc()
+    finally:
+        interpreter.close()
 
 def parse_arguments():
     """Parse command line arguments using argparse."""
@@ -898,17 +5494,60 @@ def parse_arguments():
         epilog="Example: python ws.py script.ws --debug"
     )
     
-    parser.add_argument("script", nargs="?", help="Path to the WS script file to execute")
+    parser.add_argument("script", nargs="?",
+                        help="Path to the WS script file to execute, or 'coordinator' / 'worker' for distributed runs")
     parser.add_argument("-v", "--version", action="version", version=f"WS Language Interpreter v{VERSION}",
                         help="Show version information and exit")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Fold constants and remove dead branches before execution")
+    parser.add_argument("--max-concurrency", type=int, default=1, metavar="N",
+                        help="Maximum number of every/at blocks running at the same time (default: 1)")
+    parser.add_argument("-I", "--include-path", action="append", default=[], metavar="DIR",
+                        help="Add a directory to the module search path for import (repeatable)")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="Re-run the script whenever it or one of its imported modules changes")
+    parser.add_argument("--resume", metavar="FILE",
+                        help="Continue the script from the last checkpoint saved in FILE (default checkpoint file: <script>.ckpt)")
+    parser.add_argument("--type-strategy", choices=TYPE_STRATEGIES, default="auto",
+                        help="How 'type' enters text: paste long text through the clipboard and type short text "
+                             "(auto, the default), always paste, or always send key events (keys)")
+    parser.add_argument("--run-cache", metavar="DIR",
+                        help="Keep the results of 'run cached' commands in DIR so they survive between runs")
+    parser.add_argument("--address", default=DEFAULT_COORDINATOR_ADDRESS, metavar="HOST:PORT",
+                        help=f"coordinator/worker: address to listen on or connect to (default: {DEFAULT_COORDINATOR_ADDRESS})")
+    parser.add_argument("--jobs", metavar="FILE",
+                        help="coordinator: JSON Lines file of {\"script\": ..., \"params\": {...}} jobs")
+    parser.add_argument("--retries", type=int, default=0, metavar="N",
+                        help="coordinator: times to retry a failed job (default: 0)")
+    parser.add_argument("--results", metavar="FILE", help="coordinator: write job results as JSON Lines")
+    parser.add_argument("--concurrency", type=int, default=1, metavar="N",
+                        help="worker: maximum number of jobs to run at the same time (default: 1)")
+    parser.add_argument("--max-call-depth", type=int, default=DEFAULT_MAX_CALL_DEPTH, metavar="N",
+                        help=f"Maximum nesting of WS function calls (default: {DEFAULT_MAX_CALL_DEPTH})")
     
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_arguments()
     
-    if args.script:
-        run_ws_file(args.script, debug=args.debug)
+    if args.script == "coordinator" and not os.path.isfile(args.script):
+        if not args.jobs:
+            print("Error: coordinator requires --jobs FILE")
+            sys.exit(2)
+        sys.exit(0 if run_ws_coordinator(args.jobs, args.address, args.retries, args.results) else 1)
+    elif args.script == "worker" and not os.path.isfile(args.script):
+        run_ws_worker(args.address, args.concurrency, debug=args.debug, search_paths=args.include_path,
+                      max_call_depth=args.max_call_depth)
+    elif args.script and args.watch:
+        run_ws_watch(args.script, debug=args.debug, optimize=args.optimize,
+                     max_concurrency=args.max_concurrency, search_paths=args.include_path,
+                     max_call_depth=args.max_call_depth, run_cache=args.run_cache, type_strategy=args.type_strategy)
+    elif args.script:
+        run_ws_file(args.script, debug=args.debug, optimize=args.optimize,
+                    max_concurrency=args.max_concurrency, search_paths=args.include_path,
+                    max_call_depth=args.max_call_depth, run_cache=args.run_cache, resume=args.resume,
+                    type_strategy=args.type_strategy)
     else:
-        run_ws_repl(debug=args.debug) 
+        run_ws_repl(debug=args.debug, search_paths=args.include_path, max_call_depth=args.max_call_depth,
+                    run_cache=args.run_cache, type_strategy=args.type_strategy)